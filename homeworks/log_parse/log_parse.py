@@ -1,33 +1,120 @@
 # -*- encoding: utf-8 -*-
 
-from parse import parse as python_parse
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
+from heapq import heappush, heapreplace
 from urllib.parse import urlparse
 from collections import Counter, defaultdict
+from contextlib import contextmanager
+from itertools import accumulate, chain, islice, repeat
+from bisect import bisect_left, bisect_right
+import io
+import json
+import locale
+import multiprocessing
+import os
 import re
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 PATTERN = '[{}] "{} {} {}" {} {}'
+# PATTERN as the parse library compiles it: every {} is a lazy group, the whole line must match
+LINE_PATTERN = re.compile(r'\[(.+?)\] "(.+?) (.+?) (.+?)" (.+?) (.+?)', re.DOTALL)
+# gives the same groups as LINE_PATTERN when it matches, without backtracking: every lazy group ends
+# at the first occurrence of its delimiter anyway; the rest of the lines are tried with LINE_PATTERN
+FAST_LINE_PATTERN = re.compile(r'\[([^\]]+)\] "([^ ]+) ([^ ]+) ([^"]+)" ([^ ]+) (.+)', re.DOTALL)
+MATCH_GROUP = type(re.match('', '')).group
 FILE_PATTERN = '^.*\/[\w-]+\.[A-Za-z]{1,4}$'
+FILE_REGEX = re.compile(FILE_PATTERN)
 DATETIME_PATTERN = '%d/%b/%Y %H:%M:%S'
 FILE_NAME = 'log.log'
+# urls without these characters are split by cutting the scheme, the rest goes through urlparse:
+# whitespace, control and non-ASCII characters, params, query, fragment and IPv6 brackets
+URL_SPECIAL = re.compile(r'[\x00-\x20\x7f-\U0010ffff;?#\[\]]')
+DATE_CACHE_SIZE = 4096
+# bytes a parallel worker decodes at once
+RANGE_BLOCK_SIZE = 1 << 20
+# lines the columnar mode turns into arrays at once
+COLUMN_BATCH_SIZE = 1 << 13
+# response times summed with numpy, larger ones are summed as python ints so that the sums stay exact
+COLUMN_MAX_RESPONSE_TIME = 1 << 32
+MICROSECOND = timedelta(microseconds=1)
+# the time index of a log file is kept next to it in <log>.index,
+# one entry per INDEX_INTERVAL bytes of the log
+INDEX_SUFFIX = '.index'
+INDEX_INTERVAL = 1 << 16
+INDEX_HEADER = '# log_parse time index: start end min_date max_date crc32\n'
+# what a report of parse_reports can have
+REPORT_KEYS = ('ignore_files', 'ignore_urls', 'start_at', 'stop_at', 'request_type', 'ignore_www', 'slow_queries')
+# bytes before the offset saved by an incremental run that must be the same on the next run
+STATE_CHECK_SIZE = 1 << 12
 
 def request_parser(request_string):
     """Parses the request string to tuple (date, type, request, url, response_time)"""
-    data = python_parse(PATTERN, request_string)
+    data = LINE_PATTERN.fullmatch(request_string)
     if data is not None:
-        line_request_date = datetime.strptime(data[0], DATETIME_PATTERN)
-        line_request_type = data[1]
-        line_request = urlparse(data[2])
+        line_request_date = parse_date(data.group(1))
+        line_request_type = data.group(2)
+        line_request = urlparse(data.group(3))
         line_url = line_request.netloc + line_request.path
-        line_response_time = int(data[5])
+        line_response_time = int(data.group(6))
         return (line_request_date, line_request_type,
                 line_request, line_url, line_response_time)
     else:
         raise ValueError
 
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(date_string):
+    """strptime of the log date, lines of the same second share the result"""
+    return datetime.strptime(date_string, DATETIME_PATTERN)
+
+def split_url(url):
+    """Returns netloc+path of the url, the same as urlparse gives"""
+    if URL_SPECIAL.search(url) is None:
+        if url.startswith('https://'):
+            return url[8:]
+        if url.startswith('http://'):
+            return url[7:]
+    parsed = urlparse(url)
+    return parsed.netloc + parsed.path
+
+def match_line(line):
+    """LINE_PATTERN.fullmatch, tried with FAST_LINE_PATTERN first"""
+    return FAST_LINE_PATTERN.fullmatch(line) or LINE_PATTERN.fullmatch(line)
+
+def parse_line(line):
+    """Fast request_parser: returns (date, type, url, response_time) or None if the line is not a request"""
+    data = match_line(line)
+    if data is None:
+        return None
+    date_string, line_request_type, request, _, _, response_time = data.groups()
+    try:
+        return parse_date(date_string), line_request_type, split_url(request), int(response_time)
+    except ValueError:
+        return None
+
+@contextmanager
+def open_log(log):
+    """Yields lines of a log file path or of a text or binary stream, streams are left open"""
+    if isinstance(log, (str, bytes, os.PathLike)):
+        with open(log) as log_file:
+            yield log_file
+    elif isinstance(log, (io.RawIOBase, io.BufferedIOBase)):
+        log_file = io.TextIOWrapper(log)
+        try:
+            yield log_file
+        finally:
+            log_file.detach()
+    else:
+        yield log
+
 def is_url_of_file(url):
     """Checks if url links to file"""
-    return re.fullmatch(FILE_PATTERN, url)
+    return FILE_REGEX.fullmatch(url)
 
 def strip_www(url):
     """Removes www. from url"""
@@ -51,6 +138,532 @@ def get_5_slowest_queries(url_counter, sum_response_times):
     return [avg_response_time for url, avg_response_time in url_counter.most_common(5)]
 
 
+def filter_requests(lines, ignore_files, ignore_urls, start_at, stop_at, request_type, ignore_www):
+    """Yields (url, response_time) of the request lines passing the filters.
+
+    ignore_urls must already be prepared by prepare_url_list."""
+    for line in lines:
+        parsed = parse_line(line)
+        if parsed is None:
+            continue
+        line_request_date, line_request_type, line_url, line_response_time = parsed
+
+        # Applying function parameters
+        if ignore_www:
+            line_url = strip_www(line_url)
+
+        if passes_filters(line_request_date, line_request_type, line_url,
+                          ignore_files, ignore_urls, start_at, stop_at, request_type):
+            yield line_url, line_response_time
+
+def passes_filters(line_request_date, line_request_type, line_url,
+                   ignore_files, ignore_urls, start_at, stop_at, request_type):
+    """Checks the request against the filters, line_url is already without www. if needed"""
+    if request_type and request_type != line_request_type:
+        return False
+    if line_url in ignore_urls:
+        return False
+    if ignore_files and is_url_of_file(line_url):
+        return False
+    if start_at and line_request_date < start_at :
+        return False
+    if stop_at and stop_at < line_request_date:
+        return False
+    return True
+
+def count_requests(lines, ignore_files, ignore_urls, start_at, stop_at, request_type, ignore_www, slow_queries):
+    """Counts the lines passing the filters, returns url_counter and sum_response_times (None without slow_queries)"""
+    url_counter = Counter()
+    sum_response_times = defaultdict(int) if slow_queries else None
+
+    for line_url, line_response_time in filter_requests(
+            lines, ignore_files, ignore_urls, start_at, stop_at, request_type, ignore_www):
+        url_counter[line_url] += 1
+
+        # Accumulate query time if needed
+        if slow_queries:
+            sum_response_times[line_url]+=line_response_time
+
+    return url_counter, sum_response_times
+
+class SpaceSaving:
+    """Counts of at most capacity urls, the Space-Saving algorithm of Metwally, Agrawal and El Abbadi.
+
+    When capacity urls are counted, a new url takes the place of one with the smallest count c,
+    starts from c + 1 and keeps c as its error. With n counted lines:
+    - every count is at most error, which is at most n / capacity, above the true one;
+    - every url met more than n / capacity times is counted;
+    - with no more than capacity distinct urls the counts are exact.
+    The response times of a url are summed since it got its place, over count - error lines."""
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('capacity must be positive')
+        self.capacity = capacity
+        # url -> [count, error, sum of response times]
+        self.counters = {}
+        # (count, url) of every counted url, counts may be behind the counters
+        self.heap = []
+
+    def add(self, url, response_time):
+        counter = self.counters.get(url)
+        if counter is not None:
+            counter[0] += 1
+            counter[2] += response_time
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[url] = [1, 0, response_time]
+            heappush(self.heap, (1, url))
+            return
+        while True:
+            count, smallest = self.heap[0]
+            current = self.counters[smallest][0]
+            if current == count:
+                break
+            heapreplace(self.heap, (current, smallest))
+        del self.counters[smallest]
+        self.counters[url] = [count + 1, count, response_time]
+        heapreplace(self.heap, (count + 1, url))
+
+    def max_error(self):
+        return max((error for _, error, _ in self.counters.values()), default=0)
+
+    def url_counter(self):
+        return Counter({url: count for url, (count, _, _) in self.counters.items()})
+
+    def observed(self):
+        """url_counter and sum_response_times of the lines since the urls got their places.
+
+        Only urls with count - error >= error, so every average is over at least half of the url's lines"""
+        counters = [(url, counter) for url, counter in self.counters.items() if counter[0] >= 2 * counter[1]]
+        url_counter = Counter({url: count - error for url, (count, error, _) in counters})
+        return url_counter, {url: sum_response_time for url, (_, _, sum_response_time) in counters}
+
+def count_approximate(max_urls, lines, ignore_files, ignore_urls, start_at, stop_at, request_type, ignore_www,
+                      slow_queries):
+    """count_requests keeping at most max_urls urls, see SpaceSaving for the errors.
+
+    With slow_queries the counts are of the lines the response times are summed over."""
+    top_urls = SpaceSaving(max_urls)
+    add = top_urls.add
+    for line_url, line_response_time in filter_requests(
+            lines, ignore_files, ignore_urls, start_at, stop_at, request_type, ignore_www):
+        add(line_url, line_response_time)
+    if slow_queries:
+        return top_urls.observed()
+    return top_urls.url_counter(), None
+
+def to_microseconds(date):
+    return (date - datetime.min) // MICROSECOND
+
+def to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def grow(array, size, fill):
+    return numpy.concatenate([array, numpy.full(size - len(array), fill, array.dtype)])
+
+def batch_columns(lines):
+    """Columns of date, type, request and response time strings of the request lines"""
+    matches = list(map(FAST_LINE_PATTERN.fullmatch, lines))
+    if None in matches:
+        matches = [match or LINE_PATTERN.fullmatch(line) for match, line in zip(matches, lines)]
+        matches = [match for match in matches if match is not None]
+    # one column at a time, without a tuple per line
+    return [list(map(MATCH_GROUP, matches, repeat(group))) for group in (1, 2, 3, 6)]
+
+class ColumnarCounter:
+    """count_requests over batches of lines turned into numpy arrays.
+
+    Urls, methods and dates are interned: every distinct string is split, filtered or parsed once,
+    lines become arrays of codes, the filters become masks and the counting is done by bincount."""
+
+    def __init__(self, ignore_files, ignore_urls, start_at, stop_at, request_type, ignore_www, slow_queries):
+        if numpy is None:
+            raise ImportError('columnar mode needs numpy')
+        self.ignore_files = ignore_files
+        self.ignore_urls = ignore_urls
+        self.start_at = to_microseconds(start_at) if start_at else None
+        self.stop_at = to_microseconds(stop_at) if stop_at else None
+        self.request_type = request_type
+        self.ignore_www = ignore_www
+        self.slow_queries = slow_queries
+        # request -> url code, url code 0 is a request urlparse fails on
+        self.request_codes = {}
+        self.url_codes = {}
+        self.urls = [None]
+        # filter results of the urls met in the current batch, moved to url_allowed after it
+        self.new_allowed = []
+        # date string -> microseconds since datetime.min, -1 for a bad date
+        self.dates = {}
+        self.method_codes = {}
+        self.method_allowed = []
+        # arrays indexed by url code, their length doubles when the urls do not fit
+        self.url_allowed = numpy.zeros(1, bool)
+        self.counts = numpy.zeros(1, numpy.int64)
+        self.sums = numpy.zeros(1, numpy.int64)
+        # number of the first counted line of every url, Counter keeps urls in this order
+        self.first_counted = numpy.full(1, -1, numpy.int64)
+        self.big_sums = defaultdict(int)
+        self.counted = 0
+
+    def reserve(self, size):
+        if size > len(self.counts):
+            size = max(size, 2 * len(self.counts))
+            self.url_allowed = grow(self.url_allowed, size, False)
+            self.counts = grow(self.counts, size, 0)
+            self.sums = grow(self.sums, size, 0)
+            self.first_counted = grow(self.first_counted, size, -1)
+
+    def url_code(self, request):
+        try:
+            url = split_url(request)
+        except ValueError:
+            return 0
+        if self.ignore_www:
+            url = strip_www(url)
+        code = self.url_codes.get(url)
+        if code is None:
+            code = self.url_codes[url] = len(self.urls)
+            self.urls.append(url)
+            self.new_allowed.append(url not in self.ignore_urls and not (self.ignore_files and is_url_of_file(url)))
+        return code
+
+    def date_value(self, date_string):
+        try:
+            return to_microseconds(parse_date(date_string))
+        except ValueError:
+            return -1
+
+    def method_code(self, method):
+        code = self.method_codes[method] = len(self.method_allowed)
+        self.method_allowed.append(not self.request_type or self.request_type == method)
+        return code
+
+    @staticmethod
+    def lookup(table, keys, compute):
+        """Values of the keys in the table, missing ones are computed and stored"""
+        values = list(map(table.get, keys))
+        if None in values:
+            for index, value in enumerate(values):
+                if value is None:
+                    key = keys[index]
+                    value = table.get(key)
+                    if value is None:
+                        value = table[key] = compute(key)
+                    values[index] = value
+        return values
+
+    def add(self, lines):
+        columns = batch_columns(lines)
+        if not columns[0]:
+            return
+        date_strings, methods, requests, response_times = columns
+
+        codes = numpy.array(self.lookup(self.request_codes, requests, self.url_code), numpy.intp)
+        if self.new_allowed:
+            self.reserve(len(self.urls))
+            self.url_allowed[len(self.urls) - len(self.new_allowed):len(self.urls)] = self.new_allowed
+            self.new_allowed = []
+        dates = numpy.array(self.lookup(self.dates, date_strings, self.date_value), numpy.int64)
+        method_codes = numpy.array(self.lookup(self.method_codes, methods, self.method_code), numpy.intp)
+        try:
+            response_times = list(map(int, response_times))
+            valid = None
+        except ValueError:
+            response_times = list(map(to_int, response_times))
+            valid = numpy.array([value is not None for value in response_times])
+            response_times = [value or 0 for value in response_times]
+
+        mask = self.url_allowed[codes] & numpy.array(self.method_allowed)[method_codes]
+        mask &= dates >= (self.start_at if self.start_at is not None else 0)
+        if self.stop_at is not None:
+            mask &= dates <= self.stop_at
+        if valid is not None:
+            mask &= valid
+        counted = codes[mask]
+
+        self.counts += numpy.bincount(counted, minlength=len(self.counts))
+        present, first = numpy.unique(counted, return_index=True)
+        new = self.first_counted[present] < 0
+        self.first_counted[present[new]] = self.counted + first[new]
+        self.counted += len(counted)
+
+        if self.slow_queries:
+            self.add_response_times(counted, mask, response_times)
+
+    def add_response_times(self, counted, mask, response_times):
+        try:
+            times = numpy.array(response_times, numpy.int64)[mask]
+        except OverflowError:
+            times = None
+        if times is not None and numpy.abs(times).max(initial=0) < COLUMN_MAX_RESPONSE_TIME:
+            # the float sums of a batch are below 2**53, so exact
+            self.sums += numpy.bincount(counted, times, len(self.sums)).astype(numpy.int64)
+        else:
+            for code, response_time in zip(counted.tolist(), numpy.array(response_times, object)[mask]):
+                self.big_sums[code] += response_time
+
+    def result(self):
+        """url_counter and sum_response_times as count_requests returns them"""
+        counted = numpy.flatnonzero(self.counts)
+        counted = counted[numpy.argsort(self.first_counted[counted], kind='stable')]
+        url_counter = Counter(dict(zip(map(self.urls.__getitem__, counted.tolist()),
+                                       self.counts[counted].tolist())))
+        if not self.slow_queries:
+            return url_counter, None
+        sum_response_times = defaultdict(int)
+        for code, sum_response_time in zip(counted.tolist(), self.sums[counted].tolist()):
+            sum_response_times[self.urls[code]] = sum_response_time + self.big_sums.get(code, 0)
+        return url_counter, sum_response_times
+
+def count_columnar(lines, *filters):
+    """count_requests with ColumnarCounter, lines are taken COLUMN_BATCH_SIZE at a time"""
+    counter = ColumnarCounter(*filters)
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, COLUMN_BATCH_SIZE))
+        if not batch:
+            return counter.result()
+        counter.add(batch)
+
+def split_ranges(path, parts, start=0, end=None):
+    """Splits the file from start (a line start) to end into parts byte ranges (start, end),
+    every range starts at a line start"""
+    if end is None:
+        end = os.path.getsize(path)
+    bounds = [start]
+    with open(path, 'rb') as log_file:
+        for part in range(1, parts):
+            position = max(start + (end - start) * part // parts, bounds[-1])
+            if position > start:
+                # to the end of the line holding the byte before position
+                log_file.seek(position - 1)
+                log_file.readline()
+                position = log_file.tell()
+            bounds.append(min(position, end))
+    bounds.append(end)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+def read_blocks(path, start, end, size=RANGE_BLOCK_SIZE):
+    """Yields (offset, block) of the byte range in blocks of about size bytes ending at line ends"""
+    with open(path, 'rb') as log_file:
+        log_file.seek(start)
+        offset = start
+        while offset < end:
+            block = log_file.read(min(size, end - offset))
+            if not block:
+                return
+            if not block.endswith(b'\n'):
+                # ranges end at a line end, so this does not go beyond the range
+                block += log_file.readline()
+            yield offset, block
+            offset += len(block)
+
+def decode_lines(block, encoding):
+    """Lines of the block decoded the way open() in text mode does, with universal newlines"""
+    text = block.decode(encoding)
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+def read_range(path, start, end):
+    """Yields lines of the byte range"""
+    encoding = locale.getpreferredencoding(False)
+    for _, block in read_blocks(path, start, end):
+        yield from decode_lines(block, encoding)
+
+def index_path(path):
+    return os.fsdecode(path) + INDEX_SUFFIX
+
+def complete_size(path, size):
+    """Size of the file up to its last line break, a line still being written is not indexed"""
+    with open(path, 'rb') as log_file:
+        end = size
+        while end > 0:
+            start = max(end - INDEX_INTERVAL, 0)
+            log_file.seek(start)
+            line_break = log_file.read(end - start).rfind(b'\n')
+            if line_break >= 0:
+                return start + line_break + 1
+            end = start
+    return 0
+
+def block_dates(lines):
+    """Smallest and largest date in microseconds of the lines, None, None if none has a date"""
+    dates = []
+    for data in map(match_line, lines):
+        if data is not None:
+            try:
+                dates.append(to_microseconds(parse_date(data.group(1))))
+            except ValueError:
+                pass
+    if not dates:
+        return None, None
+    return min(dates), max(dates)
+
+def read_index(path):
+    """Entries (start, end, min_date, max_date, crc32) of the index file, [] if there is none"""
+    try:
+        with open(path) as index_file:
+            if index_file.readline() != INDEX_HEADER:
+                return []
+            return [tuple(None if field == '-' else int(field) for field in line.split())
+                    for line in index_file]
+    except (FileNotFoundError, ValueError):
+        return []
+
+def update_index(path):
+    """Indexes the lines added to the log since the last update, returns the entries and the log size.
+
+    Every entry covers about INDEX_INTERVAL bytes and keeps the smallest and largest date of its lines,
+    so lines out of order do not break the index. The index is rebuilt if its last entry does not
+    match the log any more, as after truncation or rotation."""
+    size = os.path.getsize(path)
+    entries = read_index(index_path(path))
+    if entries:
+        start, end, _, _, crc = entries[-1]
+        if end > size or crc != zlib.crc32(b''.join(block for _, block in read_blocks(path, start, end))):
+            entries = []
+    indexed = entries[-1][1] if entries else 0
+    end = complete_size(path, size)
+    if end <= indexed and entries:
+        return entries, size
+
+    encoding = locale.getpreferredencoding(False)
+    with open(index_path(path), 'a' if entries else 'w') as index_file:
+        if not entries:
+            index_file.write(INDEX_HEADER)
+        for offset, block in read_blocks(path, indexed, end, INDEX_INTERVAL):
+            entry = (offset, offset + len(block)) + block_dates(decode_lines(block, encoding)) + (zlib.crc32(block),)
+            index_file.write(' '.join('-' if field is None else str(field) for field in entry) + '\n')
+            entries.append(entry)
+    return entries, size
+
+def index_ranges(path, start_at, stop_at):
+    """Byte ranges of the log that can hold lines from start_at to stop_at, found with the time index"""
+    entries, size = update_index(path)
+    start = to_microseconds(start_at) if start_at else None
+    stop = to_microseconds(stop_at) if stop_at else None
+    # the largest date up to an entry and the smallest one from it on only grow, so they can be bisected
+    first, last = 0, len(entries)
+    if start is not None:
+        highest = list(accumulate((-1 if high is None else high for _, _, _, high, _ in entries), max))
+        first = bisect_left(highest, start)
+    if stop is not None:
+        lows = (float('inf') if low is None else low for _, _, low, _, _ in reversed(entries))
+        lowest = list(accumulate(lows, min))[::-1]
+        last = bisect_right(lowest, stop)
+    ranges = []
+    for entry_start, entry_end, low, high, _ in entries[first:last]:
+        if low is None or start is not None and high < start or stop is not None and stop < low:
+            continue
+        if ranges and ranges[-1][1] == entry_start:
+            ranges[-1] = (ranges[-1][0], entry_end)
+        else:
+            ranges.append((entry_start, entry_end))
+    # the end of the log that is not indexed yet
+    indexed = entries[-1][1] if entries else 0
+    if indexed < size:
+        if ranges and ranges[-1][1] == indexed:
+            ranges[-1] = (ranges[-1][0], size)
+        else:
+            ranges.append((indexed, size))
+    return ranges
+
+def count_range(count, path, start, end, *filters):
+    return count(read_range(path, start, end), *filters)
+
+def map_ranges(path, ranges, workers, count, *filters):
+    """Results of count over byte ranges of the file in a pool of processes"""
+    with multiprocessing.Pool(min(workers, len(ranges)) or 1) as pool:
+        return pool.starmap(count_range, [(count, path, start, end) + filters for start, end in ranges])
+
+def count_parallel(path, ranges, workers, count, *filters):
+    """count (count_requests or count_columnar) over byte ranges of the file in a pool of processes,
+    partial results are summed"""
+    url_counter = Counter()
+    sum_response_times = defaultdict(int) if filters[-1] else None
+    for partial in map_ranges(path, ranges, workers, count, *filters):
+        add_counts(url_counter, sum_response_times, *partial)
+    return url_counter, sum_response_times
+
+def add_counts(url_counter, sum_response_times, partial_counter, partial_sums):
+    """Adds counts of later lines, new urls go after the known ones as if the lines were counted together"""
+    url_counter.update(partial_counter)
+    if sum_response_times is not None:
+        for url, sum_response_time in partial_sums.items():
+            sum_response_times[url] += sum_response_time
+
+def count_ranges(path, ranges, workers, count, *filters):
+    if workers > 1:
+        return count_parallel(path, ranges, workers, count, *filters)
+    lines = chain.from_iterable(read_range(path, start, end) for start, end in ranges)
+    return count(lines, *filters)
+
+def range_check(path, end):
+    """crc32 of the STATE_CHECK_SIZE bytes before end"""
+    start = max(end - STATE_CHECK_SIZE, 0)
+    with open(path, 'rb') as log_file:
+        log_file.seek(start)
+        return zlib.crc32(log_file.read(end - start))
+
+def read_state(path):
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_state(path, state):
+    """Writes the state to a temporary file first, so an interrupted run leaves the old state"""
+    temporary_path = os.fsdecode(path) + '.tmp'
+    with open(temporary_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_path, path)
+
+def count_incremental(path, state_path, workers, count, *filters):
+    """Counts like count over the whole file, but reads only the lines added since the last run.
+
+    The state file keeps the offset of the first line not counted yet, the device and inode of the log,
+    the crc32 of the bytes before the offset, the filters and the counters of the lines before it.
+    If the log was rotated (another inode), truncated or rewritten, or the filters changed,
+    the counting starts from the beginning of the log."""
+    stat = os.stat(path)
+    key = json.dumps(filters, default=str)
+    state = read_state(state_path)
+    if (state is None or state.get('filters') != key or state.get('file') != [stat.st_dev, stat.st_ino]
+            or state['offset'] > stat.st_size or state['check'] != range_check(path, state['offset'])):
+        state = {'offset': 0, 'url_counter': {}, 'sum_response_times': {}}
+    url_counter = Counter(state['url_counter'])
+    sum_response_times = defaultdict(int, state['sum_response_times']) if filters[-1] else None
+
+    # a line still being written is counted now, but saved to the state on the next run
+    end = complete_size(path, stat.st_size)
+    if end > state['offset']:
+        ranges = split_ranges(path, workers, state['offset'], end)
+        add_counts(url_counter, sum_response_times, *count_ranges(path, ranges, workers, count, *filters))
+    write_state(state_path, {
+        'filters': key,
+        'file': [stat.st_dev, stat.st_ino],
+        'offset': end,
+        'check': range_check(path, end),
+        'url_counter': url_counter,
+        'sum_response_times': sum_response_times or {},
+    })
+    if end < stat.st_size:
+        add_counts(url_counter, sum_response_times,
+                   *count_ranges(path, [(end, stat.st_size)], 1, count, *filters))
+    return url_counter, sum_response_times
+
+
 def parse(
     ignore_files=False,
     ignore_urls=[],
@@ -58,53 +671,113 @@ def parse(
     stop_at=None,
     request_type=None,
     ignore_www=False,
-    slow_queries=False
+    slow_queries=False,
+    log=FILE_NAME,
+    workers=1,
+    columnar=False,
+    index=False,
+    state=None,
+    max_urls=None
 ):
+    """log is a file path or a text or binary stream, with workers > 1 a file is parsed by that many processes.
 
-    with open(FILE_NAME) as log_file:
-        url_counter = Counter()
-        if slow_queries:
-            sum_response_times = defaultdict(int)
+    columnar counts batches of lines with numpy instead of line by line.
+    With index only the parts of a log file that can hold dates from start_at to stop_at are read,
+    they are found with the time index kept next to the log, which is created and updated on the way.
+    state is a file to keep the counters of a log file between runs with, each run reads only new lines.
+    max_urls limits the memory: at most that many urls are counted, the answers become approximate."""
+    if ignore_urls:
+        prepare_url_list(ignore_urls, ignore_www)
+    filters = (ignore_files, ignore_urls, start_at, stop_at, request_type, ignore_www, slow_queries)
+    count = count_columnar if columnar else count_requests
+    if max_urls is not None:
+        if workers > 1 or columnar or state is not None:
+            raise ValueError('max_urls works only line by line, in one process and without state')
+        count = partial(count_approximate, max_urls)
 
-        if ignore_urls:
-            prepare_url_list(ignore_urls, ignore_www)
+    is_path = isinstance(log, (str, bytes, os.PathLike))
+    if state is not None and not is_path:
+        raise ValueError('state needs a log file path')
+    if state is not None:
+        ranges = None
+    elif index and is_path and (start_at or stop_at):
+        ranges = index_ranges(log, start_at, stop_at)
+    elif workers > 1 and is_path:
+        ranges = split_ranges(log, workers)
+    else:
+        ranges = None
 
-        for line in log_file:
-            try:
-                line_request_date, line_request_type, \
-                line_request, line_url, line_response_time = request_parser(line)
-            except ValueError:
-                continue
-
-            # Applying function parameters
-            if ignore_www:
-                line_url = strip_www(line_url)
-
-            # Checking conditions
-            if request_type and request_type != line_request_type:
-                continue
-            if line_url in ignore_urls:
-                continue
-            if ignore_files and is_url_of_file(line_url):
-                continue
-            if start_at and line_request_date < start_at :
-                continue
-            if stop_at and stop_at < line_request_date:
-                continue
-
-            # Got here, if request and url are valid
-            url_counter[line_url] += 1
-
-            # Accumulate query time if needed
-            if slow_queries:
-                sum_response_times[line_url]+=line_response_time
-
-    # Function returns
+    if state is not None:
+        url_counter, sum_response_times = count_incremental(log, state, workers, count, *filters)
+    elif ranges is None:
+        with open_log(log) as log_file:
+            url_counter, sum_response_times = count(log_file, *filters)
+    else:
+        url_counter, sum_response_times = count_ranges(log, ranges, workers, count, *filters)
+
+    return answer(url_counter, sum_response_times, slow_queries)
+
+def answer(url_counter, sum_response_times, slow_queries):
+    """Counts of the top 5 urls or, with slow_queries, top 5 average response times"""
     if slow_queries:
         return get_5_slowest_queries(url_counter, sum_response_times)
     else:
         return [count for name, count in url_counter.most_common(5)]
 
+def report_filters(report):
+    """Filters of parse, as count_requests takes them, from a report dict.
+
+    ignore_urls is copied before prepare_url_list and made a set"""
+    unknown = set(report) - set(REPORT_KEYS)
+    if unknown:
+        raise TypeError('unknown report keys: {}'.format(', '.join(sorted(unknown))))
+    ignore_www = report.get('ignore_www', False)
+    ignore_urls = list(report.get('ignore_urls', []))
+    prepare_url_list(ignore_urls, ignore_www)
+    return (report.get('ignore_files', False), set(ignore_urls), report.get('start_at'), report.get('stop_at'),
+            report.get('request_type'), ignore_www, report.get('slow_queries', False))
+
+def count_reports(lines, reports):
+    """count_requests for every filters tuple of reports, every line is parsed once"""
+    results = [(Counter(), defaultdict(int) if filters[-1] else None) for filters in reports]
+    reports = list(zip(reports, results))
+    strip = any(filters[5] for filters, _ in reports)
+
+    for line in lines:
+        parsed = parse_line(line)
+        if parsed is None:
+            continue
+        line_request_date, line_request_type, line_url, line_response_time = parsed
+        url_without_www = strip_www(line_url) if strip else line_url
+
+        for filters, (url_counter, sum_response_times) in reports:
+            ignore_files, ignore_urls, start_at, stop_at, request_type, ignore_www, slow_queries = filters
+            url = url_without_www if ignore_www else line_url
+            if passes_filters(line_request_date, line_request_type, url,
+                              ignore_files, ignore_urls, start_at, stop_at, request_type):
+                url_counter[url] += 1
+                if slow_queries:
+                    sum_response_times[url] += line_response_time
+
+    return results
+
+def parse_reports(reports, log=FILE_NAME, workers=1):
+    """Answers of parse for every report in one pass over the log.
+
+    A report is a dict of parse filter arguments and slow_queries, for example
+    {'ignore_www': True, 'slow_queries': True}; log and workers are the same as in parse."""
+    reports = [report_filters(report) for report in reports]
+    if workers > 1 and isinstance(log, (str, bytes, os.PathLike)):
+        results = [(Counter(), defaultdict(int) if filters[-1] else None) for filters in reports]
+        for partial in map_ranges(log, split_ranges(log, workers), workers, count_reports, reports):
+            for result, partial_result in zip(results, partial):
+                add_counts(*result, *partial_result)
+    else:
+        with open_log(log) as log_file:
+            results = count_reports(log_file, reports)
+    return [answer(url_counter, sum_response_times, filters[-1])
+            for filters, (url_counter, sum_response_times) in zip(reports, results)]
+
 def main():
     print (parse(slow_queries=True))
     # pass
@@ -1,8 +1,29 @@
 # -*- encoding: utf-8 -*-
 
 import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
 from glob import glob
-from log_parse import parse
+import log_parse
+from log_parse import parse, parse_reports, numpy
+
+# lines out of order, as in the README example
+LATE_LINES = (
+    '[21/Mar/2018 21:53:10] "GET https://corp.mail.ru/fitness/pay_list/ HTTP/1.1" 500 120426\n'
+    '[21/Mar/2018 21:32:11] "GET https://mail.ru/static/js/jquery-go-top/go-top.png HTTP/1.1" 200 1845\n'
+    '[18/Mar/2018 11:19:40] "GET https://sys.mail.ru/calendar/config/254/40263/ HTTP/1.1" 200 965\n'
+)
+# a line still being written is not indexed yet, but must be counted
+UNFINISHED_LINE = '[21/Mar/2018 21:35:00] "GET https://mail.ru/fitness/pay_list HTTP/1.1" 301 9'
+INDEX_WINDOWS = [
+    (datetime(2018, 3, 21, 21, 32), datetime(2018, 3, 21, 21, 40)),
+    (datetime(2018, 3, 18, 11, 19, 40), datetime(2018, 3, 18, 11, 19, 40)),
+    (datetime(2018, 3, 20), None),
+    (None, datetime(2018, 3, 19)),
+    (datetime(2018, 4, 1), None),
+]
 
 error_message = 'Ошибка в файле {}. Expected: "{}", got: "{}"'
 
@@ -11,14 +32,103 @@ def run_tests():
     for filename in glob('tests/*.json'):
         data = json.load(open(filename))
         params, response = data['params'], data['response']
-        got = parse(**data['params'])
-        for index, item in enumerate(response):
-            if len(got) != len(response) or got[index] != response[index]:
-                print("Полученный и ожидаемый массивы различаются, получен: {} ожидался: {}, файл {}".format(
-                    str(got), str(response), filename
-                ))
-                return
-    print("All tests passed!")
+        with open('log.log', 'rb') as log_file:
+            runs = [parse(**data['params']), parse(log=log_file, **data['params']),
+                    parse(workers=3, **data['params']), parse(max_urls=1000, **data['params'])]
+            if numpy is not None:
+                runs.append(parse(columnar=True, **data['params']))
+        for got in runs:
+            for index, item in enumerate(response):
+                if len(got) != len(response) or got[index] != response[index]:
+                    print("Полученный и ожидаемый массивы различаются, получен: {} ожидался: {}, файл {}".format(
+                        str(got), str(response), filename
+                    ))
+                    return
+    if run_reports_tests() and run_index_tests() and run_state_tests() and run_approximate_tests():
+        print("All tests passed!")
+
+
+def run_reports_tests():
+    """All the cases as reports of one parse_reports call"""
+    filenames = glob('tests/*.json')
+    cases = [json.load(open(filename)) for filename in filenames]
+    reports = [case['params'] for case in cases]
+    for got in [parse_reports(reports), parse_reports(reports, workers=3)]:
+        for filename, case, answer in zip(filenames, cases, got):
+            if answer != case['response']:
+                print("Отчет отличается, получен: {} ожидался: {}, файл {}".format(answer, case['response'], filename))
+                return False
+    return True
+
+
+def run_index_tests():
+    """parse with the time index reads only a part of the file and must give the same answers"""
+    interval = log_parse.INDEX_INTERVAL
+    log_parse.INDEX_INTERVAL = 512
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'log.log')
+            shutil.copy('log.log', path)
+            for late_lines in ['', LATE_LINES, UNFINISHED_LINE]:
+                with open(path, 'a') as log_file:
+                    log_file.write(late_lines)
+                for start_at, stop_at in INDEX_WINDOWS:
+                    expected = parse(log=path, start_at=start_at, stop_at=stop_at, slow_queries=True)
+                    got = parse(log=path, start_at=start_at, stop_at=stop_at, slow_queries=True, index=True)
+                    if got != expected:
+                        print("Разбор с индексом отличается, получен: {} ожидался: {}, интервал {} - {}".format(
+                            got, expected, start_at, stop_at
+                        ))
+                        return False
+    finally:
+        log_parse.INDEX_INTERVAL = interval
+    return True
+
+
+def run_state_tests():
+    """parse with a state file reads only the added lines and must give the same answers as a full parse"""
+    with open('log.log') as log_file:
+        text = log_file.read()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'log.log')
+        # appended in parts cut in the middle of lines, truncated and written again in place, replaced
+        steps = [('w', text[:5000]), ('a', text[5000:9001]), ('a', text[9001:]), ('a', ''), ('r+', text[:7000]),
+                 ('r+', LATE_LINES * 30 + text), ('w', text[1000:])]
+        for mode, part in steps:
+            if mode == 'w' and os.path.exists(path):
+                os.remove(path)
+            with open(path, mode) as log_file:
+                log_file.truncate()
+                log_file.write(part)
+            for number, params in enumerate([{}, {'slow_queries': True, 'ignore_www': True}]):
+                expected = parse(log=path, **params)
+                got = parse(log=path, state=os.path.join(directory, '{}.state'.format(number)), **params)
+                if got != expected:
+                    print("Инкрементальный разбор отличается, получен: {} ожидался: {}, параметры {}".format(
+                        got, expected, params
+                    ))
+                    return False
+    return True
+
+
+def run_approximate_tests():
+    """Counts of SpaceSaving are at most n / capacity above the exact ones, and frequent urls are not lost"""
+    filters = (False, [], None, None, None, False)
+    exact, _ = log_parse.count_requests(open('log.log'), *filters, False)
+    lines = sum(exact.values())
+    for capacity in [3, 10, 30]:
+        top_urls = log_parse.SpaceSaving(capacity)
+        for url, response_time in log_parse.filter_requests(open('log.log'), *filters):
+            top_urls.add(url, response_time)
+        for url, (count, error, _) in top_urls.counters.items():
+            if not exact[url] <= count <= exact[url] + error or error > lines / capacity:
+                print("Ошибка приближенного счетчика {}: {} +- {}, точно {}".format(url, count, error, exact[url]))
+                return False
+        lost = [url for url, count in exact.items() if count > lines / capacity and url not in top_urls.counters]
+        if lost:
+            print("Приближенный счетчик потерял частые урлы: {}".format(lost))
+            return False
+    return True
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+import asyncio
+from collections import deque
+
+from framing import CommandReader, response_buffers
+
+
+class TaskQueueProtocol(asyncio.BufferedProtocol):
+    """Serves one client connection.
+
+    Old clients send a single command without a newline and the connection is closed after the response.
+    New clients terminate commands with a newline and keep the connection: commands may be pipelined
+    and are answered in order, each response terminated by a newline.
+
+    Incoming bytes go straight into the CommandReader buffers, payloads are sent back without joining.
+    A command may answer with a coroutine (e.g. background SAVE) or a future (e.g. ADD waiting
+    for the log fsync), later responses wait for it.
+
+    With length_prefixed every response is sent as "<length>\n<response>" instead, so a peer
+    can read it without knowing the command (used between shards).
+
+    SYNC as the first command turns the connection into a replication link: the server streams
+    its mutations and the follower sends back the positions it has applied.
+    """
+
+    def __init__(self, queue_server, length_prefixed=False):
+        self.queue_server = queue_server
+        self.length_prefixed = length_prefixed
+        self.transport = None
+        self.reader = CommandReader()
+        if length_prefixed:
+            # peers always terminate commands, a partly received first command is not an old client
+            self.reader.persistent = True
+        self.responses = deque()
+        # FollowerLink after SYNC
+        self.follower = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if self.follower is not None:
+            self.queue_server.replication.remove_follower(self.follower)
+        # nobody is left to answer: a parked GET must not take the next task
+        for response in self.responses:
+            if isinstance(response, asyncio.Future):
+                response.cancel()
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        if self.reader.persistent is False:
+            # old client has already sent its command
+            return
+        for command, payloads in self.reader.buffer_updated(nbytes):
+            self.respond(command, payloads)
+        self.write_responses()
+
+    def respond(self, command, payloads):
+        if self.follower is not None:
+            self.follower.acknowledge(command)
+            return
+        if command == b"SYNC" and self.queue_server.replication is not None and not self.responses:
+            self.follower = self.queue_server.replication.add_follower(self.transport)
+            return
+        if command is None:
+            response = "ERROR"
+        else:
+            response = self.queue_server.parse_command(command, payloads)
+        if asyncio.iscoroutine(response):
+            response = asyncio.ensure_future(response)
+        if isinstance(response, asyncio.Future):
+            response.add_done_callback(lambda _: self.write_responses())
+        self.responses.append(response)
+
+    def write_responses(self):
+        if self.transport.is_closing():
+            return
+        while self.responses:
+            response = self.responses[0]
+            if isinstance(response, asyncio.Future):
+                if not response.done():
+                    return
+                response = response.result() if response.exception() is None else "ERROR"
+            self.responses.popleft()
+            if self.length_prefixed:
+                buffers = response_buffers(response)
+                self.transport.write(b"%d\n" % sum(len(buffer) for buffer in buffers))
+            else:
+                buffers = response_buffers(response, b"\n" if self.reader.persistent else b"")
+            for buffer in buffers:
+                self.transport.write(buffer)
+        if self.reader.persistent is False or self.reader.broken:
+            self.transport.close()
+
+
+def serve(queue_server):
+    async def run():
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: TaskQueueProtocol(queue_server),
+            queue_server.ip,
+            queue_server.port,
+            reuse_address=True)
+        # the loop keeps only a weak reference to tasks
+        metrics = asyncio.ensure_future(queue_server.write_metrics_periodically())
+        replication = asyncio.ensure_future(queue_server.replicate())
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
@@ -0,0 +1,46 @@
+"""ACK/IN latency against queue depth.
+
+Run from the task_queue directory:
+
+    python -m bench.ack_latency [depth ...]
+"""
+import random
+import sys
+import time
+
+from server import TaskQueue
+
+
+DEFAULT_DEPTHS = [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+SAMPLES = 1000
+
+
+def fill_queue(depth):
+    queue = TaskQueue("bench", 3600)
+    for _ in range(depth):
+        queue.add(b"x")
+    for _ in range(depth):
+        queue.get()
+    return queue
+
+
+def measure(operation, ids):
+    start = time.perf_counter()
+    for task_id in ids:
+        operation(task_id)
+    return (time.perf_counter() - start) / len(ids) * 10 ** 6
+
+
+def main():
+    depths = [int(arg) for arg in sys.argv[1:]] or DEFAULT_DEPTHS
+    print(f"{'depth':>10} {'IN, us':>10} {'ACK, us':>10}")
+    for depth in depths:
+        queue = fill_queue(depth)
+        ids = [str(task_id) for task_id in random.sample(range(1, depth + 1), SAMPLES)]
+        in_latency = measure(queue.has, ids)
+        ack_latency = measure(queue.acknowledge, ids)
+        print(f"{depth:>10} {in_latency:>10.2f} {ack_latency:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Tasks per second with single-item ADD/GET/ACK versus MADD/MGET/MACK batches.
+
+Every command is sent on its own connection, as old clients do. Run from the task_queue directory:
+
+    python -m bench.batch_throughput [tasks]
+"""
+import sys
+import time
+
+from bench.common import run_server, send_once
+
+
+PORT = 5601
+DEFAULT_TASKS = 2000
+BATCH_SIZES = [10, 100, 1000]
+DATA = b"12345"
+
+
+def single(tasks):
+    for _ in range(tasks):
+        task_id = send_once(PORT, b"ADD bench %d %s" % (len(DATA), DATA))
+        send_once(PORT, b"GET bench")
+        send_once(PORT, b"ACK bench " + task_id)
+
+
+def batched(tasks, batch_size):
+    item = b"%d %s" % (len(DATA), DATA)
+    for _ in range(tasks // batch_size):
+        task_ids = send_once(PORT, b"MADD bench %d " % batch_size + b" ".join([item] * batch_size))
+        send_once(PORT, b"MGET bench %d" % batch_size)
+        send_once(PORT, b"MACK bench " + task_ids)
+
+
+def measure(function, tasks, *args):
+    start = time.perf_counter()
+    function(tasks, *args)
+    return tasks / (time.perf_counter() - start)
+
+
+def main():
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_TASKS
+    print(f"{'commands':>16} {'tasks/s':>10}")
+    with run_server(PORT):
+        print(f"{'ADD/GET/ACK':>16} {measure(single, tasks):>10.0f}")
+        for batch_size in BATCH_SIZES:
+            rate = measure(batched, max(tasks, batch_size), batch_size)
+            print(f"{f'batch of {batch_size}':>16} {rate:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Operations per second of the client library against a local async server.
+
+An operation is one ADD, GET or ACK of one task, whether it was sent alone or in a batch.
+Run from the task_queue directory:
+
+    python -m bench.client_throughput [tasks]
+"""
+import asyncio
+import sys
+import time
+
+from bench.common import run_server
+from client import Client, AsyncClient
+
+
+PORT = 5631
+DEFAULT_TASKS = 100000
+PIPELINE = 1000
+BATCH = 100
+DATA = b"12345"
+
+
+def sync_pipelined(tasks):
+    client = Client(port=PORT)
+    for _ in range(tasks // PIPELINE):
+        with client.pipeline() as pipeline:
+            for _ in range(PIPELINE):
+                pipeline.add("bench", DATA)
+            task_ids = pipeline.execute()
+            for _ in range(PIPELINE):
+                pipeline.get("bench")
+            for task_id in task_ids:
+                pipeline.ack("bench", task_id)
+            pipeline.execute()
+    client.close()
+
+
+def sync_batched(tasks):
+    client = Client(port=PORT)
+    for _ in range(tasks // (PIPELINE * BATCH) or 1):
+        with client.pipeline() as pipeline:
+            for _ in range(PIPELINE // 10):
+                pipeline.add_many("bench", [DATA] * BATCH)
+            batches = pipeline.execute()
+            for _ in batches:
+                pipeline.get_many("bench", BATCH)
+            for task_ids in batches:
+                pipeline.ack_many("bench", task_ids)
+            pipeline.execute()
+    client.close()
+
+
+async def async_pipelined(tasks):
+    client = AsyncClient(port=PORT)
+    for _ in range(tasks // PIPELINE):
+        task_ids = await asyncio.gather(*(client.add("bench", DATA) for _ in range(PIPELINE)))
+        await asyncio.gather(*(client.get("bench") for _ in range(PIPELINE)))
+        await asyncio.gather(*(client.ack("bench", task_id) for task_id in task_ids))
+    await client.close()
+
+
+async def async_batched(tasks):
+    client = AsyncClient(port=PORT)
+    for _ in range(tasks // (PIPELINE * BATCH) or 1):
+        batches = await asyncio.gather(*(client.add_many("bench", [DATA] * BATCH) for _ in range(PIPELINE // 10)))
+        await asyncio.gather(*(client.get_many("bench", BATCH) for _ in batches))
+        await asyncio.gather(*(client.ack_many("bench", task_ids) for task_ids in batches))
+    await client.close()
+
+
+def measure(function, tasks):
+    start = time.perf_counter()
+    result = function(tasks)
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+    if function in (sync_batched, async_batched):
+        tasks = max(tasks // (PIPELINE * BATCH), 1) * PIPELINE // 10 * BATCH
+    return 3 * tasks / (time.perf_counter() - start)
+
+
+def main():
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_TASKS
+    print(f"{'client':>28} {'ops/s':>10}")
+    with run_server(PORT, "-m", "async"):
+        for name, function in (("sync, pipelined", sync_pipelined), ("sync, pipelined batches", sync_batched),
+                               ("asyncio, pipelined", async_pipelined),
+                               ("asyncio, pipelined batches", async_batched)):
+            print(f"{name:>28} {measure(function, tasks):>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@contextlib.contextmanager
+def run_server(port, *args):
+    """Starts server.py with a fresh checkpoints dir and waits until it accepts connections"""
+    with tempfile.TemporaryDirectory() as path:
+        server = subprocess.Popen(
+            [sys.executable, "server.py", "-i", "127.0.0.1", "-p", str(port), "-c", path + "/"] + list(args),
+            cwd=SERVER_DIR)
+        try:
+            wait_for_port(port)
+            yield server
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def send_once(port, command):
+    """Sends one command the old way: a connection per command"""
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.sendall(command)
+        s.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = s.recv(1 << 16)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
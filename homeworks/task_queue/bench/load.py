@@ -0,0 +1,176 @@
+"""Load generator: concurrent clients running a mix of ADD/GET/ACK/IN against a local server.
+
+For every queue depth and payload size the server is started with a fresh checkpoints dir,
+the queue is prefilled to the depth with MADD, then the clients run for the given time.
+Reports ops/s and p50/p99/p999 latency per command as JSON. Run from the task_queue directory:
+
+    python -m bench.load --depths 1000,100000 --payloads 10,1000 --clients 8 --output load.json
+
+Clients are processes, each with one outstanding command: in sync mode every command uses its
+own connection, in async mode every client keeps a persistent connection. Results of different
+commits are comparable only when produced with the same options on the same machine.
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import socket
+import subprocess
+import time
+
+from bench.common import SERVER_DIR, run_server, send_once
+
+
+PORT = 5621
+COMMANDS = ("ADD", "GET", "ACK", "IN")
+# payload bytes per prefill MADD
+PREFILL_BYTES = 1 << 22
+PREFILL_BATCH = 1000
+
+
+def parse_mix(text):
+    """Parses add=2,get=1 into {"ADD": 2.0, "GET": 1.0}"""
+    mix = {}
+    for item in text.split(","):
+        command, weight = item.split("=")
+        if command.upper() not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command {command}")
+        mix[command.upper()] = float(weight)
+    return mix
+
+
+def parse_sizes(text):
+    return [int(size) for size in text.split(",")]
+
+
+def prefill(depth, payload):
+    item = b"%d %s" % (len(payload), payload)
+    batch = max(1, min(PREFILL_BATCH, PREFILL_BYTES // max(len(payload), 1)))
+    added = 0
+    while added < depth:
+        count = min(batch, depth - added)
+        send_once(PORT, b"MADD load %d " % count + b" ".join([item] * count))
+        added += count
+
+
+class Connection:
+    def __init__(self, persistent):
+        self.persistent = persistent
+        if persistent:
+            self.socket = socket.create_connection(("127.0.0.1", PORT))
+            self.file = self.socket.makefile("rwb")
+
+    def execute(self, command):
+        if not self.persistent:
+            return send_once(PORT, command)
+        self.file.write(command + b"\n")
+        self.file.flush()
+        # payloads are made of b"x", so a response is one line
+        return self.file.readline()[:-1]
+
+
+def run_client(options):
+    """Runs commands until the deadline, returns {command: [latency, ...]}"""
+    number, mix, payload, duration, persistent, seed = options
+    rng = random.Random(seed + number)
+    connection = Connection(persistent)
+    commands, weights = list(mix), list(mix.values())
+    add = b"ADD load %d %s" % (len(payload), payload)
+    # ids this client got and has not acknowledged yet
+    taken = []
+    latencies = {command: [] for command in COMMANDS}
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        command = rng.choices(commands, weights)[0]
+        if command in ("ACK", "IN") and not taken:
+            command = "GET"
+        if command == "ADD":
+            data = add
+        elif command == "GET":
+            data = b"GET load"
+        elif command == "ACK":
+            data = b"ACK load " + taken.pop()
+        else:
+            data = b"IN load " + rng.choice(taken)
+        start = time.perf_counter()
+        response = connection.execute(data)
+        latencies[command].append(time.perf_counter() - start)
+        if command == "GET" and response != b"NONE":
+            taken.append(response.split(b" ", 1)[0])
+    return latencies
+
+
+def percentile(values, q):
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def summarize(latencies, duration):
+    result = {"ops_per_sec": sum(map(len, latencies.values())) / duration, "commands": {}}
+    for command, values in latencies.items():
+        if not values:
+            continue
+        values.sort()
+        result["commands"][command] = {
+            "count": len(values),
+            "ops_per_sec": len(values) / duration,
+            "p50_ms": percentile(values, 0.5) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "p999_ms": percentile(values, 0.999) * 1000,
+        }
+    return result
+
+
+def run(args, depth, size):
+    payload = b"x" * size
+    with run_server(PORT, "-m", args.mode, *args.server_args.split()):
+        prefill(depth, payload)
+        options = [(number, args.mix, payload, args.duration, args.mode == "async", args.seed)
+                   for number in range(args.clients)]
+        with multiprocessing.Pool(args.clients) as pool:
+            results = pool.map(run_client, options)
+    latencies = {command: [value for result in results for value in result[command]] for command in COMMANDS}
+    # every client runs for the duration
+    return dict(depth=depth, payload=size, **summarize(latencies, args.duration))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=SERVER_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load benchmark of the task queue server')
+    parser.add_argument('--mode', choices=["sync", "async"], default="async", help='Server mode')
+    parser.add_argument('--server-args', default="", help='Extra server arguments, e.g. "-w -l 100000000"')
+    parser.add_argument('--clients', type=int, default=4, help='Number of client processes')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds of load for every depth and payload')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix("add=1,get=1,ack=1,in=1"),
+                        help='Command weights, e.g. add=1,get=1,ack=1,in=1')
+    parser.add_argument('--depths', type=parse_sizes, default=[1000, 100000],
+                        help='Comma separated queue depths to prefill, e.g. 1000,100000,10000000')
+    parser.add_argument('--payloads', type=parse_sizes, default=[10, 1000, 100000],
+                        help='Comma separated payload sizes in bytes, up to 1000000')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the command choice')
+    parser.add_argument('--output', help='JSON file for the results, stdout if not given')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = {
+        "commit": git_commit(),
+        "options": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": [run(args, depth, size) for depth in args.depths for size in args.payloads],
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
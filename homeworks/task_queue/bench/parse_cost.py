@@ -0,0 +1,40 @@
+"""Per-command cost of the protocol tokenizer and of a whole parse_command call.
+
+parse_command includes the tokenizer, dispatch and the queue operation itself, but not
+framing: commands come already cut from the stream, as CommandReader passes them. Commands
+that change the queue are kept cheap: GET finds an empty queue, ACK and IN an unknown id.
+Run from the task_queue directory:
+
+    python -m bench.parse_cost [repeat]
+"""
+import sys
+import timeit
+
+from protocol import tokenize
+from server import TaskQueueServer
+
+
+DEFAULT_REPEAT = 100000
+COMMANDS = [
+    (b"ADD queue 5", [b"12345"]),
+    (b"ADD queue delay=0 priority=0 5", [b"12345"]),
+    (b"GET empty", []),
+    (b"ACK queue 123456789", []),
+    (b"IN queue 123456789", []),
+    (b"MACK queue 1 2 3 4 5 6 7 8", []),
+    (b"STATS queue", []),
+]
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_REPEAT
+    server = TaskQueueServer("127.0.0.1", 5555, "./nonexistent/", 300)
+    print(f"{'command':>32} {'tokenize, us':>13} {'parse_command, us':>18}")
+    for command, payloads in COMMANDS:
+        tokenize_cost = timeit.timeit(lambda: tokenize(command), number=repeat) / repeat * 10 ** 6
+        command_cost = timeit.timeit(lambda: server.parse_command(command, payloads), number=repeat) / repeat * 10 ** 6
+        print(f"{command.decode():>32} {tokenize_cost:>13.2f} {command_cost:>18.2f}")
+
+
+if __name__ == '__main__':
+    main()
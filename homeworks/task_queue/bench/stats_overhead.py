@@ -0,0 +1,51 @@
+"""Cost of the STATS instrumentation: commands per second of an async server with latency histograms off and on.
+
+ADD/GET/ACK commands are pipelined over one persistent connection, so the server and not
+the connection setup is the bottleneck. Run from the task_queue directory:
+
+    python -m bench.stats_overhead [tasks]
+"""
+import socket
+import sys
+import time
+
+from bench.common import run_server
+
+
+PORTS = {"off": 5611, "on": 5612}
+DEFAULT_TASKS = 20000
+ROUNDS = 5
+PIPELINE = 500
+
+
+def run(port, tasks):
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        connection = s.makefile("rwb")
+        start = time.perf_counter()
+        for _ in range(tasks // PIPELINE):
+            connection.write(b"ADD bench 5 12345\n" * PIPELINE)
+            connection.flush()
+            task_ids = [connection.readline().strip() for _ in range(PIPELINE)]
+            connection.write(b"GET bench\n" * PIPELINE + b"".join(b"ACK bench %s\n" % task_id for task_id in task_ids))
+            connection.flush()
+            for _ in range(2 * PIPELINE):
+                connection.readline()
+        return 3 * tasks / (time.perf_counter() - start)
+
+
+def main():
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_TASKS
+    rates = {"off": [], "on": []}
+    with run_server(PORTS["off"], "-m", "async"), run_server(PORTS["on"], "-m", "async", "-s"):
+        # alternate the runs so that both see the same machine noise
+        for _ in range(ROUNDS):
+            for stats in rates:
+                rates[stats].append(run(PORTS[stats], tasks))
+    print(f"{'stats':>8} {'commands/s':>12}")
+    for stats, values in rates.items():
+        print(f"{stats:>8} {max(values):>12.0f}")
+    print(f"overhead {100 * (1 - max(rates['on']) / max(rates['off'])):.1f}%")
+
+
+if __name__ == '__main__':
+    main()
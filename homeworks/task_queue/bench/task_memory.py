@@ -0,0 +1,43 @@
+"""Memory per queued task, measured with tracemalloc.
+
+Reports bytes per task for tasks waiting in the queue and for given out ones, payloads are
+created before tracing starts, so they are not counted. Run from the task_queue directory:
+
+    python -m bench.task_memory [tasks]
+"""
+import gc
+import sys
+import tracemalloc
+
+from server import TaskQueue
+
+
+DEFAULT_TASKS = 100000
+PAYLOAD_SIZE = 10
+TIMEOUT = 3600
+
+
+def measure(tasks, given_out):
+    payloads = [b"%0*d" % (PAYLOAD_SIZE, number) for number in range(tasks)]
+    gc.collect()
+    tracemalloc.start()
+    queue = TaskQueue("bench", TIMEOUT)
+    for payload in payloads:
+        queue.add(payload)
+    if given_out:
+        for _ in range(tasks):
+            queue.get()
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used / tasks
+
+
+def main():
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_TASKS
+    print(f"{'tasks':>10} {'queued, B':>10} {'given out, B':>13}")
+    print(f"{tasks:>10} {measure(tasks, False):>10.0f} {measure(tasks, True):>13.0f}")
+
+
+if __name__ == '__main__':
+    main()
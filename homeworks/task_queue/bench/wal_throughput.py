@@ -0,0 +1,76 @@
+"""ADD+GET+ACK throughput in memory and with the write-ahead log.
+
+The sync mode server answers before fsync (write-behind). The async mode one answers ADD and ACK
+after the fsync that covers them (group commit), so it is measured with concurrent clients,
+each waiting for its responses like a real one would.
+
+Run from the task_queue directory:
+
+    python -m bench.wal_throughput [tasks] [clients]
+"""
+import asyncio
+import sys
+import tempfile
+import time
+
+from server import TaskQueueServer
+
+
+DEFAULT_TASKS = 100000
+DEFAULT_CLIENTS = 100
+FLUSH_INTERVALS = [0.01, 0.1]
+
+
+def measure(server, tasks):
+    start = time.perf_counter()
+    for _ in range(tasks):
+        task_id = server.parse_command(b"ADD bench 5 12345")
+        server.parse_command(b"GET bench")
+        server.parse_command(b"ACK bench " + task_id.encode())
+    return tasks / (time.perf_counter() - start)
+
+
+async def _response(response):
+    return await response if isinstance(response, asyncio.Future) else response
+
+
+async def _client(server, tasks):
+    for _ in range(tasks):
+        await _response(server.parse_command(b"ADD bench 5 12345"))
+        task = server.parse_command(b"GET bench")
+        if task != "NONE":
+            await _response(server.parse_command(b"ACK bench " + bytes(task[0]).split()[0]))
+
+
+def measure_async(server, tasks, clients):
+    async def run():
+        start = time.perf_counter()
+        await asyncio.gather(*(_client(server, tasks // clients) for _ in range(clients)))
+        return tasks // clients * clients / (time.perf_counter() - start)
+
+    return asyncio.run(run())
+
+
+def main():
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_TASKS
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_CLIENTS
+    print(f"{'mode':>40} {'tasks/s':>10}")
+    with tempfile.TemporaryDirectory() as path:
+        server = TaskQueueServer("127.0.0.1", 5555, path + "/", 300)
+        print(f"{'in memory':>40} {measure(server, tasks):>10.0f}")
+    for flush_interval in FLUSH_INTERVALS:
+        with tempfile.TemporaryDirectory() as path:
+            server = TaskQueueServer("127.0.0.1", 5555, path + "/", 300, wal=True, flush_interval=flush_interval)
+            print(f"{f'sync, write-behind, fsync every {flush_interval}s':>40} {measure(server, tasks):>10.0f}")
+            server.wal.close()
+    for flush_interval in FLUSH_INTERVALS:
+        with tempfile.TemporaryDirectory() as path:
+            server = TaskQueueServer("127.0.0.1", 5555, path + "/", 300, mode="async", wal=True,
+                                     flush_interval=flush_interval)
+            label = f"async, {clients} clients, fsync every {flush_interval}s"
+            print(f"{label:>40} {measure_async(server, tasks, clients):>10.0f}")
+            server.wal.close()
+
+
+if __name__ == '__main__':
+    main()
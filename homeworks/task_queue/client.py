@@ -0,0 +1,500 @@
+"""Client library for the task queue server, blocking (Client) and asyncio (AsyncClient).
+
+Both keep a pool of persistent connections and pipeline commands: the blocking client through
+Client.pipeline(), the asyncio one by sending commands of concurrent coroutines over shared
+connections without waiting for earlier responses (a blocking GET takes a connection of its own,
+as responses behind it would wait for it). Persistent connections need the server in
+async mode; a sync mode server answers one command per connection, so every command reconnects.
+A new blocking connection sends its first command alone to find out which kind of server it talks to.
+
+Connection failures are retried with exponential backoff. A command that was sent when the
+connection broke is sent again, so an ADD may be executed twice: tasks are delivered at least once anyway.
+Commands that were answered are never sent again.
+A response that does not come in time raises TimeoutError and the command is not sent again: the server
+may still be executing it. Blocking GETs get their wait_ms on top of the timeout.
+"""
+import asyncio
+import queue
+import random
+import socket
+import threading
+import time
+from collections import deque, namedtuple
+
+
+Task = namedtuple("Task", ["id", "data"])
+
+READ_SIZE = 1 << 16
+
+# kinds of responses
+LINE = "line"
+IDS = "ids"
+BOOL = "bool"
+BOOLS = "bools"
+TASK = "task"
+TASKS = "tasks"
+STATS = "stats"
+
+
+class TaskQueueError(Exception):
+    """The server answered ERROR"""
+
+
+class ConnectionClosed(ConnectionError):
+    pass
+
+
+def _add_options(delay, priority):
+    options = b""
+    if delay:
+        options += b" delay=%d" % delay
+    if priority:
+        options += b" priority=%d" % priority
+    return options
+
+
+def _name(queue_name):
+    return queue_name.encode("utf-8") if isinstance(queue_name, str) else queue_name
+
+
+def _id(task_id):
+    return str(task_id).encode("ascii")
+
+
+def encode_add(queue_name, data, delay=0, priority=0):
+    return b"ADD %s%s %d %s\n" % (_name(queue_name), _add_options(delay, priority), len(data), data)
+
+
+def encode_add_many(queue_name, items, delay=0, priority=0):
+    parts = [b"MADD %s%s %d" % (_name(queue_name), _add_options(delay, priority), len(items))]
+    for data in items:
+        parts.append(b"%d %s" % (len(data), data))
+    return b" ".join(parts) + b"\n"
+
+
+def encode_get(queue_name, wait_ms=0):
+    if wait_ms:
+        return b"GET %s %d\n" % (_name(queue_name), wait_ms)
+    return b"GET %s\n" % _name(queue_name)
+
+
+def encode_get_many(queue_name, count):
+    return b"MGET %s %d\n" % (_name(queue_name), count)
+
+
+def encode_ack(queue_name, task_id):
+    return b"ACK %s %s\n" % (_name(queue_name), _id(task_id))
+
+
+def encode_ack_many(queue_name, task_ids):
+    return b"MACK %s %s\n" % (_name(queue_name), b" ".join(map(_id, task_ids)))
+
+
+def encode_has(queue_name, task_id):
+    return b"IN %s %s\n" % (_name(queue_name), _id(task_id))
+
+
+def encode_stats(queue_name=None):
+    return b"STATS %s\n" % _name(queue_name) if queue_name is not None else b"STATS\n"
+
+
+class ResponseParser:
+    """Splits the stream of responses, the kind of every response is given in advance with expect()"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.kinds = deque()
+
+    def expect(self, kind):
+        self.kinds.append(kind)
+
+    def feed(self, data):
+        """Returns responses completed by data, a TaskQueueError instance stands for ERROR"""
+        self.buffer += data
+        responses = []
+        position = 0
+        while self.kinds:
+            if self.kinds[0] in (TASK, TASKS):
+                parsed = self._parse_tasks(position, many=self.kinds[0] == TASKS)
+            else:
+                parsed = self._parse_line(position, self.kinds[0])
+            if parsed is None:
+                break
+            response, position = parsed
+            responses.append(response)
+            self.kinds.popleft()
+        del self.buffer[:position]
+        return responses
+
+    def _parse_line(self, position, kind):
+        end = self.buffer.find(b"\n", position)
+        if end < 0:
+            return None
+        line = bytes(self.buffer[position:end]).decode("utf-8")
+        if line == "ERROR":
+            return TaskQueueError(line), end + 1
+        if kind == IDS:
+            response = line.split()
+        elif kind == BOOL:
+            response = line == "YES"
+        elif kind == BOOLS:
+            response = [answer == "YES" for answer in line.split()]
+        elif kind == STATS:
+            response = {} if line == "NONE" else dict(field.split("=") for field in line.split())
+        else:
+            response = line
+        return response, end + 1
+
+    def _parse_tasks(self, position, many):
+        for word in (b"NONE\n", b"ERROR\n"):
+            if self.buffer.startswith(word, position):
+                response = TaskQueueError("ERROR") if word == b"ERROR\n" else ([] if many else None)
+                return response, position + len(word)
+            if word.startswith(bytes(self.buffer[position:position + len(word)])):
+                # may still become NONE or ERROR
+                return None
+        tasks = []
+        while True:
+            id_end = self.buffer.find(b" ", position)
+            length_end = self.buffer.find(b" ", id_end + 1) if id_end >= 0 else -1
+            if length_end < 0:
+                return None
+            length = int(self.buffer[id_end + 1:length_end])
+            end = length_end + 1 + length
+            if end >= len(self.buffer):
+                return None
+            tasks.append(Task(bytes(self.buffer[position:id_end]).decode("ascii"),
+                              bytes(self.buffer[length_end + 1:end])))
+            position = end + 1
+            if self.buffer[end] == ord("\n"):
+                return (tasks if many else tasks[0]), position
+
+
+class Backoff:
+    """Exponential backoff with jitter between reconnection attempts"""
+
+    def __init__(self, retries=5, initial=0.05, maximum=2.0):
+        self.retries = retries
+        self.initial = initial
+        self.maximum = maximum
+
+    def delays(self):
+        delay = self.initial
+        for _ in range(self.retries):
+            yield delay * random.uniform(0.5, 1)
+            delay = min(delay * 2, self.maximum)
+
+
+class Connection:
+    """One blocking connection, commands are answered in order"""
+
+    def __init__(self, host, port, timeout):
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.parser = ResponseParser()
+        self.closed = False
+        # whether the server keeps the connection after a response, None until the first one
+        self.persistent = None
+
+    def execute(self, commands, timeout, responses):
+        """Sends (command, kind) pairs and appends their responses, waiting for them up to timeout seconds.
+
+        Responses are appended as they come, so the answered commands are known when this raises.
+        A new connection sends the first command alone: a sync mode server answers it and closes
+        the connection, the rest must not be sent to it. When the server closes the connection
+        after some responses, the rest are not answered; ConnectionClosed is raised if none are.
+        """
+        self.socket.settimeout(timeout)
+        if self.persistent is None and len(commands) > 1:
+            self._execute(commands[:1], responses)
+            if self.closed:
+                return
+            commands = commands[1:]
+        self._execute(commands, responses)
+
+    def _execute(self, commands, responses):
+        for _, kind in commands:
+            self.parser.expect(kind)
+        self.socket.sendall(b"".join(command for command, _ in commands))
+        expected = len(responses) + len(commands)
+        answered = len(responses)
+        while len(responses) < expected:
+            data = self.socket.recv(READ_SIZE)
+            if not data:
+                self.close()
+                # a sync mode server answers one command without a newline and closes the connection
+                responses += self.parser.feed(b"\n")
+                if len(responses) == answered:
+                    raise ConnectionClosed("connection closed by the server")
+                break
+            responses += self.parser.feed(data)
+        if self.persistent is None:
+            self.persistent = not self.closed
+
+    def close(self):
+        self.closed = True
+        self.socket.close()
+
+
+def _raise_errors(responses):
+    for response in responses:
+        if isinstance(response, TaskQueueError):
+            raise response
+    return responses
+
+
+class Commands:
+    """Command methods shared by the clients and pipelines, _run((command, kind), wait_ms) executes one.
+
+    wait_ms is how long the server may hold the response back, as blocking GET does.
+    """
+
+    def add(self, queue_name, data, delay=0, priority=0):
+        """Returns the id of the new task"""
+        return self._run((encode_add(queue_name, data, delay, priority), LINE))
+
+    def add_many(self, queue_name, items, delay=0, priority=0):
+        return self._run((encode_add_many(queue_name, items, delay, priority), IDS))
+
+    def get(self, queue_name, wait_ms=0):
+        """Returns a Task or None"""
+        return self._run((encode_get(queue_name, wait_ms), TASK), wait_ms)
+
+    def get_many(self, queue_name, count):
+        return self._run((encode_get_many(queue_name, count), TASKS))
+
+    def ack(self, queue_name, task_id):
+        return self._run((encode_ack(queue_name, task_id), BOOL))
+
+    def ack_many(self, queue_name, task_ids):
+        return self._run((encode_ack_many(queue_name, task_ids), BOOLS))
+
+    def has(self, queue_name, task_id):
+        return self._run((encode_has(queue_name, task_id), BOOL))
+
+    def stats(self, queue_name=None):
+        return self._run((encode_stats(queue_name), STATS))
+
+    def save(self):
+        return self._run((b"SAVE\n", LINE))
+
+
+class Client(Commands):
+    def __init__(self, host="127.0.0.1", port=5555, pool_size=4, timeout=10, backoff=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.backoff = backoff or Backoff()
+        self._pool = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _connect(self):
+        delays = self.backoff.delays()
+        while True:
+            try:
+                return Connection(self.host, self.port, self.timeout)
+            except OSError:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    def execute(self, commands, wait_ms=0):
+        """Sends (command, kind) pairs over pooled connections and returns the responses.
+
+        Commands that were answered are never sent again, the rest go over a new connection
+        when the server closes one (a sync mode server answers one command per connection).
+        """
+        delays = self.backoff.delays()
+        responses = []
+        with self._slots:
+            while True:
+                try:
+                    connection = self._pool.get_nowait()
+                except queue.Empty:
+                    connection = self._connect()
+                try:
+                    connection.execute(commands[len(responses):], self.timeout + wait_ms / 1000, responses)
+                except socket.timeout:
+                    # the commands may still be executed, sending them again could run them twice
+                    connection.close()
+                    raise
+                except OSError:
+                    connection.close()
+                    delay = next(delays, None)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    continue
+                if not connection.closed:
+                    self._pool.put(connection)
+                if len(responses) == len(commands):
+                    return responses
+
+    def _run(self, command, wait_ms=0):
+        return _raise_errors(self.execute([command], wait_ms))[0]
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class Pipeline(Commands):
+    """Collects commands and sends them at once: with client.pipeline() as p: p.add(...); responses = p.execute()"""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        # the server answers pipelined commands one after another, so their waits add up
+        self.wait_ms = 0
+
+    def _run(self, command, wait_ms=0):
+        self.commands.append(command)
+        self.wait_ms += wait_ms
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        wait_ms, self.wait_ms = self.wait_ms, 0
+        return _raise_errors(self.client.execute(commands, wait_ms)) if commands else []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.commands = []
+        self.wait_ms = 0
+
+
+class AsyncConnection:
+    """Asyncio connection shared by concurrent requests, responses are matched to requests in order"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.parser = ResponseParser()
+        self.pending = deque()
+        self.closed = False
+        self._reading = asyncio.ensure_future(self._read_responses())
+
+    @classmethod
+    async def open(cls, host, port):
+        # asyncio turns Nagle's algorithm off itself
+        return cls(*await asyncio.open_connection(host, port))
+
+    def request(self, command, kind):
+        if self.closed:
+            raise ConnectionClosed("connection closed by the server")
+        response = asyncio.get_running_loop().create_future()
+        self.parser.expect(kind)
+        self.pending.append(response)
+        self.writer.write(command)
+        return response
+
+    async def _read_responses(self):
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    # a sync mode server closes the connection after the first response
+                    data = b"\n"
+                    self.closed = True
+                for response in self.parser.feed(data):
+                    future = self.pending.popleft()
+                    # a request that timed out is cancelled, its late response is dropped
+                    if not future.done():
+                        future.set_result(response)
+                if self.closed:
+                    break
+        except OSError:
+            self.closed = True
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionClosed("connection closed by the server"))
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+        self._reading.cancel()
+
+
+class AsyncClient(Commands):
+    """Requests of concurrent coroutines are pipelined over pool_size shared connections.
+
+    The command methods are coroutines: await client.add("queue", b"data").
+    """
+
+    def __init__(self, host="127.0.0.1", port=5555, pool_size=4, timeout=10, backoff=None):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.backoff = backoff or Backoff()
+        self._connections = []
+        self._next = 0
+        self._connecting = None
+
+    async def _connect(self):
+        delays = self.backoff.delays()
+        while True:
+            try:
+                return await AsyncConnection.open(self.host, self.port)
+            except OSError:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    async def _connection(self):
+        self._connections = [connection for connection in self._connections if not connection.closed]
+        if len(self._connections) < self.pool_size:
+            # concurrent requests wait for the same new connection instead of opening one each
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(self._connect())
+            try:
+                connection = await asyncio.shield(self._connecting)
+            finally:
+                self._connecting = None
+            if connection not in self._connections:
+                self._connections.append(connection)
+            return connection
+        self._next = (self._next + 1) % len(self._connections)
+        return self._connections[self._next]
+
+    async def execute(self, commands):
+        """Sends (command, kind) pairs and returns the responses"""
+        return await asyncio.gather(*(self._request(command, kind) for command, kind in commands))
+
+    async def _request(self, command, kind, wait_ms=0):
+        delays = self.backoff.delays()
+        while True:
+            # a blocking GET would hold up the responses behind it on a shared connection, it gets one of its own
+            connection = await self._connect() if wait_ms else await self._connection()
+            try:
+                # TimeoutError is not a ConnectionError: a command that timed out is not sent again
+                return await asyncio.wait_for(connection.request(command, kind), self.timeout + wait_ms / 1000)
+            except ConnectionError:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            finally:
+                if wait_ms:
+                    connection.close()
+
+    async def _run(self, command, wait_ms=0):
+        response = await self._request(*command, wait_ms)
+        if isinstance(response, TaskQueueError):
+            raise response
+        return response
+
+    async def close(self):
+        for connection in self._connections:
+            connection.close()
+        self._connections = []
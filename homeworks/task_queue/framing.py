@@ -0,0 +1,229 @@
+import re
+import socket
+from collections import deque
+from itertools import islice
+
+
+READ_SIZE = 1 << 16
+MAX_PAYLOAD_LENGTH = 10 ** 6
+# the end of a payload goes through the read buffer, so the command terminator is seen together with it
+PAYLOAD_TAIL = 1 << 12
+# limit of buffers in one sendmsg call
+IOV_MAX = 1024
+# responses smaller than this are joined into one buffer, bigger ones are sent without copying
+JOIN_LIMIT = 1 << 16
+
+# the queue name may be followed by options like delay=100
+RE_ADD_HEADER = re.compile(rb"(ADD \S+(?: \w+=-?\d+)* (\d+)) ")
+RE_MADD_HEADER = re.compile(rb"(MADD \S+(?: \w+=-?\d+)* (\d+)) ")
+RE_ITEM_HEADER = re.compile(rb"(\d+) ")
+
+# frame of a command that could not be framed, the connection can not be read further
+ERROR_FRAME = (None, None)
+
+
+class CommandReader:
+    """Splits a stream of bytes into (command, payloads) frames.
+
+    Commands end with a newline. ADD and MADD payloads are cut by their declared length,
+    so they may contain anything. Big payloads are received straight into a preallocated
+    bytearray: feed the reader with recv_into(get_buffer()) and buffer_updated(nbytes).
+
+    The first command decides the kind of connection: old clients send a single command
+    without a newline (persistent is False), new ones terminate every command (persistent is True).
+    """
+
+    def __init__(self):
+        # allocated on first use, split() does not need it
+        self.read_buffer = None
+        self.pending = bytearray()
+        self.position = 0
+        self.persistent = None
+        self.broken = False
+        self._reset()
+
+    def _reset(self):
+        self.command = None
+        self.payloads = []
+        self.items_left = 0
+        self.need_separator = False
+        self.payload = None
+        self.filled = 0
+
+    @classmethod
+    def split(cls, data):
+        """Returns frames of all complete commands in data"""
+        reader = cls()
+        reader.pending += data
+        return reader._parse()
+
+    def _receives_payload(self):
+        return self.payload is not None and len(self.payload) - self.filled > PAYLOAD_TAIL
+
+    def get_buffer(self):
+        if self._receives_payload():
+            return memoryview(self.payload)[self.filled:len(self.payload) - PAYLOAD_TAIL]
+        if self.read_buffer is None:
+            self.read_buffer = bytearray(READ_SIZE)
+        return memoryview(self.read_buffer)
+
+    def buffer_updated(self, nbytes):
+        """Takes nbytes written to the last get_buffer() and returns frames completed by them"""
+        if self._receives_payload():
+            self.filled += nbytes
+        else:
+            self.pending += memoryview(self.read_buffer)[:nbytes]
+        return self._parse()
+
+    def _parse(self):
+        frames = []
+        while not self.broken and not (self.persistent is False and frames):
+            if self.payload is not None:
+                done = self._fill_payload()
+            elif self.need_separator:
+                done = self._skip_separator(frames)
+            elif self.items_left:
+                done = self._start_item(frames)
+            elif self.command is not None:
+                done = self._finish_command(frames)
+            else:
+                done = self._start_command(frames)
+            if not done:
+                break
+        del self.pending[:self.position]
+        self.position = 0
+        return frames
+
+    def _available(self):
+        return len(self.pending) - self.position
+
+    def _fail(self, frames):
+        frames.append(ERROR_FRAME)
+        self.broken = True
+        return False
+
+    def _start_command(self, frames):
+        # only commands with payloads need the header regex, the rest are cut at the newline
+        if self.pending.startswith((b"ADD ", b"MADD "), self.position):
+            has_items = self.pending[self.position] == ord("M")
+            match = (RE_MADD_HEADER if has_items else RE_ADD_HEADER).match(self.pending, self.position)
+            if match is not None:
+                self.command = bytes(match.group(1))
+                self.position = match.end()
+                if has_items:
+                    self.items_left = int(match.group(2))
+                    return True
+                return self._start_payload(int(match.group(2)), frames)
+        end = self.pending.find(b"\n", self.position)
+        if end >= 0:
+            if self.persistent is None:
+                self.persistent = True
+            frames.append((bytes(self.pending[self.position:end]).strip(), []))
+            self.position = end + 1
+            return True
+        if self.persistent is None and self._available():
+            # old client: everything received is one command
+            self.persistent = False
+            frames.append((bytes(self.pending[self.position:]).strip(), []))
+            self.position = len(self.pending)
+            return True
+        return False
+
+    def _start_item(self, frames):
+        match = RE_ITEM_HEADER.match(self.pending, self.position)
+        if match is None:
+            rest = self.pending[self.position:]
+            if len(rest) < 8 and (not rest or rest.isdigit()):
+                return False
+            return self._fail(frames)
+        self.position = match.end()
+        self.items_left -= 1
+        return self._start_payload(int(match.group(1)), frames)
+
+    def _skip_separator(self, frames):
+        if not self._available():
+            return False
+        if self.pending[self.position] != ord(" "):
+            return self._fail(frames)
+        self.position += 1
+        self.need_separator = False
+        return True
+
+    def _start_payload(self, length, frames):
+        if length > MAX_PAYLOAD_LENGTH:
+            return self._fail(frames)
+        if self._available() >= length:
+            self._payload_done(bytes(memoryview(self.pending)[self.position:self.position + length]))
+            self.position += length
+        else:
+            self.payload = bytearray(length)
+            self.filled = 0
+        return True
+
+    def _fill_payload(self):
+        size = min(self._available(), len(self.payload) - self.filled)
+        self.payload[self.filled:self.filled + size] = memoryview(self.pending)[self.position:self.position + size]
+        self.position += size
+        self.filled += size
+        if self.filled < len(self.payload):
+            return False
+        self._payload_done(self.payload)
+        self.payload = None
+        return True
+
+    def _payload_done(self, payload):
+        self.payloads.append(payload)
+        self.need_separator = self.items_left > 0
+
+    def _finish_command(self, frames):
+        if self._available():
+            if self.pending[self.position] != ord("\n"):
+                return self._fail(frames)
+            self.position += 1
+            if self.persistent is None:
+                self.persistent = True
+        elif self.persistent is None:
+            # old client: the command ends with the payload
+            self.persistent = False
+        else:
+            return False
+        frames.append((self.command, self.payloads))
+        self._reset()
+        return True
+
+
+def request_buffers(command, payloads=(), terminator=b"\n"):
+    """Returns the wire form of a framed command, the reverse of CommandReader"""
+    buffers = [command]
+    if command.startswith(b"ADD "):
+        buffers += [b" ", payloads[0]]
+    elif command.startswith(b"MADD "):
+        for payload in payloads:
+            buffers += [b" %d " % len(payload), payload]
+    buffers.append(terminator)
+    return buffers
+
+
+def response_buffers(response, terminator=b""):
+    """Returns the response as a list of bytes-like buffers"""
+    if isinstance(response, str):
+        return [response.encode("utf-8") + terminator]
+    if sum(len(buffer) for buffer in response) < JOIN_LIMIT:
+        return [b"".join(response) + terminator]
+    return response + [terminator] if terminator else response
+
+
+def send_buffers(sock, buffers):
+    """Sends buffers with scatter/gather writes, without joining them"""
+    if not hasattr(socket.socket, "sendmsg"):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+    views = deque(memoryview(buffer).cast("B") for buffer in buffers)
+    while views:
+        sent = sock.sendmsg(list(islice(views, IOV_MAX)))
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.popleft()
+        if sent:
+            views[0] = views[0][sent:]
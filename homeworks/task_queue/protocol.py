@@ -0,0 +1,154 @@
+"""Tokenizer of command lines.
+
+The command is split on spaces once, the verb selects the argument grammar from a table and every
+token is checked with bytes methods, so each byte is looked at a constant number of times
+in C code, without regular expressions:
+
+    tokenize(b"ADD queue delay=100 5") == (b"ADD", ["queue", [("delay", 100)], 5])
+
+Queue names are decoded to str, task ids stay bytes. Malformed commands raise ProtocolError
+with the offset of the offending byte.
+"""
+
+
+# queue names and task ids are \w: ASCII letters, digits, "_" and any byte of a multibyte UTF-8 character
+WORD_BYTES = bytes(byte for byte in range(256) if byte >= 128 or chr(byte).isalnum() or byte == ord("_"))
+MAX_ID_LENGTH = 128
+# snapshots and the log store the length of a queue name in 16 bits
+MAX_NAME_LENGTH = 2 ** 16 - 1
+
+
+class ProtocolError(ValueError):
+    def __init__(self, message, position):
+        super().__init__(f"{message} at {position}")
+        self.position = position
+
+
+def _offset(tokens, index):
+    """Offset of tokens[index] in the command, only needed for errors"""
+    return sum(len(token) + 1 for token in tokens[:index])
+
+
+def _error(message, tokens, index, shift=0):
+    return ProtocolError(message, _offset(tokens, index) + shift)
+
+
+def _word(tokens, index, what):
+    token = tokens[index]
+    # isalnum is the common case and much cheaper than translate
+    if token.isalnum() or token and not token.translate(None, WORD_BYTES):
+        return token
+    if not token:
+        raise _error(f"empty {what}", tokens, index)
+    bad = next(offset for offset, byte in enumerate(token) if byte not in WORD_BYTES)
+    raise _error(f"bad {what}", tokens, index, bad)
+
+
+def _name(tokens, index):
+    if len(tokens[index]) > MAX_NAME_LENGTH:
+        raise _error("queue name is too long", tokens, index, MAX_NAME_LENGTH)
+    try:
+        return _word(tokens, index, "queue name").decode("utf-8")
+    except UnicodeDecodeError as error:
+        raise _error("bad queue name", tokens, index, error.start)
+
+
+def _id(tokens, index):
+    if len(tokens[index]) > MAX_ID_LENGTH:
+        raise _error("task id is too long", tokens, index, MAX_ID_LENGTH)
+    return _word(tokens, index, "task id")
+
+
+def _number(tokens, index):
+    if not tokens[index].isdigit():
+        raise _error("bad number", tokens, index)
+    return int(tokens[index])
+
+
+def _option(tokens, index):
+    name, separator, value = tokens[index].partition(b"=")
+    if not separator:
+        raise _error("bad option", tokens, index, len(name))
+    digits = value[1:] if value.startswith(b"-") else value
+    if not digits.isdigit():
+        raise _error("bad option value", tokens, index, len(name) + 1)
+    if not name.isalnum() and (not name or name.translate(None, WORD_BYTES)):
+        raise _error("bad option", tokens, index)
+    return name.decode("ascii"), int(value)
+
+
+def _count_error(tokens, low, high):
+    """Error of a command without low to high arguments, the parsers check the count inline as it is cheaper"""
+    if len(tokens) - 1 < low:
+        return _error("missing argument", tokens, len(tokens), -1)
+    return _error("unexpected argument", tokens, high + 1)
+
+
+def _name_options_number(tokens):
+    last = len(tokens) - 1
+    if last < 2:
+        raise _count_error(tokens, 2, last)
+    options = [_option(tokens, index) for index in range(2, last)] if last > 2 else []
+    return [_name(tokens, 1), options, _number(tokens, last)]
+
+
+def _name_optional_number(tokens):
+    if len(tokens) == 2:
+        return [_name(tokens, 1), None]
+    if len(tokens) != 3:
+        raise _count_error(tokens, 1, 2)
+    return [_name(tokens, 1), _number(tokens, 2)]
+
+
+def _name_id(tokens):
+    if len(tokens) != 3:
+        raise _count_error(tokens, 2, 2)
+    return [_name(tokens, 1), _id(tokens, 2)]
+
+
+def _name_number(tokens):
+    if len(tokens) != 3:
+        raise _count_error(tokens, 2, 2)
+    return [_name(tokens, 1), _number(tokens, 2)]
+
+
+def _name_ids(tokens):
+    if len(tokens) < 3:
+        raise _count_error(tokens, 2, len(tokens))
+    return [_name(tokens, 1), [_id(tokens, index) for index in range(2, len(tokens))]]
+
+
+def _optional_name(tokens):
+    if len(tokens) > 2:
+        raise _count_error(tokens, 0, 1)
+    return [_name(tokens, 1) if len(tokens) == 2 else None]
+
+
+def _nothing(tokens):
+    if len(tokens) != 1:
+        raise _count_error(tokens, 0, 0)
+    return []
+
+
+# verb -> parser of the split command returning the arguments
+COMMANDS = {
+    b"ADD": _name_options_number,
+    b"GET": _name_optional_number,
+    b"ACK": _name_id,
+    b"IN": _name_id,
+    b"MADD": _name_options_number,
+    b"MGET": _name_number,
+    b"MACK": _name_ids,
+    b"STATS": _optional_name,
+    b"SAVE": _nothing,
+    b"PROMOTE": _nothing,
+}
+
+
+def tokenize(command):
+    """Returns (verb, arguments) of a command without payloads"""
+    tokens = bytes(command).split(b" ")
+    parser = COMMANDS.get(tokens[0])
+    if parser is None:
+        raise ProtocolError("unknown command", 0)
+    return tokens[0], parser(tokens)
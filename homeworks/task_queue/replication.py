@@ -0,0 +1,169 @@
+"""Primary/follower replication.
+
+A follower connects to the primary's port like a client and sends SYNC. The primary answers with
+a snapshot of its queues and then streams every mutation (ADD, GET lease, ACK) as write-ahead log
+records. Records of one event loop iteration are sent as one batch frame, an empty batch is sent
+every HEARTBEAT seconds. Frames are
+
+    kind:uint8 length:uint32 position:uint64 sent_at:float64 body
+
+where position counts the records the primary has produced and sent_at is its unix time.
+The follower answers every applied frame with "<position>\\n", so the primary knows how far behind
+each follower is. A follower reconnects and resyncs from a new snapshot when the link breaks.
+"""
+import asyncio
+import io
+import struct
+import time
+
+from snapshot import SnapshotWriter
+from wal import append_record, decode_records
+
+
+SNAPSHOT = 1
+BATCH = 2
+
+FRAME_HEADER = struct.Struct("!BIQd")
+
+# seconds between empty batches, so the lag of an idle follower stays fresh
+HEARTBEAT = 1.0
+RECONNECT_DELAY = 1.0
+
+
+class FollowerLink:
+    """Primary side of a follower connection"""
+    __slots__ = ("transport", "acknowledged")
+
+    def __init__(self, transport, position):
+        self.transport = transport
+        self.acknowledged = position
+
+    def acknowledge(self, command):
+        try:
+            self.acknowledged = int(command)
+        except (TypeError, ValueError):
+            self.transport.close()
+
+
+def _frame(kind, position, body):
+    return FRAME_HEADER.pack(kind, len(body), position, time.time()) + body
+
+
+class ReplicationSource:
+    """Primary side: numbers mutations and streams them in batches to connected followers"""
+
+    def __init__(self, queue_server):
+        self.queue_server = queue_server
+        self.position = 0
+        self.followers = []
+        self._batch = bytearray()
+        self._flush_scheduled = False
+
+    def append(self, op, queue_name, task_id, payload=b""):
+        self.position += 1
+        append_record(self._batch, op, queue_name, task_id, payload)
+        if not self._flush_scheduled:
+            # commands parsed from the same read end up in one frame
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self, heartbeat=False):
+        self._flush_scheduled = False
+        if not self._batch and not heartbeat:
+            return
+        frame = _frame(BATCH, self.position, self._batch)
+        self._batch = bytearray()
+        self.followers = [link for link in self.followers if not link.transport.is_closing()]
+        for link in self.followers:
+            link.transport.write(frame)
+
+    def add_follower(self, transport):
+        # records already applied to the queues must not reach the new follower after the snapshot
+        self.flush()
+        f = io.BytesIO()
+        writer = SnapshotWriter(f)
+        for queue in self.queue_server.queues.values():
+            queue.dump(writer)
+        writer.close()
+        transport.write(_frame(SNAPSHOT, self.position, f.getvalue()))
+        link = FollowerLink(transport, self.position)
+        self.followers.append(link)
+        return link
+
+    def remove_follower(self, link):
+        if link in self.followers:
+            self.followers.remove(link)
+
+    def counters(self):
+        return {
+            "followers": len(self.followers),
+            "replication_position": self.position,
+            "replication_lag": max((self.position - link.acknowledged for link in self.followers), default=0),
+        }
+
+    async def send_heartbeats(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT)
+            if self.followers:
+                self.flush(heartbeat=True)
+
+
+class Follower:
+    """Follower side: applies the primary's stream to the queue server until promoted"""
+
+    def __init__(self, queue_server, host, port):
+        self.queue_server = queue_server
+        self.host = host
+        self.port = port
+        self.position = 0
+        self.connected = False
+        # seconds between the primary sending the last frame and the follower applying it
+        self.lag = 0.0
+        self.promoted = False
+        self._writer = None
+
+    async def run(self):
+        """Returns once promoted"""
+        while not self.promoted:
+            try:
+                reader, self._writer = await asyncio.open_connection(self.host, self.port)
+                if self.promoted:
+                    break
+                self._writer.write(b"SYNC\n")
+                while True:
+                    kind, length, position, sent_at = FRAME_HEADER.unpack(
+                        await reader.readexactly(FRAME_HEADER.size))
+                    body = await reader.readexactly(length)
+                    self.apply(kind, body)
+                    self.position = position
+                    self.lag = max(time.time() - sent_at, 0.0)
+                    self.connected = True
+                    self._writer.write(b"%d\n" % position)
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                self.connected = False
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+            if not self.promoted:
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    def apply(self, kind, body):
+        if kind == SNAPSHOT:
+            self.queue_server.load_replica(body)
+        else:
+            for op, queue_name, task_id, payload, _ in decode_records(body):
+                self.queue_server.apply_log_record(op, queue_name, task_id, payload)
+
+    def promote(self):
+        self.promoted = True
+        if self._writer is not None:
+            self._writer.close()
+
+    def counters(self):
+        return {
+            "replication_position": self.position,
+            "replication_connected": int(self.connected),
+            "replication_lag_ms": round(self.lag * 1000, 3),
+        }
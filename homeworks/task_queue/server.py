@@ -1,30 +1,56 @@
 import argparse
+import asyncio
 import socketserver
-import re
-from parse import parse
 import datetime
+import io
 import pickle
+import heapq
+import os
+import socket
+import time
+import traceback
+from collections import deque
+from functools import partial
+from operator import attrgetter
+
+import async_server
+import sharding
+from replication import ReplicationSource, Follower
+from wal import WriteAheadLog, WAL_FILENAME, OP_ADD, OP_ACK, OP_ADD_SCHEDULED, OP_LEASE, SCHEDULE_FORMAT, LEASE_FORMAT
+from framing import CommandReader, ERROR_FRAME, response_buffers, send_buffers
+from protocol import tokenize, ProtocolError
+from spill import PayloadStore, payload_view
+from timing_wheel import TimingWheel
+from stats import CommandStats, format_stats, format_prometheus
+from snapshot import SnapshotWriter, read_snapshot, is_snapshot, QUEUE, TASK, QUEUE_END
 
 
 DUMP_FILENAME = "dump.txt"
+SPILL_DIRNAME = "spill"
+METRICS_FILENAME = "metrics.prom"
+# seconds between rewrites of the metrics file
+METRICS_INTERVAL = 10
+# seconds the sync server waits for the rest of a command, it serves nobody else meanwhile
+READ_TIMEOUT = 2
+# seconds per tick of the lease timing wheel
+LEASE_TICK = 0.01
+# last_time_taken of a task that was never given out and available_at of one that is not delayed
+NEVER = float("-inf")
 
 
-RE_ADD = "^ADD \w+ \d+ .+$"
-PATTERN_ADD = "ADD {} {} {}"
+ADD_OPTIONS = ("delay", "priority")
+MIN_PRIORITY = -2 ** 15
+MAX_PRIORITY = 2 ** 15 - 1
+# longest delay and GET wait in milliseconds, about 24 days
+MAX_WAIT_MS = 2 ** 31
 
-RE_GET = "^GET \w+$"
-PATTERN_GET = "GET {}"
-
-RE_ACK = "^ACK \w+ \w{1,128}$"
-PATTERN_ACK = "ACK {} {}"
-
-RE_IN = "^IN \w+ \w{1,128}$"
-PATTERN_IN = "IN {} {}"
-
-RE_SAVE = "^SAVE$"
+# commands a follower refuses, its queues change only by replication
+WRITE_COMMANDS = frozenset((b"ADD", b"GET", b"ACK", b"MADD", b"MGET", b"MACK"))
 
 
 class LinkedListNode:
+    __slots__ = ("data", "prev", "next")
+
     def __init__(self, data):
         self.data = data
         self.prev = None
@@ -32,22 +58,95 @@ class LinkedListNode:
 
 
 class Task(LinkedListNode):
+    # times are time.monotonic() seconds, NEVER if the task was not taken or is not delayed
+    __slots__ = ("task_id", "last_time_taken", "done", "priority", "available_at", "timer")
+
     def __init__(self, task_data, task_id):
         super().__init__(task_data)
         self.task_id = task_id
-        self.last_time_taken = datetime.datetime.min
+        self.last_time_taken = NEVER
+        self.done = False
+        self.priority = 0
+        # when a delayed task becomes ready
+        self.available_at = NEVER
+        # position in the timing wheel while the task is given out or delayed
+        self.timer = None
+
+    def __setstate__(self, state):
+        # tasks pickled before __slots__ come with a dict, _load_pickle converts their times
+        for name, value in (state[1] if isinstance(state, tuple) else state).items():
+            setattr(self, name, value)
+
+    def to_buffers(self):
+        """Returns the task as "<id> <length> <data>" without copying data"""
+        return [b"%d %d " % (self.task_id, len(self.data)), payload_view(self.data)]
+
+
+def _to_timestamp(moment):
+    """Monotonic time to a unix timestamp for snapshots and the log, 0 for NEVER"""
+    return 0.0 if moment == NEVER else moment + (time.time() - time.monotonic())
+
+
+def _from_timestamp(timestamp):
+    return NEVER if timestamp == 0 else timestamp - (time.time() - time.monotonic())
 
-    def __str__(self):
-        return f"{self.task_id} {len(self.data)} {self.data}"
+
+def _to_tick(moment):
+    return int(moment / LEASE_TICK)
+
+
+def _to_deadline_tick(moment):
+    # rounded up, a lease never expires early
+    return -int(-moment // LEASE_TICK)
+
+
+def parse_add_options(options):
+    """Checks [("delay", 100), ("priority", 2)] and returns (delay in ms, priority), None if they are invalid"""
+    values = {}
+    for name, value in options:
+        if name not in ADD_OPTIONS or name in values:
+            return None
+        values[name] = value
+    delay, priority = values.get("delay", 0), values.get("priority", 0)
+    if not 0 <= delay <= MAX_WAIT_MS or not MIN_PRIORITY <= priority <= MAX_PRIORITY:
+        return None
+    return delay, priority
+
+
+def split_batch(text, count):
+    """Splits "<length> <data> <length> <data> ..." into count data items, returns None if malformed"""
+    items = []
+    position = 0
+    for index in range(count):
+        if index:
+            if text[position:position + 1] != " ":
+                return None
+            position += 1
+        space = text.find(" ", position)
+        if space < 0 or not text[position:space].isdigit():
+            return None
+        end = space + 1 + int(text[position:space])
+        if end > len(text):
+            return None
+        items.append(text[space + 1:end])
+        position = end
+    return items if position == len(text) else None
 
 
 class LinkedList:
     head_node: LinkedListNode
 
-    def __init__(self):
+    def __init__(self, key=None):
         self.head_node = None
         self.tail_node = None
         self.__next_iter_node = None
+        # optional key -> node index, kept in sync by add/delete
+        self._key = key
+        self._index = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
 
     def __iter__(self):
         self.__next_iter_node = self.head_node
@@ -69,6 +168,9 @@ class LinkedList:
             self.tail_node.next = node
             node.prev = self.tail_node
             self.tail_node = node
+        self._size += 1
+        if self._key is not None:
+            self._index[self._key(node)] = node
 
     def delete(self, node: LinkedListNode, check=False):
         if check:
@@ -82,119 +184,722 @@ class LinkedList:
             node.prev.next = node.next
         if node.next is not None:
             node.next.prev = node.prev
+        self._size -= 1
+        if self._key is not None:
+            del self._index[self._key(node)]
 
     def has(self, node):
+        if self._key is not None:
+            return self._index.get(self._key(node)) is node
         for list_node in self:
             if list_node is node:
                 return True
         return False
 
+    def find(self, key):
+        return self._index.get(key)
+
+
+class PriorityLevel:
+    """Ready tasks of one priority: never given out ones in a deque and returned ones in a heap, both by id"""
+    __slots__ = ("ready", "returned")
+
+    def __init__(self):
+        self.ready = deque()
+        # expired leases and delayed tasks that became due: heap of (task_id, task)
+        self.returned = []
+
+    def pop(self):
+        self.trim()
+        if self.returned and (not self.ready or self.returned[0][0] < self.ready[0].task_id):
+            return heapq.heappop(self.returned)[1]
+        return self.ready.popleft() if self.ready else None
+
+    def trim(self):
+        """Drops tasks that are not ready any more from the fronts.
+
+        Tasks removed by log replay or given out by the replication primary stay where they are
+        until they reach a front.
+        """
+        while self.ready and (self.ready[0].done or self.ready[0].timer is not None):
+            self.ready.popleft()
+        while self.returned and (self.returned[0][1].done or self.returned[0][1].timer is not None):
+            heapq.heappop(self.returned)
+
 
 class TaskQueue:
-    def __init__(self, name, timeout):
-        self.storage = LinkedList()
+    def __init__(self, name, timeout, payloads=None):
+        self.storage = LinkedList(key=attrgetter("task_id"))
         self._last_id = 0
         self._name = name
         self.last_task = None
+        # lease time in seconds
         self.timeout = timeout
+        # priority -> PriorityLevel
+        self._levels = {}
+        # heap of negated priorities of levels that may have ready tasks, _active holds the same priorities
+        self._priorities = []
+        self._active = set()
+        # given out tasks by lease deadline and delayed tasks by due time
+        self._timers = TimingWheel(_to_tick(time.monotonic()))
+        self._delayed = 0
+        # PayloadStore that keeps task data within the memory limit, None when memory is not limited
+        self._payloads = payloads
+        self.added = 0
+        self.acknowledged = 0
+        self.redelivered = 0
 
     def _generate_id(self):
         self._last_id = self._last_id + 1
         return self._last_id
 
-    def add(self, task_data):
-        task_id = self._generate_id()
-        self.storage.add(Task(task_data, task_id))
-        return str(task_id)
-
-    def get(self):
+    def _new_task(self, task_data, task_id, priority):
+        if self._payloads is not None:
+            task_data = self._payloads.store(task_data)
+        task = Task(task_data, task_id)
+        task.priority = priority
+        return task
+
+    def _level(self, priority):
+        level = self._levels.get(priority)
+        if level is None:
+            level = self._levels[priority] = PriorityLevel()
+        if priority not in self._active:
+            self._active.add(priority)
+            heapq.heappush(self._priorities, -priority)
+        return level
+
+    def _append(self, task):
+        self.storage.add(task)
+        self._level(task.priority).ready.append(task)
+
+    def _return(self, task):
+        heapq.heappush(self._level(task.priority).returned, (task.task_id, task))
+
+    def _delay(self, task, available_at):
+        task.available_at = available_at
+        self._delayed += 1
+        self._timers.schedule(task.task_id, task, _to_deadline_tick(available_at))
+
+    def _is_delayed(self, task):
+        return task.timer is not None and task.last_time_taken == NEVER
+
+    def _delete(self, task):
+        self.storage.delete(task)
+        if self._is_delayed(task):
+            self._delayed -= 1
+        self._timers.cancel(task.task_id, task)
+        task.done = True
+        if self._payloads is not None:
+            self._payloads.release(task.data)
+
+    def add(self, task_data, delay=0, priority=0):
+        """delay is in milliseconds, tasks of bigger priority are given out first"""
+        self.added += 1
+        task = self._new_task(task_data, self._generate_id(), priority)
+        if delay:
+            self.storage.add(task)
+            self._delay(task, time.monotonic() + delay / 1000)
+        else:
+            self._append(task)
+        return str(task.task_id)
+
+    def restore(self, task_id, task_data, last_time_taken=NEVER, priority=0, available_at=NEVER):
+        """Re-adds a task with a known id, ids that were already generated are skipped.
+
+        Times are time.monotonic() seconds.
+        """
+        if task_id <= self._last_id:
+            return
+        self._last_id = task_id
+        task = self._new_task(task_data, task_id, priority)
+        now = time.monotonic()
+        if last_time_taken == NEVER and available_at > now:
+            self.storage.add(task)
+            self._delay(task, available_at)
+        elif now - last_time_taken >= self.timeout:
+            # never taken tasks and expired leases are ready right away, in id order
+            self._append(task)
+        else:
+            self.storage.add(task)
+            self._lease(task, last_time_taken)
+
+    def lease(self, task_id, taken_at):
+        """Marks a task as given out at taken_at, for followers applying GET of the primary"""
+        task = self.storage.find(task_id)
+        if task is None:
+            return
+        if self._is_delayed(task):
+            self._delayed -= 1
+        self._timers.cancel(task.task_id, task)
+        self._lease(task, taken_at)
+        self._level(task.priority).trim()
+
+    def clear(self):
+        for task in list(self.storage):
+            self._delete(task)
+
+    def restore_last_id(self, last_id):
+        self._last_id = max(self._last_id, last_id)
+
+    def dump(self, writer):
+        writer.queue(self._name)
         for task in self.storage:
-            if datetime.datetime.now() - task.last_time_taken > self.timeout:
-                task.last_time_taken = datetime.datetime.now()
-                return str(task)
+            available_at = task.available_at if self._is_delayed(task) else NEVER
+            writer.task(task.task_id, _to_timestamp(task.last_time_taken), payload_view(task.data),
+                        task.priority, _to_timestamp(available_at))
+        writer.queue_end(self._last_id)
+
+    def remove(self, task_id):
+        task = self.storage.find(task_id)
+        if task is not None:
+            self._delete(task)
+
+    def _is_leased(self, task, now):
+        return now - task.last_time_taken < self.timeout
+
+    def _requeue_expired(self, now):
+        for task in self._timers.advance(_to_tick(now)):
+            if task.last_time_taken == NEVER:
+                self._delayed -= 1
+            else:
+                self.redelivered += 1
+            self._return(task)
+
+    def _pop_ready(self):
+        while self._priorities:
+            level = self._levels[-self._priorities[0]]
+            task = level.pop()
+            if task is not None:
+                return task
+            self._active.discard(-heapq.heappop(self._priorities))
         return None
 
+    def get(self):
+        now = time.monotonic()
+        self._requeue_expired(now)
+        task = self._pop_ready()
+        if task is None:
+            return None
+        self._lease(task, now)
+        return task
+
+    def counters(self):
+        self._requeue_expired(time.monotonic())
+        in_flight = len(self._timers) - self._delayed
+        return {
+            "tasks": len(self.storage),
+            "ready": len(self.storage) - in_flight - self._delayed,
+            "in_flight": in_flight,
+            "delayed": self._delayed,
+            "added_total": self.added,
+            "acknowledged_total": self.acknowledged,
+            "redelivered_total": self.redelivered,
+        }
+
+    def next_expiry(self):
+        """time.monotonic() when a given out task may be redelivered or a delayed one become due, None if there are none"""
+        tick = self._timers.next_tick()
+        return tick * LEASE_TICK if tick is not None else None
+
+    def _lease(self, task, now):
+        task.last_time_taken = now
+        self._timers.schedule(task.task_id, task, _to_deadline_tick(now + self.timeout))
+
+    def _find(self, task_id):
+        try:
+            return self.storage.find(int(task_id))
+        except ValueError:
+            return None
+
     def acknowledge(self, task_id):
-        for task in self.storage:
-            if task.task_id == int(task_id):
-                if datetime.datetime.now() - task.last_time_taken < self.timeout:
-                    self.storage.delete(task)
-                    return "YES"
-                else:
-                    return "NO"
+        task = self._find(task_id)
+        if task is not None and self._is_leased(task, time.monotonic()):
+            self._delete(task)
+            self.acknowledged += 1
+            return "YES"
         return "NO"
 
     def has(self, task_id):
-        for task in self.storage:
-            if task.task_id == int(task_id):
-                return "YES"
-        return "NO"
+        return "YES" if self._find(task_id) is not None else "NO"
 
 
 class MyTCPHandler(socketserver.BaseRequestHandler):
     def handle(self):
-        data = self.request.recv(1000000).strip()
-        response = server.parse_command(data)
-        if response is not None:
-            self.request.sendall(bytes(response, "utf-8"))
+        reader = CommandReader()
+        frames = []
+        received = 0
+        self.request.settimeout(READ_TIMEOUT)
+        try:
+            while not frames:
+                nbytes = self.request.recv_into(reader.get_buffer())
+                if not nbytes:
+                    if not received:
+                        return
+                    break
+                received += nbytes
+                frames = reader.buffer_updated(nbytes)
+        except socket.timeout:
+            pass
+        if not frames:
+            # a payload shorter than its declared length: the client stopped sending or closed its side
+            frames = [ERROR_FRAME]
+        command, payloads = frames[0]
+        if command is None:
+            response = "ERROR"
+        else:
+            response = self.server.queue_server.parse_command(command, payloads)
+        send_buffers(self.request, response_buffers(response))
+
+
+class MyTCPServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, queue_server):
+        super().__init__((queue_server.ip, queue_server.port), MyTCPHandler)
+        self.queue_server = queue_server
+
+    def service_actions(self):
+        self.queue_server.write_metrics_if_due()
 
 
 class TaskQueueServer:
-    def __init__(self, ip, port, path, timeout):
+    def __init__(self, ip, port, path, timeout, mode="sync", wal=False, flush_interval=0.01, memory_limit=0,
+                 stats=False, metrics=False, primary=None):
         self.ip = ip
         self.port = port
         self.path = path
-        self.timeout = datetime.timedelta(seconds=timeout)
+        self.mode = mode
+        self.timeout = timeout
+        self.wal = WriteAheadLog(path + WAL_FILENAME, flush_interval) if wal else None
+        # async mode answers logged commands once the periodic fsync covers them:
+        # (log position, future, response) in log order, the loop is known after the first such command
+        self._unsynced = deque()
+        self._loop = None
+        if self.wal is not None and mode == "async" and flush_interval > 0:
+            self.wal.on_sync = self._log_synced
+        self._save_lock = asyncio.Lock()
+        self.payloads = PayloadStore(path + SPILL_DIRNAME, memory_limit) if memory_limit else None
+        # consumers parked by blocking GET: queue name -> deque of futures, served first come first served
+        self._waiters = {}
+        # queue name -> timer waking the waiters when the earliest given out task expires
+        self._expiry_timers = {}
+        # command latency histograms, None when not enabled
+        self.command_stats = CommandStats(self._is_queue) if stats or metrics else None
+        self.metrics = metrics
+        self._metrics_written = time.monotonic()
+        # followers connect to async servers only, they need persistent connections
+        self.replication = ReplicationSource(self) if mode == "async" else None
+        # "host:port" of the primary when this server is its follower
+        self.follower = None
+        if primary is not None:
+            host, _, port = primary.rpartition(":")
+            self.follower = Follower(self, host, int(port))
+        self.load(path)
+        if self.wal is not None:
+            self.wal.open()
+
+    def _is_queue(self, name):
         try:
-            self.load(path)
-        except IOError:
-            self.queues = {}
+            return name.decode("utf-8") in self.queues
+        except UnicodeDecodeError:
+            return False
 
     def get_queue(self, name, create=True):
         if name not in self.queues:
             if create:
-                self.queues[name] = TaskQueue(name, self.timeout)
+                self.queues[name] = TaskQueue(name, self.timeout, self.payloads)
             else:
                 return None
         return self.queues[name]
 
-    def parse_command(self, text):
-        text = text.decode("utf-8").strip()
-        if re.match(RE_SAVE, text):
-            self.save(self.path)
-        elif re.match(RE_ADD, text):
-            queue_name, length, data = parse(PATTERN_ADD, text)
-            queue = self.get_queue(queue_name)
-            assert int(length) == len(data)
-            return queue.add(data)
-        elif re.match(RE_GET, text):
-            queue_name = parse(PATTERN_GET, text)[0]
-            queue = self.get_queue(queue_name, create=False)
-            return queue.get()
-        elif re.match(RE_ACK, text):
-            queue_name, task_id = parse(PATTERN_ACK, text)
-            queue = self.get_queue(queue_name, create=False)
-            return queue.acknowledge(task_id)
-        elif re.match(RE_IN, text):
-            queue_name, task_id = parse(PATTERN_IN, text)
-            queue = self.get_queue(queue_name)
-            return queue.has(task_id)
+    def add(self, queue_name, data, delay=0, priority=0):
+        queue = self.get_queue(queue_name)
+        task_id = queue.add(data, delay, priority)
+        if delay or priority:
+            task = queue.storage.find(int(task_id))
+            schedule = SCHEDULE_FORMAT.pack(priority, _to_timestamp(task.available_at))
+            self._record(OP_ADD_SCHEDULED, queue_name, int(task_id), schedule + bytes(data))
         else:
+            self._record(OP_ADD, queue_name, int(task_id), data)
+        self._wake_waiters(queue_name)
+        return task_id
+
+    def _record(self, op, queue_name, task_id, payload=b""):
+        """Writes a mutation to the write-ahead log and streams it to followers"""
+        if self.wal is not None:
+            self.wal.append(op, queue_name, task_id, payload)
+        if self.replication is not None and self.replication.followers:
+            self.replication.append(op, queue_name, task_id, payload)
+
+    def _take(self, queue, queue_name):
+        task = queue.get()
+        if task is not None and self.replication is not None and self.replication.followers:
+            # leases are not logged: after a restart given out tasks are available again
+            self.replication.append(OP_LEASE, queue_name, task.task_id,
+                                    LEASE_FORMAT.pack(_to_timestamp(task.last_time_taken)))
+        return task
+
+    def get(self, queue_name, wait_ms=0):
+        """Returns a task, with wait_ms in async mode returns a coroutine waiting for one that long"""
+        queue = self.get_queue(queue_name, create=False)
+        task = self._take(queue, queue_name) if queue is not None else None
+        if task is not None:
+            return task.to_buffers()
+        if wait_ms and self.mode == "async":
+            return self._wait_for_task(queue_name, wait_ms / 1000)
+        return "NONE"
+
+    async def _wait_for_task(self, queue_name, timeout):
+        waiter = asyncio.get_running_loop().create_future()
+        waiters = self._waiters.setdefault(queue_name, deque())
+        waiters.append(waiter)
+        self._schedule_expiry(queue_name)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return "NONE"
+        finally:
+            if waiter in waiters:
+                waiters.remove(waiter)
+            self._schedule_expiry(queue_name)
+
+    def _wake_waiters(self, queue_name):
+        waiters = self._waiters.get(queue_name)
+        if not waiters:
+            return
+        queue = self.get_queue(queue_name)
+        while waiters:
+            if waiters[0].done():
+                waiters.popleft()
+                continue
+            task = self._take(queue, queue_name)
+            if task is None:
+                break
+            waiters.popleft().set_result(task.to_buffers())
+        self._schedule_expiry(queue_name)
+
+    def _schedule_expiry(self, queue_name):
+        """Keeps a timer for the next lease expiry of the queue while somebody waits for it"""
+        timer = self._expiry_timers.pop(queue_name, None)
+        if timer is not None:
+            timer.cancel()
+        if not self._waiters.get(queue_name):
+            self._waiters.pop(queue_name, None)
+            return
+        queue = self.get_queue(queue_name, create=False)
+        expiry = queue.next_expiry() if queue is not None else None
+        if expiry is not None:
+            delay = max(expiry - time.monotonic(), 0)
+            self._expiry_timers[queue_name] = asyncio.get_running_loop().call_later(
+                delay, self._wake_waiters, queue_name)
+
+    def acknowledge(self, queue_name, task_id):
+        queue = self.get_queue(queue_name, create=False)
+        if queue is None:
+            return "NO"
+        response = queue.acknowledge(task_id)
+        if response == "YES":
+            self._record(OP_ACK, queue_name, int(task_id))
+        return response
+
+    def parse_command(self, command, payloads=None):
+        """Executes a command and returns the response: a string or a list of bytes-like buffers.
+
+        ADD/MADD payloads are passed separately when the command was framed by CommandReader,
+        otherwise they are cut from the command itself.
+        """
+        if self.command_stats is None:
+            return self._execute(command, payloads)
+        started = time.perf_counter()
+        response = self._execute(command, payloads)
+        # a blocking GET is timed until it parks, not until it gets a task
+        self.command_stats.observe(command, time.perf_counter() - started)
+        return response
+
+    def _execute(self, command, payloads):
+        if payloads is None:
+            frames = CommandReader.split(command)
+            if len(frames) != 1 or frames[0] is ERROR_FRAME:
+                return "ERROR"
+            command, payloads = frames[0]
+        try:
+            verb, arguments = tokenize(command)
+        except ProtocolError:
             return "ERROR"
+        if self.follower is not None and verb in WRITE_COMMANDS:
+            return "ERROR"
+        if self.wal is None or self.wal.on_sync is None:
+            return self.COMMANDS[verb](self, payloads, *arguments)
+        logged = self.wal.appended
+        response = self.COMMANDS[verb](self, payloads, *arguments)
+        if self.wal.appended == logged:
+            return response
+        return self._after_sync(self.wal.appended, response)
+
+    def _after_sync(self, position, response):
+        """Returns a future of the response resolved once the log is on disk up to position"""
+        # the loop is set before synced is checked, so the flushing thread either sees it or has already synced
+        self._loop = asyncio.get_running_loop()
+        if self.wal.synced >= position:
+            return response
+        future = self._loop.create_future()
+        self._unsynced.append((position, future, response))
+        return future
+
+    def _log_synced(self, position):
+        """Called by the log flushing thread after fsync"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._release_synced, position)
+        except RuntimeError:
+            # closed meanwhile: the server is stopping and nobody waits for the responses
+            pass
+
+    def _release_synced(self, position):
+        while self._unsynced and self._unsynced[0][0] <= position:
+            _, future, response = self._unsynced.popleft()
+            # cancelled when the client has disconnected
+            if not future.done():
+                future.set_result(response)
+
+    def _add_command(self, payloads, queue_name, options, length):
+        options = parse_add_options(options)
+        if options is None or len(payloads) != 1:
+            return "ERROR"
+        return self.add(queue_name, payloads[0], *options)
+
+    def _get_command(self, payloads, queue_name, wait_ms):
+        if wait_ms is not None and wait_ms > MAX_WAIT_MS:
+            return "ERROR"
+        return self.get(queue_name, wait_ms or 0)
+
+    def _ack_command(self, payloads, queue_name, task_id):
+        return self.acknowledge(queue_name, task_id)
+
+    def _in_command(self, payloads, queue_name, task_id):
+        queue = self.get_queue(queue_name, create=False)
+        return queue.has(task_id) if queue is not None else "NO"
+
+    def _madd_command(self, payloads, queue_name, options, count):
+        options = parse_add_options(options)
+        if options is None or len(payloads) != count:
+            return "ERROR"
+        return " ".join(self.add(queue_name, data, *options) for data in payloads)
+
+    def _mget_command(self, payloads, queue_name, count):
+        buffers = []
+        for _ in range(count):
+            task = self.get(queue_name)
+            if task == "NONE":
+                break
+            if buffers:
+                buffers.append(b" ")
+            buffers.extend(task)
+        return buffers if buffers else "NONE"
+
+    def _mack_command(self, payloads, queue_name, task_ids):
+        return " ".join(self.acknowledge(queue_name, task_id) for task_id in task_ids)
+
+    def _stats_command(self, payloads, queue_name):
+        return self.stats(queue_name)
+
+    def _save_command(self, payloads):
+        if self.mode == "async" and hasattr(os, "fork"):
+            return self.save_in_background(self.path)
+        self.save(self.path)
+        return "OK"
+
+    def _promote_command(self, payloads):
+        self.promote()
+        return "OK"
+
+    COMMANDS = {
+        b"ADD": _add_command,
+        b"GET": _get_command,
+        b"ACK": _ack_command,
+        b"IN": _in_command,
+        b"MADD": _madd_command,
+        b"MGET": _mget_command,
+        b"MACK": _mack_command,
+        b"STATS": _stats_command,
+        b"SAVE": _save_command,
+        b"PROMOTE": _promote_command,
+    }
+
+    def queue_counters(self, queue_name):
+        counters = self.queues[queue_name].counters()
+        counters["waiting"] = len(self._waiters.get(queue_name, ()))
+        return counters
+
+    def stats(self, queue_name=None):
+        """Counters of one queue or totals of all queues, with latencies when they are collected"""
+        if queue_name is not None:
+            if queue_name not in self.queues:
+                return "NONE"
+            counters = self.queue_counters(queue_name)
+        else:
+            counters = {"queues": len(self.queues)}
+            for name in self.queues:
+                for key, value in self.queue_counters(name).items():
+                    counters[key] = counters.get(key, 0) + value
+            counters.update(self.replication_counters())
+        histograms = {}
+        if self.command_stats is not None:
+            histograms = self.command_stats.by_command(queue_name.encode() if queue_name is not None else None)
+        return format_stats(counters, histograms)
+
+    def write_metrics(self):
+        filename = self.path + METRICS_FILENAME
+        text = format_prometheus({name: self.queue_counters(name) for name in self.queues}, self.command_stats,
+                                 self.replication_counters())
+        with open(filename + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(filename + ".tmp", filename)
+        self._metrics_written = time.monotonic()
+
+    def write_metrics_if_due(self):
+        if self.metrics and time.monotonic() - self._metrics_written >= METRICS_INTERVAL:
+            self.write_metrics()
+
+    async def write_metrics_periodically(self):
+        while self.metrics:
+            await asyncio.sleep(METRICS_INTERVAL)
+            self.write_metrics()
+
+    def replication_counters(self):
+        if self.follower is not None:
+            return self.follower.counters()
+        return self.replication.counters() if self.replication is not None else {}
+
+    async def replicate(self):
+        """Follows the primary until promoted, then keeps the lag of own followers fresh"""
+        if self.follower is not None:
+            await self.follower.run()
+        if self.replication is not None:
+            await self.replication.send_heartbeats()
+
+    def promote(self):
+        """Stops following the primary and starts accepting writes"""
+        if self.follower is None:
+            return
+        self.follower.promote()
+        self.follower = None
+        if self.wal is not None:
+            # the log continues from the replicated state, not from the last own checkpoint
+            self.save(self.path)
+
+    def load_replica(self, snapshot):
+        """Replaces all queues with a snapshot received from the primary"""
+        for queue in self.queues.values():
+            queue.clear()
+        self.queues = {}
+        self._load_snapshot(io.BytesIO(snapshot))
+
+    def _write_snapshot(self, path):
+        with open(path + DUMP_FILENAME + ".tmp", 'wb') as f:
+            writer = SnapshotWriter(f)
+            for queue in self.queues.values():
+                queue.dump(writer)
+            writer.close()
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + DUMP_FILENAME + ".tmp", path + DUMP_FILENAME)
+
+    def _rotate_log(self):
+        return self.wal.rotate() if self.wal is not None else None
+
+    def _drop_log(self, segment):
+        if segment is not None:
+            self.wal.drop_segments(segment)
 
     def save(self, path):
-        dump = pickle.dumps(self.queues)
-        with open(path + DUMP_FILENAME, 'wb') as f:
-            f.write(dump)
+        segment = self._rotate_log()
+        self._write_snapshot(path)
+        self._drop_log(segment)
+
+    async def save_in_background(self, path):
+        """Writes the snapshot from a forked child, so requests are served while it is being written"""
+        async with self._save_lock:
+            segment = self._rotate_log()
+            pid = os.fork()
+            if pid == 0:
+                self._run_snapshot_child(path)
+            _, status = await asyncio.get_running_loop().run_in_executor(None, os.waitpid, pid, 0)
+            if os.waitstatus_to_exitcode(status) != 0:
+                return "ERROR"
+            self._drop_log(segment)
+            return "OK"
+
+    def _run_snapshot_child(self, path):
+        exit_code = 1
+        try:
+            self._write_snapshot(path)
+            exit_code = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(exit_code)
 
     def load(self, path):
-        with open(path + DUMP_FILENAME, 'rb') as f:
-            dump = f.read()
-        self.queues = pickle.loads(dump)
+        self.queues = {}
+        if os.path.isfile(path + DUMP_FILENAME):
+            with open(path + DUMP_FILENAME, 'rb') as f:
+                if is_snapshot(f):
+                    self._load_snapshot(f)
+                else:
+                    self._load_pickle(f)
+        if self.wal is not None:
+            self.wal.replay(self.apply_log_record)
+
+    def _load_pickle(self, f):
+        """Loads dumps saved before the binary snapshot format"""
+        for name, old_queue in pickle.load(f).items():
+            queue = self.get_queue(name)
+            for task in old_queue.storage:
+                data = task.data.encode("utf-8") if isinstance(task.data, str) else task.data
+                taken = task.last_time_taken
+                queue.restore(task.task_id, data,
+                              NEVER if taken == datetime.datetime.min else _from_timestamp(taken.timestamp()))
+            queue.restore_last_id(old_queue._last_id)
+
+    def _load_snapshot(self, f):
+        queue = None
+        for record in read_snapshot(f):
+            if record[0] == QUEUE:
+                queue = self.get_queue(record[1])
+            elif record[0] == TASK:
+                _, task_id, taken_at, data, priority, available_at = record
+                queue.restore(task_id, data, _from_timestamp(taken_at), priority, _from_timestamp(available_at))
+            elif record[0] == QUEUE_END:
+                queue.restore_last_id(record[1])
+
+    def apply_log_record(self, op, queue_name, task_id, payload):
+        queue = self.get_queue(queue_name)
+        if op == OP_ADD:
+            queue.restore(task_id, payload)
+        elif op == OP_ADD_SCHEDULED:
+            priority, available_at = SCHEDULE_FORMAT.unpack_from(payload)
+            queue.restore(task_id, payload[SCHEDULE_FORMAT.size:], priority=priority,
+                          available_at=_from_timestamp(available_at))
+        elif op == OP_LEASE:
+            taken_at, = LEASE_FORMAT.unpack(payload)
+            queue.lease(task_id, _from_timestamp(taken_at))
+        elif op == OP_ACK:
+            queue.remove(task_id)
 
     def run(self):
-        with socketserver.TCPServer((self.ip, self.port), MyTCPHandler) as my_server:
-            my_server.serve_forever()
+        try:
+            if self.mode == "async":
+                async_server.serve(self)
+            else:
+                with MyTCPServer(self) as my_server:
+                    my_server.serve_forever()
+        finally:
+            if self.wal is not None:
+                self.wal.close()
 
 
 def parse_args():
@@ -227,10 +932,69 @@ def parse_args():
         type=int,
         default=300,
         help='Task maximum GET timeout in seconds')
-    return parser.parse_args()
+    parser.add_argument(
+        '-m',
+        action="store",
+        dest="mode",
+        type=str,
+        choices=["sync", "async"],
+        default="sync",
+        help='Serving mode: one command per connection (sync) or persistent pipelined connections (async)')
+    parser.add_argument(
+        '-w',
+        action="store_true",
+        dest="wal",
+        help='Log every ADD/ACK to a write-ahead log in the checkpoints dir')
+    parser.add_argument(
+        '-f',
+        action="store",
+        dest="flush_interval",
+        type=float,
+        default=0.01,
+        help='Write-ahead log fsync interval in seconds, 0 to fsync every command')
+    parser.add_argument(
+        '-l',
+        action="store",
+        dest="memory_limit",
+        type=int,
+        default=0,
+        help='Memory limit for task data in bytes, data beyond it is spilled to disk. 0 for no limit')
+    parser.add_argument(
+        '-n',
+        action="store",
+        dest="shards",
+        type=int,
+        default=1,
+        help='Number of worker processes, each owns the queues whose names hash to it')
+    parser.add_argument(
+        '-s',
+        action="store_true",
+        dest="stats",
+        help='Collect command latency histograms for STATS')
+    parser.add_argument(
+        '-e',
+        action="store_true",
+        dest="metrics",
+        help=f'Collect statistics and write them to {METRICS_FILENAME} in the checkpoints dir '
+             f'in Prometheus text format every {METRICS_INTERVAL} seconds')
+    parser.add_argument(
+        '-r',
+        action="store",
+        dest="primary",
+        type=str,
+        default=None,
+        help='Follow the primary at host:port: replicate its queues, refuse writes until PROMOTE')
+    args = parser.parse_args()
+    if args.primary is not None and (args.mode != "async" or args.shards > 1):
+        parser.error("a follower runs in async mode without shards")
+    return args
 
 
 if __name__ == '__main__':
-    args = parse_args()
-    server = TaskQueueServer(**args.__dict__)
-    server.run()
+    args = parse_args().__dict__
+    shards = args.pop("shards")
+    if shards > 1:
+        sharding.run_shards(partial(TaskQueueServer, **args), shards, args["ip"], args["port"], args["path"])
+    else:
+        server = TaskQueueServer(**args)
+        server.run()
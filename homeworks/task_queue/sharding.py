@@ -0,0 +1,172 @@
+"""Sharded mode: N worker processes, each owning the queues whose names hash to it.
+
+Every worker listens on the public port with SO_REUSEPORT, so the kernel spreads connections
+between them. A command for a queue owned by another shard is forwarded to that shard over
+a persistent pipelined connection to its internal port (public port + 1 + shard number).
+SAVE is executed by every shard, each one writes a checkpoint of its own queues to <path>/shard-<n>/.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+import zlib
+from collections import deque
+
+from async_server import TaskQueueProtocol
+from framing import request_buffers, response_buffers
+
+
+def shard_of(queue_name, shards):
+    """Stable across processes, unlike hash()"""
+    return zlib.crc32(queue_name) % shards
+
+
+def internal_port(port, number):
+    return port + 1 + number
+
+
+class ShardPeer:
+    """Pipelined connection to another shard, responses come back length-prefixed and in order"""
+
+    def __init__(self, port):
+        self.port = port
+        self.writer = None
+        self.pending = deque()
+        self._connecting = None
+
+    async def _connect(self):
+        # concurrent requests wait for the same connection attempt, a cancelled request does not cancel it
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open())
+        await asyncio.shield(self._connecting)
+
+    async def _open(self):
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        except OSError:
+            self._connecting = None
+            raise
+        asyncio.ensure_future(self._read_responses(reader))
+        self.writer = writer
+
+    async def request(self, command, payloads):
+        if self.writer is None:
+            await self._connect()
+        response = asyncio.get_running_loop().create_future()
+        self.pending.append(response)
+        for buffer in request_buffers(command, payloads):
+            self.writer.write(buffer)
+        return await response
+
+    async def request_alone(self, command, payloads):
+        """Sends one command over a connection of its own, so a blocking GET does not hold up the pipeline"""
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        try:
+            for buffer in request_buffers(command, payloads):
+                writer.write(buffer)
+            length = int(await reader.readuntil(b"\n"))
+            return [await reader.readexactly(length)]
+        finally:
+            writer.close()
+
+    async def _read_responses(self, reader):
+        try:
+            while True:
+                length = int(await reader.readuntil(b"\n"))
+                data = await reader.readexactly(length)
+                response = self.pending.popleft()
+                # the request is cancelled when its client disconnects, the response is still read
+                if not response.done():
+                    response.set_result([data])
+        except (OSError, asyncio.IncompleteReadError) as error:
+            self.writer = None
+            self._connecting = None
+            while self.pending:
+                response = self.pending.popleft()
+                if not response.done():
+                    response.set_exception(error)
+
+
+class ShardRouter:
+    """Executes commands for local queues and forwards the others to their shards"""
+    # shards do not take followers
+    replication = None
+
+    def __init__(self, queue_server, number, shards, port):
+        self.queue_server = queue_server
+        self.number = number
+        self.shards = shards
+        self.peers = {other: ShardPeer(internal_port(port, other)) for other in range(shards) if other != number}
+
+    def parse_command(self, command, payloads):
+        words = command.split(b" ", 2)
+        if words[0] == b"SAVE":
+            return self.save_all()
+        if len(words) < 2:
+            return self.queue_server.parse_command(command, payloads)
+        shard = shard_of(words[1], self.shards)
+        if shard == self.number:
+            return self.queue_server.parse_command(command, payloads)
+        if words[0] == b"GET" and len(words) == 3:
+            return self.peers[shard].request_alone(command, payloads)
+        return self.peers[shard].request(command, payloads)
+
+    async def _save_local(self):
+        response = self.queue_server.parse_command(b"SAVE", [])
+        return await response if asyncio.iscoroutine(response) else response
+
+    async def save_all(self):
+        responses = await asyncio.gather(
+            self._save_local(),
+            *(peer.request(b"SAVE", []) for peer in self.peers.values()),
+            return_exceptions=True)
+        if all(isinstance(response, (str, list)) and b"".join(response_buffers(response)) == b"OK"
+               for response in responses):
+            return "OK"
+        return "ERROR"
+
+
+def run_shard(make_server, number, shards, ip, port, path):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    shard_path = os.path.join(path, f"shard-{number}") + "/"
+    os.makedirs(shard_path, exist_ok=True)
+    queue_server = make_server(path=shard_path, mode="async")
+    router = ShardRouter(queue_server, number, shards, port)
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        public = await loop.create_server(
+            lambda: TaskQueueProtocol(router), ip, port, reuse_address=True, reuse_port=True)
+        internal = await loop.create_server(
+            lambda: TaskQueueProtocol(queue_server, length_prefixed=True),
+            "127.0.0.1", internal_port(port, number), reuse_address=True)
+        # the loop keeps only a weak reference to tasks
+        metrics = asyncio.ensure_future(queue_server.write_metrics_periodically())
+        async with public, internal:
+            await asyncio.gather(public.serve_forever(), internal.serve_forever())
+
+    try:
+        asyncio.run(serve())
+    finally:
+        if queue_server.wal is not None:
+            queue_server.wal.close()
+
+
+def run_shards(make_server, shards, ip, port, path):
+    """Starts the shard processes and waits for them, stopping all of them on Ctrl+C or SIGTERM"""
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    workers = [
+        multiprocessing.Process(target=run_shard, args=(make_server, number, shards, ip, port, path))
+        for number in range(shards)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,100 @@
+"""Binary snapshot of task queues.
+
+Layout (all integers big-endian), written and read as a stream:
+
+    header      b"TQSNAP" version:uint8
+    queue       b"Q" name_length:uint16 name
+    task        b"T" task_id:uint64 taken_at:float64 priority:int16 available_at:float64 data_length:uint32 data
+    queue end   b"N" last_id:uint64
+    end         b"E"
+
+Tasks follow their queue in storage order. taken_at is a unix timestamp of the last GET, 0 if never taken,
+available_at is the unix timestamp when a delayed task becomes ready, 0 if it is not delayed.
+Version 1 tasks have no priority and available_at fields, they are read as 0.
+"""
+import struct
+
+
+MAGIC = b"TQSNAP"
+VERSION = 2
+
+QUEUE = b"Q"
+TASK = b"T"
+QUEUE_END = b"N"
+END = b"E"
+
+VERSION_FORMAT = struct.Struct("!B")
+QUEUE_FORMAT = struct.Struct("!H")
+TASK_FORMAT = struct.Struct("!QdhdI")
+TASK_FORMAT_V1 = struct.Struct("!QdI")
+QUEUE_END_FORMAT = struct.Struct("!Q")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotWriter:
+    def __init__(self, f):
+        self.f = f
+        f.write(MAGIC + VERSION_FORMAT.pack(VERSION))
+
+    def queue(self, name):
+        name = name.encode("utf-8")
+        self.f.write(QUEUE + QUEUE_FORMAT.pack(len(name)) + name)
+
+    def task(self, task_id, taken_at, data, priority=0, available_at=0.0):
+        self.f.write(TASK + TASK_FORMAT.pack(task_id, taken_at, priority, available_at, len(data)))
+        self.f.write(data)
+
+    def queue_end(self, last_id):
+        self.f.write(QUEUE_END + QUEUE_END_FORMAT.pack(last_id))
+
+    def close(self):
+        self.f.write(END)
+
+
+def is_snapshot(f):
+    """Checks the header without moving the file position"""
+    position = f.tell()
+    header = f.read(len(MAGIC))
+    f.seek(position)
+    return header == MAGIC
+
+
+def _read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise SnapshotError("unexpected end of snapshot")
+    return data
+
+
+def _read_struct(f, fmt):
+    return fmt.unpack(_read_exactly(f, fmt.size))
+
+
+def read_snapshot(f):
+    """Yields (QUEUE, name), (TASK, task_id, taken_at, data, priority, available_at) and (QUEUE_END, last_id) records"""
+    if _read_exactly(f, len(MAGIC)) != MAGIC:
+        raise SnapshotError("not a snapshot")
+    version, = _read_struct(f, VERSION_FORMAT)
+    if version not in (1, VERSION):
+        raise SnapshotError(f"unsupported snapshot version {version}")
+    while True:
+        kind = _read_exactly(f, 1)
+        if kind == QUEUE:
+            name_length, = _read_struct(f, QUEUE_FORMAT)
+            yield QUEUE, _read_exactly(f, name_length).decode("utf-8")
+        elif kind == TASK and version == 1:
+            task_id, taken_at, data_length = _read_struct(f, TASK_FORMAT_V1)
+            yield TASK, task_id, taken_at, _read_exactly(f, data_length), 0, 0.0
+        elif kind == TASK:
+            task_id, taken_at, priority, available_at, data_length = _read_struct(f, TASK_FORMAT)
+            yield TASK, task_id, taken_at, _read_exactly(f, data_length), priority, available_at
+        elif kind == QUEUE_END:
+            last_id, = _read_struct(f, QUEUE_END_FORMAT)
+            yield QUEUE_END, last_id
+        elif kind == END:
+            return
+        else:
+            raise SnapshotError(f"unknown record {kind!r}")
@@ -0,0 +1,111 @@
+import glob
+import mmap
+import os
+
+
+SEGMENT_SIZE = 64 << 20
+SEGMENT_FILENAME = "segment.{}"
+
+
+class SpilledPayload:
+    """Location of a payload written to a segment file"""
+    __slots__ = ("segment", "offset", "length")
+
+    def __init__(self, segment, offset, length):
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def view(self):
+        return self.segment.view(self.offset, self.length)
+
+
+def payload_view(data):
+    """Returns a bytes-like view of a payload, whether it is in memory or spilled"""
+    return data.view() if isinstance(data, SpilledPayload) else data
+
+
+class Segment:
+    """Append-only file of payloads, read back through one read-only memory map.
+
+    The file is created sparse at its full size, so the map never has to grow.
+    """
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.capacity = size
+        self.size = 0
+        # payloads that are not released yet
+        self.live = 0
+        self.file = open(filename, "w+b", buffering=0)
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+
+    def fits(self, length):
+        return self.size + length <= self.capacity
+
+    def append(self, data):
+        offset = self.size
+        view = memoryview(data)
+        while view:
+            view = view[self.file.write(view):]
+        self.size += len(data)
+        self.live += 1
+        return offset
+
+    def view(self, offset, length):
+        return memoryview(self.map)[offset:offset + length]
+
+    def delete(self):
+        # the map is closed when the last view of it is released
+        self.map = None
+        self.file.close()
+        os.remove(self.filename)
+
+
+class PayloadStore:
+    """Keeps task payloads in memory up to limit bytes, the rest is spilled to segment files.
+
+    A segment file is deleted once all of its payloads are released and a newer segment is in use.
+    Spilled payloads are not durable by themselves: snapshots and the write-ahead log keep their own copy.
+    """
+
+    def __init__(self, directory, limit, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.limit = limit
+        self.segment_size = segment_size
+        # bytes of payloads kept in memory
+        self.resident = 0
+        self._active = None
+        self._next_segment = 1
+        os.makedirs(directory, exist_ok=True)
+        for filename in glob.glob(os.path.join(glob.escape(directory), SEGMENT_FILENAME.format("*"))):
+            os.remove(filename)
+
+    def store(self, data):
+        if not data or self.resident + len(data) <= self.limit:
+            self.resident += len(data)
+            return data
+        return self._spill(data)
+
+    def _spill(self, data):
+        if self._active is None or not self._active.fits(len(data)):
+            if self._active is not None and self._active.live == 0:
+                self._active.delete()
+            filename = os.path.join(self.directory, SEGMENT_FILENAME.format(self._next_segment))
+            self._next_segment += 1
+            self._active = Segment(filename, self.segment_size)
+        offset = self._active.append(data)
+        return SpilledPayload(self._active, offset, len(data))
+
+    def release(self, data):
+        if isinstance(data, SpilledPayload):
+            segment = data.segment
+            segment.live -= 1
+            if segment.live == 0 and segment is not self._active:
+                segment.delete()
+        else:
+            self.resident -= len(data)
@@ -0,0 +1,141 @@
+"""Command latency histograms and the Prometheus text dump of server statistics."""
+from bisect import bisect_left
+
+
+# upper bounds of histogram buckets in seconds, the last bucket is +Inf
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+COMMANDS = frozenset((b"ADD", b"GET", b"ACK", b"IN", b"SAVE", b"MADD", b"MGET", b"MACK", b"STATS", b"PROMOTE"))
+
+
+class Histogram:
+    """Fixed-bucket histogram, observing is a bisect and two additions"""
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile, None if empty or beyond the last bound"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+
+class CommandStats:
+    """Latency histograms of executed commands by (command, queue name).
+
+    With is_queue(name) commands of queues that do not exist share one histogram per command
+    under an empty queue name, so random names can not grow the statistics.
+    """
+
+    def __init__(self, is_queue=None):
+        self.histograms = {}
+        self._is_queue = is_queue
+        # "<command> <queue>" prefix -> histogram, saves splitting every command
+        self._by_prefix = {}
+
+    def observe(self, command, seconds):
+        end = command.find(b" ", command.find(b" ") + 1)
+        prefix = command[:end] if end >= 0 else command
+        histogram = self._by_prefix.get(prefix)
+        if histogram is None:
+            histogram = self._histogram(prefix)
+        histogram.counts[bisect_left(BUCKETS, seconds)] += 1
+        histogram.sum += seconds
+
+    def _histogram(self, prefix):
+        words = prefix.split(b" ", 1)
+        queue = words[1] if len(words) > 1 else b""
+        # unknown commands and queues are not cached, so garbage can not grow the cache
+        cached = words[0] in COMMANDS
+        if not cached:
+            key = (b"ERROR", b"")
+        elif queue and self._is_queue is not None and not self._is_queue(queue):
+            # the queue may still be created later
+            key, cached = (words[0], b""), False
+        else:
+            key = (words[0], queue)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        if cached:
+            self._by_prefix[prefix] = histogram
+        return histogram
+
+    def by_command(self, queue_name=None):
+        """Merged histograms by command name, of one queue or of all of them"""
+        merged = {}
+        for (name, queue), histogram in self.histograms.items():
+            if queue_name is None or queue == queue_name:
+                merged.setdefault(name.decode(), Histogram()).merge(histogram)
+        return merged
+
+
+def format_stats(counters, histograms):
+    """One line of key=value pairs, latencies are bucket bounds in milliseconds"""
+    fields = [f"{key}={value}" for key, value in counters.items()]
+    for name, histogram in sorted(histograms.items()):
+        fields.append(f"{name}_count={histogram.count}")
+        for label, q in (("p50", 0.5), ("p99", 0.99)):
+            bound = histogram.quantile(q)
+            fields.append(f"{name}_{label}_ms={bound * 1000:g}" if bound is not None else f"{name}_{label}_ms=inf")
+    return " ".join(fields)
+
+
+def _label_value(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", errors="replace")
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join(f'{key}="{_label_value(value)}"' for key, value in labels.items())
+
+
+def format_prometheus(queue_counters, command_stats, server_counters=None):
+    """Prometheus text exposition format.
+
+    queue_counters maps queue name to a dict of counters, keys ending with _total are counters, the rest gauges.
+    server_counters are gauges without labels.
+    """
+    lines = []
+    for key, value in (server_counters or {}).items():
+        lines.append(f"# TYPE task_queue_{key} gauge")
+        lines.append(f"task_queue_{key} {value}")
+    metrics = {}
+    for queue_name, counters in sorted(queue_counters.items()):
+        for key, value in counters.items():
+            metrics.setdefault(key, []).append(f"task_queue_{key}{{{_labels(queue=queue_name)}}} {value}")
+    for key, samples in metrics.items():
+        lines.append(f"# TYPE task_queue_{key} {'counter' if key.endswith('_total') else 'gauge'}")
+        lines.extend(samples)
+    if command_stats is not None and command_stats.histograms:
+        lines.append("# TYPE task_queue_command_seconds histogram")
+        for (name, queue), histogram in sorted(command_stats.histograms.items()):
+            labels = _labels(command=name, queue=queue)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'task_queue_command_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"task_queue_command_seconds_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"task_queue_command_seconds_count{{{labels}}} {cumulative}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,6 @@
+from framing import response_buffers
+
+
+def execute(server, command):
+    """Runs a command and joins the response buffers"""
+    return b"".join(response_buffers(server.parse_command(command))).decode("utf-8")
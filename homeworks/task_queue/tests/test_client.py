@@ -0,0 +1,170 @@
+import asyncio
+import os
+import socket
+import subprocess
+import time
+from unittest import TestCase
+
+from client import (Client, AsyncClient, ResponseParser, Task, TaskQueueError,
+                    LINE, IDS, BOOL, BOOLS, TASK, TASKS, STATS)
+from server import DUMP_FILENAME
+
+
+class ResponseParserTest(TestCase):
+    def test_byte_by_byte(self):
+        parser = ResponseParser()
+        for kind in (LINE, TASK, TASKS, TASK, BOOLS, IDS, BOOL, STATS, TASKS, LINE):
+            parser.expect(kind)
+        data = b"1\n1 3 a\nb\n2 1 x 3 2 yz\nNONE\nYES NO\n4 5\nNO\ntasks=1\nNONE\nERROR\n"
+        responses = []
+        for i in range(len(data)):
+            responses += parser.feed(data[i:i + 1])
+        self.assertEqual(["1", Task("1", b"a\nb"), [Task("2", b"x"), Task("3", b"yz")], None, [True, False],
+                          ["4", "5"], False, {"tasks": "1"}, []], responses[:-1])
+        self.assertIsInstance(responses[-1], TaskQueueError)
+
+
+class ClientTest(TestCase):
+    server_args = ['-m', 'async']
+
+    def setUp(self):
+        if os.path.isfile("./" + DUMP_FILENAME):
+            os.remove("./" + DUMP_FILENAME)
+        self.server = subprocess.Popen(['py', 'server.py'] + self.server_args)
+        time.sleep(0.5)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+
+    def test_commands(self):
+        client = Client()
+        task_id = client.add("queue", b"12\n45", priority=1)
+        self.assertTrue(client.has("queue", task_id))
+        self.assertEqual(Task(task_id, b"12\n45"), client.get("queue"))
+        self.assertIsNone(client.get("queue"))
+        self.assertTrue(client.ack("queue", task_id))
+        self.assertFalse(client.ack("queue", task_id))
+        ids = client.add_many("queue", [b"a", b"b"])
+        self.assertEqual([Task(ids[0], b"a"), Task(ids[1], b"b")], client.get_many("queue", 5))
+        self.assertEqual([True, True], client.ack_many("queue", ids))
+        self.assertEqual("3", client.stats("queue")["added_total"])
+        with self.assertRaises(TaskQueueError):
+            client.ack("queue", "bad id")
+        client.close()
+
+    def test_pipeline(self):
+        client = Client()
+        with client.pipeline() as pipeline:
+            pipeline.add("queue", b"a")
+            pipeline.add("queue", b"b")
+            pipeline.get("queue")
+            first_id, second_id, task = pipeline.execute()
+        self.assertEqual(Task(first_id, b"a"), task)
+        # answered commands are not sent again
+        self.assertEqual("2", client.stats("queue")["added_total"])
+        client.close()
+
+    def test_reconnect(self):
+        client = Client()
+        task_id = client.add("queue", b"a")
+        self.tearDown()
+        self.setUp()
+        self.assertFalse(client.has("queue", task_id))
+        client.close()
+
+    def test_blocking_get_outlasts_timeout(self):
+        client = Client(timeout=0.2)
+        client.add("queue", b"a")
+        client.get("queue")
+        self.assertIsNone(client.get("queue", wait_ms=500))
+        self.assertEqual("0", client.stats("queue")["waiting"])
+        client.close()
+
+    def test_async_blocking_get_does_not_hold_up_others(self):
+        async def scenario():
+            client = AsyncClient(pool_size=1, timeout=0.3)
+            waiting = asyncio.ensure_future(client.get("other", wait_ms=1000))
+            await asyncio.sleep(0.05)
+            # the only pooled connection would answer ADD after the GET, when the timeout has passed
+            task_id = await client.add("queue", b"a")
+            task = await waiting
+            await client.close()
+            return task_id, task
+
+        task_id, task = asyncio.run(scenario())
+        self.assertEqual("1", task_id)
+        self.assertIsNone(task)
+
+    def test_async_client(self):
+        async def scenario():
+            client = AsyncClient(pool_size=2)
+            ids = await asyncio.gather(*(client.add("queue", b"%d" % i) for i in range(100)))
+            tasks = await asyncio.gather(*(client.get("queue") for _ in range(100)))
+            acks = await client.ack_many("queue", ids)
+            await client.close()
+            return ids, tasks, acks
+
+        ids, tasks, acks = asyncio.run(scenario())
+        self.assertEqual(100, len(set(ids)))
+        self.assertEqual(sorted(ids, key=int), sorted((task.id for task in tasks), key=int))
+        self.assertTrue(all(acks))
+
+
+class SyncServerClientTest(ClientTest):
+    server_args = []
+
+    def test_async_blocking_get_does_not_hold_up_others(self):
+        # the sync server does not wait in GET
+        pass
+
+    def test_async_client(self):
+        async def scenario():
+            client = AsyncClient()
+            task_id = await client.add("queue", b"a")
+            task = await client.get("queue")
+            await client.close()
+            return task_id, task
+
+        task_id, task = asyncio.run(scenario())
+        self.assertEqual(Task(task_id, b"a"), task)
+
+
+class ReadTimeoutTest(TestCase):
+    """A server that takes commands and never answers"""
+
+    def setUp(self):
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def received(self):
+        connection, _ = self.listener.accept()
+        connection.settimeout(0.5)
+        data = connection.recv(1000)
+        connection.close()
+        self.listener.settimeout(0)
+        # no second connection: the command is not sent again
+        with self.assertRaises(BlockingIOError):
+            self.listener.accept()
+        return data
+
+    def test_not_resent(self):
+        client = Client(port=self.port, timeout=0.2)
+        with self.assertRaises(TimeoutError):
+            client.add("queue", b"a")
+        self.assertEqual(b"ADD queue 1 a\n", self.received())
+
+    def test_async_not_resent(self):
+        async def scenario():
+            client = AsyncClient(port=self.port, timeout=0.2)
+            try:
+                with self.assertRaises(TimeoutError):
+                    await client.add("queue", b"a")
+            finally:
+                await client.close()
+
+        asyncio.run(scenario())
+        self.assertEqual(b"ADD queue 1 a\n", self.received())
@@ -0,0 +1,61 @@
+from unittest import TestCase
+
+from framing import CommandReader, ERROR_FRAME, READ_SIZE, request_buffers
+
+
+def feed(reader, data):
+    """Feeds data to the reader the way a socket does, through get_buffer()"""
+    frames = []
+    view = memoryview(data)
+    while view:
+        buffer = reader.get_buffer()
+        size = min(len(buffer), len(view), READ_SIZE // 3)
+        buffer[:size] = view[:size]
+        view = view[size:]
+        frames.extend(reader.buffer_updated(size))
+    return frames
+
+
+class CommandReaderTest(TestCase):
+    def test_old_client(self):
+        self.assertEqual([(b"GET queue", [])], CommandReader.split(b"GET queue"))
+        self.assertEqual([(b"ADD queue 5", [b"12\n45"])], CommandReader.split(b"ADD queue 5 12\n45"))
+
+    def test_persistent_commands(self):
+        reader = CommandReader()
+        frames = feed(reader, b"ADD queue 5 12\n45\nGET queue\nMADD queue 2 1 \n 3 a b\nACK queue 1\n")
+        self.assertTrue(reader.persistent)
+        self.assertEqual([
+            (b"ADD queue 5", [b"12\n45"]),
+            (b"GET queue", []),
+            (b"MADD queue 2", [b"\n", b"a b"]),
+            (b"ACK queue 1", []),
+        ], frames)
+
+    def test_partial_command(self):
+        reader = CommandReader()
+        self.assertEqual([(b"GET queue", [])], feed(reader, b"GET queue\nADD queue 5 12"))
+        self.assertEqual([(b"ADD queue 5", [b"12345"])], feed(reader, b"345\n"))
+
+    def test_big_payload(self):
+        data = bytes(range(256)) * 3900
+        reader = CommandReader()
+        frames = feed(reader, b"ADD queue %d %s\nGET queue\n" % (len(data), data))
+        self.assertEqual([(b"ADD queue %d" % len(data), [data]), (b"GET queue", [])], frames)
+        self.assertIsInstance(frames[0][1][0], bytearray)
+
+    def test_wrong_length(self):
+        reader = CommandReader()
+        self.assertEqual([(b"GET queue", []), ERROR_FRAME], feed(reader, b"GET queue\nADD queue 2 123\nGET queue\n"))
+        self.assertTrue(reader.broken)
+        self.assertEqual([ERROR_FRAME], CommandReader.split(b"MADD queue 2 1 a, 1 b"))
+        self.assertEqual([ERROR_FRAME], CommandReader.split(b"ADD queue 1000001 1"))
+
+    def test_add_options(self):
+        self.assertEqual([(b"ADD queue delay=10 priority=-1 5", [b"12 45"])],
+                         CommandReader.split(b"ADD queue delay=10 priority=-1 5 12 45"))
+
+    def test_request_buffers(self):
+        frames = [(b"ADD queue 5", [b"12\n45"]), (b"MADD queue 2", [b"1 ", b"abc"]), (b"GET queue", [])]
+        data = b"".join(b"".join(request_buffers(command, payloads)) for command, payloads in frames)
+        self.assertEqual(frames, feed(CommandReader(), data))
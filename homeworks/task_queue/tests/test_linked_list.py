@@ -91,3 +91,23 @@ class LinkedListBaseTest(TestCase):
         self.assertEqual(b.next, d)
         self.assertEqual(d.prev, b)
         self.assertIsNone(d.next)
+
+    def test_index(self):
+        a = LinkedListNode("a")
+        b = LinkedListNode("b")
+        c = LinkedListNode("c")
+
+        l = LinkedList(key=lambda node: node.data)
+        l.add(a)
+        l.add(b)
+        l.add(c)
+
+        self.assertEqual(l.find("b"), b)
+        self.assertTrue(l.has(c))
+
+        l.delete(b)
+
+        self.assertIsNone(l.find("b"))
+        self.assertFalse(l.has(b))
+        self.assertEqual(l.find("a"), a)
+        self.assertEqual(l.find("c"), c)
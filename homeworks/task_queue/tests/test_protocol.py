@@ -0,0 +1,36 @@
+from unittest import TestCase
+
+from protocol import tokenize, ProtocolError
+
+
+class TokenizeTest(TestCase):
+    def test_commands(self):
+        self.assertEqual((b"ADD", ["queue", [], 5]), tokenize(b"ADD queue 5"))
+        self.assertEqual((b"ADD", ["queue", [("delay", 100), ("priority", -2)], 5]),
+                         tokenize(b"ADD queue delay=100 priority=-2 5"))
+        self.assertEqual((b"GET", ["queue", None]), tokenize(b"GET queue"))
+        self.assertEqual((b"GET", ["queue", 100]), tokenize(b"GET queue 100"))
+        self.assertEqual((b"ACK", ["queue", b"12"]), tokenize(b"ACK queue 12"))
+        self.assertEqual((b"MACK", ["queue", [b"1", b"a_b"]]), tokenize(b"MACK queue 1 a_b"))
+        self.assertEqual((b"STATS", [None]), tokenize(b"STATS"))
+        self.assertEqual((b"SAVE", []), tokenize(b"SAVE"))
+        self.assertEqual((b"IN", ["очередь", b"1"]), tokenize("IN очередь 1".encode("utf-8")))
+
+    def assertError(self, command, position):
+        with self.assertRaises(ProtocolError) as context:
+            tokenize(command)
+        self.assertEqual(position, context.exception.position)
+
+    def test_errors(self):
+        self.assertError(b"ADDD queue 5", 0)
+        self.assertError(b"ADD queue", 9)
+        self.assertError(b"ADD que-ue 5", 7)
+        self.assertError(b"ADD queue delay=x 5", 16)
+        self.assertError(b"ADD queue delay 5", 15)
+        self.assertError(b"ADD queue 5x", 10)
+        self.assertError(b"GET  queue", 4)
+        self.assertError(b"GET queue 1 2", 12)
+        self.assertError(b"SAVE now", 5)
+        self.assertError(b"ACK queue " + b"1" * 129, 138)
+        self.assertError(b"ADD \xd0 5", 4)
+        self.assertError(b"GET " + b"q" * 2 ** 16, 4 + 2 ** 16 - 1)
@@ -7,15 +7,20 @@ import socket
 import subprocess
 
 import os
+import glob
+import shutil
+import tempfile
 
 from server import DUMP_FILENAME
 
 
 class ServerBaseTest(TestCase):
+    server_args = []
+
     def setUp(self):
         if os.path.isfile("./" + DUMP_FILENAME):
             os.remove("./" + DUMP_FILENAME)
-        self.server = subprocess.Popen(['py', 'server.py'])
+        self.server = subprocess.Popen(['py', 'server.py'] + self.server_args)
         # даем серверу время на запуск
         time.sleep(0.5)
 
@@ -75,7 +80,7 @@ class ServerBaseTest(TestCase):
 
         self.tearDown()
 
-        self.server = subprocess.Popen(['py', 'server.py'])
+        self.server = subprocess.Popen(['py', 'server.py'] + self.server_args)
         time.sleep(1)
 
         self.assertEqual(b'YES', self.send(b'IN queue1 ' + first_task_id))
@@ -83,6 +88,204 @@ class ServerBaseTest(TestCase):
         self.assertEqual(b'YES', self.send(b'IN queue1 ' + third_task_id))
 
 
+class AsyncServerTest(ServerBaseTest):
+    server_args = ['-m', 'async']
+
+    def connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        return s.makefile('rwb')
+
+    def test_persistent_connection(self):
+        connection = self.connect()
+        connection.write(b'ADD 1 5 12345\n')
+        connection.flush()
+        task_id = connection.readline().strip()
+        connection.write(b'IN 1 ' + task_id + b'\n')
+        connection.flush()
+        self.assertEqual(b'YES\n', connection.readline())
+        connection.close()
+
+    def test_pipelined_commands(self):
+        connection = self.connect()
+        connection.write(b'ADD 1 5 12345\nADD 1 4 6789\nGET 1\nGET 1\nGET 1\n')
+        connection.flush()
+        first_task_id = connection.readline().strip()
+        second_task_id = connection.readline().strip()
+        self.assertEqual(first_task_id + b' 5 12345\n', connection.readline())
+        self.assertEqual(second_task_id + b' 4 6789\n', connection.readline())
+        self.assertEqual(b'NONE\n', connection.readline())
+        connection.close()
+
+    def test_big_payload(self):
+        data = bytes(range(256)) * 3900
+        connection = self.connect()
+        connection.write(b'ADD 1 %d %s\nGET 1\n' % (len(data), data))
+        connection.flush()
+        task_id = connection.readline().strip()
+        self.assertEqual(task_id + b' %d ' % len(data), connection.read(len(task_id) + len(str(len(data))) + 2))
+        self.assertEqual(data + b'\n', connection.read(len(data) + 1))
+        connection.close()
+
+    def test_blocking_get(self):
+        consumer = self.connect()
+        consumer.write(b'GET 1 5000\n')
+        consumer.flush()
+        time.sleep(0.2)
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(task_id + b' 5 12345\n', consumer.readline())
+        consumer.write(b'GET 1 100\n')
+        consumer.flush()
+        self.assertEqual(b'NONE\n', consumer.readline())
+        consumer.close()
+
+    def test_disconnected_blocking_get(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.send(b'GET 1 5000\n')
+        time.sleep(0.2)
+        s.close()
+        time.sleep(0.2)
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+
+    def test_old_clients(self):
+        connection = self.connect()
+        connection.write(b'ADD 1 5 12345\n')
+        connection.flush()
+        task_id = connection.readline().strip()
+        self.assertEqual(b'YES', self.send(b'IN 1 ' + task_id))
+        connection.close()
+
+
+class ShardedServerTest(ServerBaseTest):
+    server_args = ['-n', '3']
+
+    def setUp(self):
+        for directory in glob.glob("./shard-*"):
+            shutil.rmtree(directory)
+        super().setUp()
+        time.sleep(0.5)
+
+    @classmethod
+    def tearDownClass(cls):
+        for directory in glob.glob("./shard-*"):
+            shutil.rmtree(directory)
+
+    def test_many_queues(self):
+        queues = [b'queue%d' % i for i in range(10)]
+        task_ids = [self.send(b'ADD ' + queue + b' 5 12345') for queue in queues]
+        for queue, task_id in zip(queues, task_ids):
+            self.assertEqual(b'YES', self.send(b'IN ' + queue + b' ' + task_id))
+            self.assertEqual(task_id + b' 5 12345', self.send(b'GET ' + queue))
+            self.assertEqual(b'YES', self.send(b'ACK ' + queue + b' ' + task_id))
+
+    def test_forwarded_pipeline(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        connection = s.makefile('rwb')
+        commands = b''.join(b'ADD queue%d 5 12345\nGET queue%d\n' % (i, i) for i in range(10))
+        connection.write(commands)
+        connection.flush()
+        for _ in range(10):
+            task_id = connection.readline().strip()
+            self.assertEqual(task_id + b' 5 12345\n', connection.readline())
+        connection.close()
+
+    def test_blocking_get(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        consumer = s.makefile('rwb')
+        # some of the queues belong to other shards, forwarded blocking GETs must not hold each other up
+        consumer.write(b''.join(b'GET queue%d 5000\n' % i for i in range(3)))
+        consumer.flush()
+        time.sleep(0.2)
+        task_ids = [self.send(b'ADD queue%d 5 12345' % i) for i in range(3)]
+        for task_id in task_ids:
+            self.assertEqual(task_id + b' 5 12345\n', consumer.readline())
+        consumer.close()
+
+    def test_disconnected_blocking_get(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        # forwarded GETs are cancelled on the owning shard too
+        s.send(b''.join(b'GET queue%d 5000\n' % i for i in range(3)))
+        time.sleep(0.2)
+        s.close()
+        time.sleep(0.2)
+        for i in range(3):
+            task_id = self.send(b'ADD queue%d 5 12345' % i)
+            self.assertEqual(task_id + b' 5 12345', self.send(b'GET queue%d' % i))
+
+    def test_save_creates_shard_checkpoints(self):
+        self.send(b'ADD queue1 5 12345')
+        self.assertEqual(b'OK', self.send(b'SAVE'))
+        for n in range(3):
+            self.assertTrue(os.path.isfile("./shard-%d/%s" % (n, DUMP_FILENAME)))
+
+
+class ReplicationTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.terminate()
+            server.wait()
+        self.dir.cleanup()
+
+    def start(self, name, port, *args):
+        path = os.path.join(self.dir.name, name) + "/"
+        os.makedirs(path)
+        self.servers.append(subprocess.Popen(['py', 'server.py', '-m', 'async', '-p', str(port), '-c', path] + list(args)))
+        time.sleep(0.5)
+
+    def send(self, port, command):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', port))
+        s.send(command)
+        data = s.recv(1000000)
+        s.close()
+        return data
+
+    def stats(self, port):
+        return dict(field.split(b"=") for field in self.send(port, b'STATS').split())
+
+    def wait_for_follower(self):
+        for _ in range(50):
+            primary = self.stats(5561)
+            follower = self.stats(5562)
+            if primary[b'followers'] == b'1' and primary[b'replication_position'] == follower[b'replication_position']:
+                return
+            time.sleep(0.1)
+        self.fail("follower did not catch up")
+
+    def test_follow_and_promote(self):
+        self.start('primary', 5561)
+        first_task_id = self.send(5561, b'ADD queue 5 12345')
+        self.start('follower', 5562, '-r', '127.0.0.1:5561')
+        second_task_id = self.send(5561, b'ADD queue 4 6789')
+        third_task_id = self.send(5561, b'ADD queue 2 00')
+        self.assertEqual(first_task_id + b' 5 12345', self.send(5561, b'GET queue'))
+        self.assertEqual(b'YES', self.send(5561, b'ACK queue ' + first_task_id))
+        self.assertEqual(second_task_id + b' 4 6789', self.send(5561, b'GET queue'))
+        self.wait_for_follower()
+
+        self.assertEqual(b'NO', self.send(5562, b'IN queue ' + first_task_id))
+        self.assertEqual(b'YES', self.send(5562, b'IN queue ' + second_task_id))
+        self.assertEqual(b'ERROR', self.send(5562, b'ADD queue 1 a'))
+        self.assertEqual(b'1', self.stats(5562)[b'in_flight'])
+        self.assertEqual(b'1', self.stats(5562)[b'replication_connected'])
+        self.assertEqual(b'0', self.stats(5561)[b'replication_lag'])
+
+        self.assertEqual(b'OK', self.send(5562, b'PROMOTE'))
+        # the lease given out by the primary holds on the promoted follower
+        self.assertEqual(third_task_id + b' 2 00', self.send(5562, b'GET queue'))
+        self.assertEqual(b'YES', self.send(5562, b'ACK queue ' + second_task_id))
+        self.assertEqual(b'4', self.send(5562, b'ADD queue 1 a'))
+
+
 class ServerTimeoutTest(TestCase):
     def setUp(self):
         if os.path.isfile("./" + DUMP_FILENAME):
@@ -112,6 +315,23 @@ class ServerTimeoutTest(TestCase):
         time.sleep(6)
         self.assertEqual(b'NO', self.send(b'ACK queue1 ' + first_task_id))
 
+    def test_short_payload(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.send(b'ADD 1 10 12345')
+        started = time.monotonic()
+        self.assertEqual(b'ERROR', s.recv(1000))
+        self.assertLess(time.monotonic() - started, 5)
+        s.close()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.send(b'ADD 1 10 12345')
+        s.shutdown(socket.SHUT_WR)
+        self.assertEqual(b'ERROR', s.recv(1000))
+        s.close()
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,144 @@
+import asyncio
+import io
+import os
+import struct
+import time
+import tempfile
+from unittest import TestCase
+
+from server import TaskQueueServer, DUMP_FILENAME
+from snapshot import SnapshotWriter, SnapshotError, read_snapshot, QUEUE, TASK, QUEUE_END
+from tests import execute
+
+
+class SnapshotFormatTest(TestCase):
+    def test_round_trip(self):
+        f = io.BytesIO()
+        writer = SnapshotWriter(f)
+        writer.queue("queue")
+        writer.task(1, 0.0, b"12345")
+        writer.task(3, 1.5, b"", -2, 7.5)
+        writer.queue_end(4)
+        writer.close()
+        f.seek(0)
+
+        self.assertEqual([
+            (QUEUE, "queue"),
+            (TASK, 1, 0.0, b"12345", 0, 0.0),
+            (TASK, 3, 1.5, b"", -2, 7.5),
+            (QUEUE_END, 4),
+        ], list(read_snapshot(f)))
+
+    def test_version_1(self):
+        f = io.BytesIO(b"TQSNAP\x01Q\x00\x05queueT" + struct.pack("!QdI", 1, 1.5, 5) + b"12345E")
+        self.assertEqual([(QUEUE, "queue"), (TASK, 1, 1.5, b"12345", 0, 0.0)], list(read_snapshot(f)))
+
+    def test_truncated(self):
+        f = io.BytesIO()
+        writer = SnapshotWriter(f)
+        writer.queue("queue")
+        writer.task(1, 0.0, b"12345")
+
+        with self.assertRaises(SnapshotError):
+            list(read_snapshot(io.BytesIO(f.getvalue()[:-1])))
+
+
+class ServerSnapshotTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def start(self, timeout=300, **kwargs):
+        server = TaskQueueServer("127.0.0.1", 5555, self.dir.name + "/", timeout, **kwargs)
+        if server.wal is not None:
+            self.addCleanup(server.wal.close)
+        return server
+
+    def test_save_load(self):
+        server = self.start()
+        first_task_id = execute(server, b"ADD queue 5 12345")
+        second_task_id = execute(server, b"ADD queue 4 6789")
+        third_task_id = execute(server, b"ADD queue 2 00")
+        execute(server, b"GET queue")
+        execute(server, b"GET queue")
+        execute(server, b"ACK queue " + second_task_id.encode())
+        execute(server, b"SAVE")
+
+        server = self.start()
+        self.assertEqual("YES", execute(server, b"IN queue " + first_task_id.encode()))
+        self.assertEqual("NO", execute(server, b"IN queue " + second_task_id.encode()))
+        # first task is still given out
+        self.assertEqual(third_task_id + " 2 00", execute(server, b"GET queue"))
+        self.assertEqual("YES", execute(server, b"ACK queue " + first_task_id.encode()))
+        self.assertEqual("4", execute(server, b"ADD queue 1 0"))
+
+    def test_long_queue_name(self):
+        server = self.start()
+        self.assertEqual("ERROR", execute(server, b"ADD " + b"q" * 70000 + b" 1 x"))
+        self.assertEqual("OK", execute(server, b"SAVE"))
+
+    def test_expired_lease_after_load(self):
+        server = self.start()
+        first_task_id = execute(server, b"ADD queue 5 12345")
+        execute(server, b"ADD queue 4 6789")
+        execute(server, b"GET queue")
+        server.save(server.path)
+
+        server = self.start(timeout=0)
+        self.assertEqual(first_task_id + " 5 12345", execute(server, b"GET queue"))
+
+    def test_delay_and_priority_after_load(self):
+        server = self.start()
+        execute(server, b"ADD queue 1 a")
+        execute(server, b"ADD queue priority=5 1 b")
+        execute(server, b"ADD queue delay=200 priority=9 1 c")
+        server.save(server.path)
+
+        server = self.start()
+        self.assertEqual("2 1 b", execute(server, b"GET queue"))
+        self.assertEqual("1 1 a", execute(server, b"GET queue"))
+        self.assertEqual("NONE", execute(server, b"GET queue"))
+        time.sleep(0.25)
+        self.assertEqual("3 1 c", execute(server, b"GET queue"))
+
+    def test_save_drops_log_segments(self):
+        server = self.start(wal=True)
+        execute(server, b"ADD queue 5 12345")
+        execute(server, b"SAVE")
+        execute(server, b"ADD queue 4 6789")
+        server.wal.close()
+
+        self.assertEqual(["dump.txt", "wal.log"], sorted(os.listdir(self.dir.name)))
+        server = self.start(wal=True)
+        self.assertEqual("1 5 12345", execute(server, b"GET queue"))
+        self.assertEqual("2 4 6789", execute(server, b"GET queue"))
+
+    def test_log_segment_of_unfinished_snapshot_is_replayed(self):
+        server = self.start(wal=True)
+        execute(server, b"ADD queue 5 12345")
+        server.wal.rotate()
+        execute(server, b"ADD queue 4 6789")
+        server.wal.close()
+
+        server = self.start(wal=True)
+        self.assertEqual("1 5 12345", execute(server, b"GET queue"))
+        self.assertEqual("2 4 6789", execute(server, b"GET queue"))
+
+
+class BackgroundSnapshotTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_save_in_background(self):
+        server = TaskQueueServer("127.0.0.1", 5555, self.dir.name + "/", 300, mode="async")
+        task_id = execute(server, b"ADD queue 5 12345")
+
+        self.assertEqual("OK", asyncio.run(server.parse_command(b"SAVE")))
+        self.assertTrue(os.path.isfile(self.dir.name + "/" + DUMP_FILENAME))
+        server = TaskQueueServer("127.0.0.1", 5555, self.dir.name + "/", 300)
+        self.assertEqual("YES", execute(server, b"IN queue " + task_id.encode()))
@@ -0,0 +1,64 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from server import TaskQueueServer, SPILL_DIRNAME
+from spill import PayloadStore, SpilledPayload, payload_view
+from tests import execute
+
+
+class PayloadStoreTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = PayloadStore(self.dir.name, 10, segment_size=16)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_spill_over_limit(self):
+        first = self.store.store(b"12345678")
+        second = self.store.store(b"abcdef")
+        self.assertEqual(b"12345678", first)
+        self.assertIsInstance(second, SpilledPayload)
+        self.assertEqual(b"abcdef", bytes(payload_view(second)))
+        self.assertEqual(8, self.store.resident)
+
+        self.store.release(first)
+        self.assertEqual(0, self.store.resident)
+        self.assertEqual(b"0123456789", self.store.store(b"0123456789"))
+
+    def test_segments_are_reclaimed(self):
+        self.store.limit = 0
+        first = self.store.store(b"12345678")
+        second = self.store.store(b"abcdefgh")
+        third = self.store.store(b"ABCDEFGH")
+        self.assertEqual(["segment.1", "segment.2"], sorted(os.listdir(self.dir.name)))
+
+        self.store.release(first)
+        self.assertEqual(["segment.1", "segment.2"], sorted(os.listdir(self.dir.name)))
+        self.store.release(second)
+        self.assertEqual(["segment.2"], os.listdir(self.dir.name))
+        self.assertEqual(b"ABCDEFGH", bytes(payload_view(third)))
+
+
+class ServerSpillTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_spilled_tasks(self):
+        server = TaskQueueServer("127.0.0.1", 5555, self.dir.name + "/", 300, memory_limit=5)
+        first_task_id = execute(server, b"ADD queue 5 12345")
+        second_task_id = execute(server, b"ADD queue 4 6789")
+        self.assertEqual(5, server.payloads.resident)
+
+        self.assertEqual(first_task_id + " 5 12345", execute(server, b"GET queue"))
+        self.assertEqual(second_task_id + " 4 6789", execute(server, b"GET queue"))
+        self.assertEqual("YES", execute(server, b"ACK queue " + second_task_id.encode()))
+
+        execute(server, b"SAVE")
+        server = TaskQueueServer("127.0.0.1", 5555, self.dir.name + "/", 300, memory_limit=5)
+        self.assertEqual("YES", execute(server, b"IN queue " + first_task_id.encode()))
+        self.assertEqual([], os.listdir(os.path.join(self.dir.name, SPILL_DIRNAME)))
@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+from stats import Histogram, CommandStats, format_stats, format_prometheus
+
+
+class HistogramTest(TestCase):
+    def test_quantile(self):
+        histogram = Histogram()
+        for value in [0.00001] * 98 + [0.003, 2.0]:
+            histogram.observe(value)
+        self.assertEqual(100, histogram.count)
+        self.assertEqual(0.00005, histogram.quantile(0.5))
+        self.assertEqual(0.005, histogram.quantile(0.99))
+        self.assertIsNone(histogram.quantile(1))
+        self.assertIsNone(Histogram().quantile(0.5))
+
+
+class CommandStatsTest(TestCase):
+    def test_keys(self):
+        stats = CommandStats()
+        stats.observe(b"ADD queue 5", 0.001)
+        stats.observe(b"GET queue", 0.001)
+        stats.observe(b"GET other", 0.001)
+        stats.observe(b"SAVE", 0.1)
+        stats.observe(b"PROMOTE", 0.001)
+        stats.observe(b"FOO bar", 0.001)
+        self.assertEqual(
+            {(b"ADD", b"queue"), (b"GET", b"queue"), (b"GET", b"other"), (b"SAVE", b""), (b"PROMOTE", b""),
+             (b"ERROR", b"")},
+            set(stats.histograms))
+        self.assertEqual(2, stats.by_command()["GET"].count)
+        self.assertEqual({"ADD", "GET"}, set(stats.by_command(b"queue")))
+
+    def test_unknown_queues(self):
+        stats = CommandStats(lambda name: name == b"queue")
+        stats.observe(b"GET queue", 0.001)
+        for i in range(100):
+            stats.observe(b"IN nosuch%d 1" % i, 0.001)
+        self.assertEqual({(b"GET", b"queue"), (b"IN", b"")}, set(stats.histograms))
+        self.assertEqual(100, stats.by_command()["IN"].count)
+        self.assertEqual(1, len(stats._by_prefix))
+
+    def test_format(self):
+        stats = CommandStats()
+        stats.observe(b"GET queue", 0.0002)
+        self.assertEqual("tasks=1 GET_count=1 GET_p50_ms=0.25 GET_p99_ms=0.25",
+                         format_stats({"tasks": 1}, stats.by_command()))
+        text = format_prometheus({"queue": {"tasks": 1, "added_total": 3}}, stats)
+        self.assertIn('# TYPE task_queue_added_total counter\ntask_queue_added_total{queue="queue"} 3\n', text)
+        self.assertIn('task_queue_command_seconds_bucket{command="GET",queue="queue",le="0.0001"} 0\n', text)
+        self.assertIn('task_queue_command_seconds_bucket{command="GET",queue="queue",le="+Inf"} 1\n', text)
+        self.assertIn('task_queue_command_seconds_count{command="GET",queue="queue"} 1\n', text)
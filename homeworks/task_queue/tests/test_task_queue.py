@@ -0,0 +1,230 @@
+import asyncio
+import tempfile
+import time
+from unittest import TestCase
+
+from framing import response_buffers
+from server import TaskQueue, TaskQueueServer, METRICS_FILENAME
+from tests import execute
+
+
+async def execute_async(server, command):
+    response = server.parse_command(command)
+    if asyncio.iscoroutine(response) or isinstance(response, asyncio.Future):
+        response = await response
+    return b"".join(response_buffers(response)).decode("utf-8")
+
+
+class TaskQueueTest(TestCase):
+    def setUp(self):
+        self.queue = TaskQueue("queue", 0.1)
+
+    def get_id(self):
+        task = self.queue.get()
+        return str(task.task_id) if task is not None else None
+
+    def test_get_in_order(self):
+        ids = [self.queue.add("data") for _ in range(3)]
+        self.assertEqual(ids, [self.get_id() for _ in range(3)])
+        self.assertIsNone(self.queue.get())
+
+    def test_expired_tasks_keep_order(self):
+        first, second, third = [self.queue.add("data") for _ in range(3)]
+        self.assertEqual(first, self.get_id())
+        self.assertEqual(second, self.get_id())
+        time.sleep(0.15)
+        fourth = self.queue.add("data")
+
+        self.assertEqual(first, self.get_id())
+        self.assertEqual(second, self.get_id())
+        self.assertEqual(third, self.get_id())
+        self.assertEqual(fourth, self.get_id())
+        self.assertIsNone(self.queue.get())
+
+    def test_acknowledged_task_is_not_redelivered(self):
+        first, second = [self.queue.add("data") for _ in range(2)]
+        self.get_id()
+        self.get_id()
+        self.assertEqual("YES", self.queue.acknowledge(first))
+        self.assertEqual("NO", self.queue.has(first))
+        time.sleep(0.15)
+
+        self.assertEqual("NO", self.queue.acknowledge(second))
+        self.assertEqual(second, self.get_id())
+        self.assertIsNone(self.queue.get())
+
+    def test_acknowledge_not_taken(self):
+        task_id = self.queue.add("data")
+        self.assertEqual("NO", self.queue.acknowledge(task_id))
+        self.assertEqual("YES", self.queue.has(task_id))
+
+    def test_unknown_id(self):
+        self.queue.add("data")
+        self.assertEqual("NO", self.queue.has("42"))
+        self.assertEqual("NO", self.queue.has("abc"))
+        self.assertEqual("NO", self.queue.acknowledge("abc"))
+
+    def test_replicated_lease(self):
+        first, second = [self.queue.add("data") for _ in range(2)]
+        self.queue.lease(int(second), time.monotonic())
+        self.assertEqual(first, self.get_id())
+        self.assertIsNone(self.queue.get())
+        self.assertEqual("YES", self.queue.acknowledge(second))
+        time.sleep(0.15)
+        self.assertEqual(first, self.get_id())
+        self.assertIsNone(self.queue.get())
+
+
+class PriorityAndDelayTest(TestCase):
+    def setUp(self):
+        self.queue = TaskQueue("queue", 0.1)
+
+    def get_id(self):
+        task = self.queue.get()
+        return task.task_id if task is not None else None
+
+    def test_priority_then_fifo(self):
+        for priority in [0, 2, -1, 2, 0]:
+            self.queue.add(b"data", priority=priority)
+        self.assertEqual([2, 4, 1, 5, 3, None], [self.get_id() for _ in range(6)])
+
+    def test_expired_task_keeps_priority(self):
+        self.queue.add(b"data", priority=1)
+        self.assertEqual(1, self.get_id())
+        self.queue.add(b"data")
+        time.sleep(0.15)
+        self.queue.add(b"data", priority=1)
+        self.assertEqual([1, 3, 2], [self.get_id() for _ in range(3)])
+
+    def test_delay(self):
+        self.queue.add(b"data", delay=100)
+        self.queue.add(b"data")
+        self.assertEqual(2, self.get_id())
+        self.assertIsNone(self.queue.get())
+        self.assertEqual(1, self.queue.counters()["delayed"])
+        self.assertEqual("NO", self.queue.acknowledge("1"))
+        time.sleep(0.15)
+        self.assertEqual(0, self.queue.counters()["delayed"])
+        # only the lease of the second task has expired, the first one becomes ready for the first time
+        self.assertEqual(1, self.queue.redelivered)
+        self.assertEqual([1, 2], [self.get_id() for _ in range(2)])
+
+    def test_options(self):
+        server = TaskQueueServer("127.0.0.1", 5555, "./nonexistent/", 300)
+        self.assertEqual("1", execute(server, b"ADD queue priority=-3 1 a"))
+        self.assertEqual("2", execute(server, b"ADD queue delay=0 1 b"))
+        self.assertEqual("ERROR", execute(server, b"ADD queue speed=1 1 c"))
+        self.assertEqual("ERROR", execute(server, b"ADD queue delay=1 delay=2 1 c"))
+        self.assertEqual("ERROR", execute(server, b"ADD queue delay=-1 1 c"))
+        self.assertEqual("ERROR", execute(server, b"ADD queue delay=%d 1 c" % (2 ** 31 + 1)))
+        self.assertEqual("ERROR", execute(server, b"ADD queue delay=1" + b"0" * 400 + b" 1 c"))
+        self.assertEqual("ERROR", execute(server, b"ADD queue priority=40000 1 c"))
+        self.assertEqual("2 1 b 1 1 a", execute(server, b"MGET queue 3"))
+
+
+class BatchCommandsTest(TestCase):
+    def setUp(self):
+        self.server = TaskQueueServer("127.0.0.1", 5555, "./nonexistent/", 300)
+
+    def test_batch_scenario(self):
+        self.assertEqual("1 2 3", execute(self.server, b"MADD queue 3 5 12345 3 a b 2 00"))
+        self.assertEqual("1 5 12345 2 3 a b", execute(self.server, b"MGET queue 2"))
+        self.assertEqual("YES NO YES", execute(self.server, b"MACK queue 1 3 2"))
+        self.assertEqual("3 2 00", execute(self.server, b"MGET queue 5"))
+        self.assertEqual("NONE", execute(self.server, b"MGET queue 5"))
+
+    def test_malformed_batch(self):
+        self.assertEqual("ERROR", execute(self.server, b"MADD queue 2 5 12345"))
+        self.assertEqual("ERROR", execute(self.server, b"MADD queue 3"))
+        self.assertEqual("NONE", execute(self.server, b"GET queue"))
+
+
+class BlockingGetTest(TestCase):
+    def setUp(self):
+        self.server = TaskQueueServer("127.0.0.1", 5555, "./nonexistent/", 0.1, mode="async")
+
+    def test_wakes_waiters_in_order(self):
+        async def scenario():
+            first = asyncio.ensure_future(execute_async(self.server, b"GET queue 1000"))
+            second = asyncio.ensure_future(execute_async(self.server, b"GET queue 1000"))
+            await asyncio.sleep(0.01)
+            self.assertFalse(first.done())
+            execute(self.server, b"ADD queue 1 a")
+            execute(self.server, b"ADD queue 1 b")
+            return await first, await second
+
+        self.assertEqual(("1 1 a", "2 1 b"), asyncio.run(scenario()))
+
+    def test_wait_timeout(self):
+        started = time.monotonic()
+        self.assertEqual("NONE", asyncio.run(execute_async(self.server, b"GET queue 50")))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual({}, self.server._waiters)
+        self.assertEqual({}, self.server.queues)
+
+    def test_wakes_on_expired_lease(self):
+        execute(self.server, b"ADD queue 1 a")
+        execute(self.server, b"GET queue")
+        self.assertEqual("1 1 a", asyncio.run(execute_async(self.server, b"GET queue 1000")))
+
+    def test_cancelled_waiter(self):
+        async def scenario():
+            waiting = asyncio.ensure_future(execute_async(self.server, b"GET queue 1000"))
+            await asyncio.sleep(0.01)
+            # what the connection does when the client goes away
+            waiting.cancel()
+            await asyncio.sleep(0)
+            execute(self.server, b"ADD queue 1 a")
+            return execute(self.server, b"GET queue")
+
+        self.assertEqual("1 1 a", asyncio.run(scenario()))
+        self.assertEqual({}, self.server._waiters)
+
+    def test_wait_limit(self):
+        self.assertEqual("ERROR", execute(self.server, b"GET queue 1" + b"0" * 400))
+
+    def test_sync_mode_does_not_wait(self):
+        server = TaskQueueServer("127.0.0.1", 5555, "./nonexistent/", 0.1)
+        self.assertEqual("NONE", execute(server, b"GET queue 1000"))
+
+
+class StatsCommandTest(TestCase):
+    def setUp(self):
+        self.server = TaskQueueServer("127.0.0.1", 5555, "./nonexistent/", 0.1, stats=True)
+
+    def test_queue_stats(self):
+        execute(self.server, b"MADD queue 3 1 a 1 b 1 c")
+        execute(self.server, b"GET queue")
+        task_id = execute(self.server, b"GET queue").split()[0]
+        execute(self.server, b"ACK queue " + task_id.encode())
+        counters = dict(field.split("=") for field in execute(self.server, b"STATS queue").split())
+        self.assertEqual("2", counters["tasks"])
+        self.assertEqual("1", counters["in_flight"])
+        self.assertEqual("3", counters["added_total"])
+        self.assertEqual("1", counters["acknowledged_total"])
+        self.assertEqual("2", counters["GET_count"])
+        time.sleep(0.15)
+        counters = dict(field.split("=") for field in execute(self.server, b"STATS").split())
+        self.assertEqual("1", counters["queues"])
+        self.assertEqual("0", counters["in_flight"])
+        self.assertEqual("1", counters["redelivered_total"])
+        self.assertEqual("NONE", execute(self.server, b"STATS other"))
+
+    def test_unknown_queues_are_not_created(self):
+        execute(self.server, b"ADD queue 1 a")
+        self.assertEqual("NO", execute(self.server, b"IN nosuch 1"))
+        self.assertEqual("NONE", execute(self.server, b"GET other"))
+        self.assertEqual("NONE", execute(self.server, b"STATS nosuch"))
+        self.assertEqual(["queue"], list(self.server.queues))
+        self.assertEqual({("ADD", "queue"), ("IN", ""), ("GET", ""), ("STATS", "")},
+                         {(name.decode(), queue.decode()) for name, queue in self.server.command_stats.histograms})
+
+    def test_metrics_file(self):
+        with tempfile.TemporaryDirectory() as path:
+            server = TaskQueueServer("127.0.0.1", 5555, path + "/", 0.1, metrics=True)
+            execute(server, b"ADD queue 1 a")
+            server.write_metrics()
+            with open(path + "/" + METRICS_FILENAME) as f:
+                text = f.read()
+        self.assertIn('task_queue_tasks{queue="queue"} 1\n', text)
+        self.assertIn('task_queue_command_seconds_count{command="ADD",queue="queue"} 1\n', text)
@@ -0,0 +1,71 @@
+import random
+from unittest import TestCase
+
+from timing_wheel import TimingWheel
+
+
+class Item:
+    def __init__(self, key, deadline):
+        self.key = key
+        self.deadline = deadline
+        self.timer = None
+
+
+class TimingWheelTest(TestCase):
+    def test_expires_in_order(self):
+        wheel = TimingWheel(0)
+        items = [Item(key, deadline) for key, deadline in enumerate([5, 3, 300, 5, 70000])]
+        for item in items:
+            wheel.schedule(item.key, item, item.deadline)
+        self.assertEqual([], wheel.advance(2))
+        self.assertEqual([1, 0, 3], [item.key for item in wheel.advance(10)])
+        self.assertEqual([], wheel.advance(299))
+        self.assertEqual([2], [item.key for item in wheel.advance(300)])
+        self.assertEqual([4], [item.key for item in wheel.advance(10 ** 6)])
+        self.assertEqual(0, len(wheel))
+
+    def test_cancel(self):
+        wheel = TimingWheel(0)
+        first, second = Item(1, 10), Item(2, 10)
+        wheel.schedule(1, first, 10)
+        wheel.schedule(2, second, 10)
+        wheel.cancel(1, first)
+        wheel.cancel(1, first)
+        self.assertEqual([second], wheel.advance(10))
+
+    def test_past_deadline(self):
+        wheel = TimingWheel(100)
+        item = Item(1, 50)
+        wheel.schedule(1, item, 50)
+        self.assertEqual(100, wheel.next_tick())
+        self.assertEqual([item], wheel.advance(100))
+
+    def test_against_model(self):
+        """Random schedules, cancels and advances on a small wheel, compared with a plain dict"""
+        rng = random.Random(1)
+        wheel = TimingWheel(0, slots=4, levels=3)
+        model = {}
+        now = 0
+        for key in range(5000):
+            action = rng.random()
+            if action < 0.5:
+                item = Item(key, now + rng.randint(-2, 200))
+                wheel.schedule(key, item, item.deadline)
+                # an item scheduled in the past expires on the next advance
+                item.expires = max(item.deadline, now)
+                model[key] = item
+            elif action < 0.7 and model:
+                item = model.pop(rng.choice(list(model)))
+                wheel.cancel(item.key, item)
+            else:
+                next_tick = wheel.next_tick()
+                if model:
+                    self.assertLessEqual(next_tick, max(now, min(item.deadline for item in model.values())))
+                now += rng.randint(0, 30)
+                expired = wheel.advance(now)
+                expected = [item for item in model.values() if item.deadline <= now]
+                self.assertEqual(sorted(item.key for item in expected), sorted(item.key for item in expired))
+                self.assertEqual([item.expires for item in expired], sorted(item.expires for item in expired))
+                for item in expected:
+                    del model[item.key]
+            self.assertEqual(len(model), len(wheel))
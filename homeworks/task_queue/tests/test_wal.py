@@ -0,0 +1,126 @@
+import asyncio
+import os
+import tempfile
+from unittest import TestCase
+
+from server import TaskQueueServer
+from wal import WriteAheadLog, OP_ADD, OP_ACK
+from tests import execute
+
+
+class WriteAheadLogTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, "wal.log")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read_records(self):
+        records = []
+        WriteAheadLog(self.filename, 0).replay(lambda *record: records.append(record))
+        return records
+
+    def test_replay(self):
+        log = WriteAheadLog(self.filename, 0.01)
+        log.open()
+        log.append(OP_ADD, "queue", 1, b"12345")
+        log.append(OP_ACK, "queue", 1)
+        log.close()
+
+        self.assertEqual([(OP_ADD, "queue", 1, b"12345"), (OP_ACK, "queue", 1, b"")], self.read_records())
+
+    def test_torn_tail_is_dropped(self):
+        log = WriteAheadLog(self.filename, 0)
+        log.open()
+        log.append(OP_ADD, "queue", 1, b"12345")
+        log.close()
+        size = os.path.getsize(self.filename)
+        with open(self.filename, "ab") as f:
+            f.write(b"A\x00")
+
+        self.assertEqual([(OP_ADD, "queue", 1, b"12345")], self.read_records())
+        self.assertEqual(size, os.path.getsize(self.filename))
+
+
+class ServerWalTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def start(self):
+        server = TaskQueueServer("127.0.0.1", 5555, self.dir.name + "/", 300, wal=True)
+        self.addCleanup(server.wal.close)
+        return server
+
+    def test_recover_without_save(self):
+        server = self.start()
+        first_task_id = execute(server, b"ADD queue 5 12345")
+        second_task_id = execute(server, b"ADD queue 4 6789")
+        execute(server, b"GET queue")
+        self.assertEqual("YES", execute(server, b"ACK queue " + first_task_id.encode()))
+        server.wal.close()
+
+        server = self.start()
+        self.assertEqual("NO", execute(server, b"IN queue " + first_task_id.encode()))
+        self.assertEqual("YES", execute(server, b"IN queue " + second_task_id.encode()))
+        self.assertEqual(second_task_id + " 4 6789", execute(server, b"GET queue"))
+        self.assertEqual("3", execute(server, b"ADD queue 2 00"))
+
+    def test_async_answers_after_fsync(self):
+        server = TaskQueueServer("127.0.0.1", 5555, self.dir.name + "/", 300, mode="async", wal=True,
+                                 flush_interval=0.05)
+        self.addCleanup(server.wal.close)
+
+        async def scenario():
+            response = server.parse_command(b"ADD queue 5 12345")
+            self.assertFalse(response.done())
+            # not logged, answered right away
+            self.assertEqual("NONE", server.parse_command(b"GET other"))
+            task_id = await response
+            self.assertEqual(1, server.wal.synced)
+            return task_id
+
+        self.assertEqual("1", asyncio.run(scenario()))
+
+    def test_close_after_loop(self):
+        server = TaskQueueServer("127.0.0.1", 5555, self.dir.name + "/", 300, mode="async", wal=True,
+                                 flush_interval=10)
+
+        async def scenario():
+            return server.parse_command(b"ADD queue 5 12345")
+
+        self.assertFalse(asyncio.run(scenario()).done())
+        # the final flush of a stopped server has nobody to answer
+        server.wal.close()
+        self.assertEqual(1, server.wal.synced)
+
+    def test_long_queue_name_is_not_logged(self):
+        server = self.start()
+        self.assertEqual("ERROR", execute(server, b"ADD " + b"q" * 70000 + b" 1 x"))
+        self.assertEqual(0, server.wal.appended)
+        self.assertEqual({}, server.queues)
+
+    def test_save_truncates_log(self):
+        server = self.start()
+        execute(server, b"ADD queue 5 12345")
+        execute(server, b"SAVE")
+        execute(server, b"ADD queue 4 6789")
+        server.wal.close()
+
+        server = self.start()
+        self.assertEqual("1 5 12345", execute(server, b"GET queue"))
+        self.assertEqual("2 4 6789", execute(server, b"GET queue"))
+        self.assertEqual("NONE", execute(server, b"GET queue"))
+
+    def test_recover_delay_and_priority(self):
+        server = self.start()
+        execute(server, b"ADD queue 1 a")
+        execute(server, b"MADD queue priority=3 2 1 b 1 c")
+        execute(server, b"ADD queue delay=100000 priority=9 1 d")
+        server.wal.close()
+
+        server = self.start()
+        self.assertEqual("2 1 b 3 1 c 1 1 a", execute(server, b"MGET queue 5"))
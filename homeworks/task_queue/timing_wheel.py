@@ -0,0 +1,144 @@
+"""Hierarchical timing wheel for lease deadlines.
+
+Time is counted in integer ticks. Level 0 has one slot per tick, every slot of level n covers
+a whole rotation of level n - 1. A timer goes to the lowest level whose rotation still reaches
+its deadline and moves down a level each time the wheel passes the start of its slot, so
+scheduling, cancelling and expiring are O(1) and advancing costs O(ticks passed) at worst.
+Empty stretches of the wheel are skipped.
+
+Scheduled items get a `timer` attribute, the wheel uses it to find them on cancel.
+"""
+
+
+SLOTS = 256
+LEVELS = 4
+
+
+class TimingWheel:
+    def __init__(self, now, slots=SLOTS, levels=LEVELS):
+        if levels < 2:
+            # deadlines beyond the wheel are parked in the top level, they must cascade to be checked again
+            raise ValueError("timing wheel needs at least two levels")
+        self.current = now
+        self.slots = slots
+        # level -> slot -> {key: item}, slot dicts are created on first use
+        self._levels = [[None] * slots for _ in range(levels)]
+        self._level_sizes = [0] * levels
+        # items with a deadline that has already passed
+        self._due = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def schedule(self, key, item, deadline):
+        """Adds an item expiring at the deadline tick, key must be unique among scheduled items"""
+        delta = deadline - self.current
+        if delta <= 0:
+            bucket = self._due
+            level = None
+        else:
+            level = 0
+            span = self.slots
+            while delta >= span and level < len(self._levels) - 1:
+                level += 1
+                span *= self.slots
+            # deadlines beyond the top level wait in its furthest slot and are rescheduled from there
+            slot_tick = min(deadline, self.current + span - 1)
+            slots = self._levels[level]
+            index = (slot_tick // (span // self.slots)) % self.slots
+            bucket = slots[index]
+            if bucket is None:
+                bucket = slots[index] = {}
+            self._level_sizes[level] += 1
+        bucket[key] = item
+        item.timer = (bucket, level, deadline)
+        self._size += 1
+
+    def cancel(self, key, item):
+        if item.timer is None:
+            return
+        bucket, level, _ = item.timer
+        del bucket[key]
+        if level is not None:
+            self._level_sizes[level] -= 1
+        item.timer = None
+        self._size -= 1
+
+    def advance(self, now):
+        """Moves the wheel to the tick now and returns the items expired by then, in scheduling order per tick"""
+        expired = self._take(self._due, None)
+        while self.current < now:
+            if not self._size:
+                self.current = now
+                break
+            self._skip_empty(now)
+            self.current += 1
+            self._cascade(1)
+            if self._due:
+                # cascaded items with the deadline right at the boundary
+                expired.extend(self._take(self._due, None))
+            bucket = self._levels[0][self.current % self.slots]
+            if bucket:
+                self._levels[0][self.current % self.slots] = None
+                expired.extend(self._take(bucket, 0))
+        return expired
+
+    def next_tick(self):
+        """Earliest tick when an item may expire, None if nothing is scheduled.
+
+        Items of upper levels are answered conservatively with the next cascade of their level.
+        """
+        if not self._size:
+            return None
+        if self._due:
+            return self.current
+        ticks = []
+        if self._level_sizes[0]:
+            ticks.append(next(tick for tick in range(self.current + 1, self.current + self.slots + 1)
+                              if self._levels[0][tick % self.slots]))
+        span = self.slots
+        for size in self._level_sizes[1:]:
+            if size:
+                ticks.append((self.current // span + 1) * span)
+                break
+            span *= self.slots
+        return min(ticks)
+
+    def _take(self, bucket, level):
+        items = list(bucket.values())
+        bucket.clear()
+        for item in items:
+            item.timer = None
+        self._size -= len(items)
+        if level is not None:
+            self._level_sizes[level] -= len(items)
+        return items
+
+    def _skip_empty(self, now):
+        """Jumps over ticks where nothing can expire or cascade: up to the next boundary of the lowest used level"""
+        span = 1
+        for size in self._level_sizes:
+            if size:
+                break
+            span *= self.slots
+        if span > 1:
+            self.current = max(self.current, min(now, (self.current // span + 1) * span) - 1)
+
+    def _cascade(self, level):
+        """Moves items of the level slot that starts at the current tick to lower levels"""
+        if level >= len(self._levels):
+            return
+        span = self.slots ** level
+        if self.current % span:
+            return
+        self._cascade(level + 1)
+        index = (self.current // span) % self.slots
+        bucket = self._levels[level][index]
+        if not bucket:
+            return
+        self._levels[level][index] = None
+        entries = [(key, item, item.timer[2]) for key, item in bucket.items()]
+        self._take(bucket, level)
+        for key, item, deadline in entries:
+            self.schedule(key, item, deadline)
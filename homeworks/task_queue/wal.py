@@ -0,0 +1,156 @@
+import glob
+import os
+import struct
+import threading
+
+
+WAL_FILENAME = "wal.log"
+
+OP_ADD = b"A"
+OP_ACK = b"K"
+# ADD with a delay or priority, the payload starts with SCHEDULE_FORMAT
+OP_ADD_SCHEDULED = b"S"
+# GET, the payload is LEASE_FORMAT. Only streamed to replication followers, never written to the log
+OP_LEASE = b"L"
+
+# operation, queue name length, task id, payload length. Longer queue names are refused by the tokenizer
+RECORD_HEADER = struct.Struct("!cHQI")
+# priority, unix timestamp when the task becomes ready (0 if not delayed)
+SCHEDULE_FORMAT = struct.Struct("!hd")
+# unix timestamp of the GET
+LEASE_FORMAT = struct.Struct("!d")
+
+
+def append_record(buffer, op, queue_name, task_id, payload=b""):
+    """Appends a record to a bytearray"""
+    queue_name = queue_name.encode("utf-8")
+    buffer += RECORD_HEADER.pack(op, len(queue_name), task_id, len(payload))
+    buffer += queue_name
+    buffer += payload
+
+
+def decode_records(data):
+    """Yields (op, queue_name, task_id, payload, end offset) of the complete records at the start of data"""
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        op, name_length, task_id, payload_length = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + name_length + payload_length
+        if end > len(data):
+            break
+        name_start = offset + RECORD_HEADER.size
+        payload_start = name_start + name_length
+        yield op, data[name_start:payload_start].decode("utf-8"), task_id, data[payload_start:end], end
+        offset = end
+
+
+class WriteAheadLog:
+    """Append-only log of queue mutations.
+
+    Records are buffered in memory and written with one fsync per flush interval. Zero interval means
+    fsync on every append. Otherwise a record is on disk only once on_sync(position) reports a position
+    not less than the one append returned: a caller answering before that may lose up to the last
+    interval of answered commands in a crash, one waiting for it gets group commit.
+
+    Before a snapshot the log is rotated: the current file is renamed to a numbered segment
+    that is deleted once the snapshot is complete.
+    """
+
+    def __init__(self, filename, flush_interval, on_sync=None):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        # called with the new synced position after every fsync, from the flushing thread
+        self.on_sync = on_sync
+        # number of records appended and of those known to be on disk
+        self.appended = 0
+        self.synced = 0
+        self._file = None
+        self._buffer = bytearray()
+        # _lock guards the buffer only, so appends do not wait for fsync
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+
+    def _segments(self):
+        """Returns numbers of rotated segments in order"""
+        prefix = self.filename + "."
+        return sorted(int(name[len(prefix):]) for name in glob.glob(glob.escape(prefix) + "[0-9]*"))
+
+    def _segment_filename(self, number):
+        return f"{self.filename}.{number}"
+
+    def replay(self, apply):
+        """Calls apply(op, queue_name, task_id, payload) for every record of the segments and the current file"""
+        for number in self._segments():
+            self._replay_file(self._segment_filename(number), apply)
+        self._replay_file(self.filename, apply)
+
+    def _replay_file(self, filename, apply):
+        """Applies every complete record and cuts off a torn tail"""
+        if not os.path.isfile(filename):
+            return
+        with open(filename, "rb") as f:
+            data = f.read()
+        offset = 0
+        for op, queue_name, task_id, payload, offset in decode_records(data):
+            apply(op, queue_name, task_id, payload)
+        if offset != len(data):
+            os.truncate(filename, offset)
+
+    def open(self):
+        self._file = open(self.filename, "ab")
+        if self.flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flusher.start()
+
+    def append(self, op, queue_name, task_id, payload=b""):
+        """Returns the position of the record"""
+        with self._lock:
+            append_record(self._buffer, op, queue_name, task_id, payload)
+            self.appended += 1
+            position = self.appended
+        if self.flush_interval <= 0:
+            self.flush()
+        return position
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                buffer, self._buffer = self._buffer, bytearray()
+                position = self.appended
+            if not buffer:
+                return
+            self._file.write(buffer)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.synced = position
+            if self.on_sync is not None:
+                self.on_sync(position)
+
+    def rotate(self):
+        """Moves all records written so far to a new segment and returns its number"""
+        self.flush()
+        with self._write_lock:
+            segments = self._segments()
+            number = segments[-1] + 1 if segments else 1
+            self._file.close()
+            os.replace(self.filename, self._segment_filename(number))
+            self._file = open(self.filename, "ab")
+        return number
+
+    def drop_segments(self, number):
+        """Deletes segments up to number, called once their records are saved in a snapshot"""
+        for segment in self._segments():
+            if segment <= number:
+                os.remove(self._segment_filename(segment))
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        self._file.close()